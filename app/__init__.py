@@ -1,4 +1,5 @@
 from flask import Flask, json
+from werkzeug.serving import run_simple
 from flask_restplus import Api
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
@@ -7,6 +8,7 @@ from celery import Celery
 from flask_migrate import Migrate, init as db_init, migrate as db_migrate, upgrade as db_upgrade
 from config import config
 import os
+import click
 import redis
 from pytz import utc
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -20,10 +22,10 @@ app.config.from_object(config[os.environ.get('FLASK_ENV')])
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
-# APScheduler
+# APScheduler, paused so jobs only run in `flask scheduler`, see leader.py
 scheduler = BackgroundScheduler()
 scheduler.configure(jobstores=app.config['SCHEDULER_JOBSTORES'], timezone=utc)
-scheduler.start()
+scheduler.start(paused=True)
 
 celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
 celery.conf.update(app.config)
@@ -49,6 +51,8 @@ def update():
     # update user roles
     model.Role.insert_roles()
     model.File.clear_missing_file()
+    # pause totals kept on the phases
+    model.Phase.fill_pauses()
 
 
 @app.cli.command()
@@ -62,6 +66,64 @@ def init():
     model.Option.init_option()
     db_init()
 
+@app.cli.command()
+def reindex():
+    # rebuild the search index of every project and file
+    from sqlalchemy.orm import selectinload
+    from .model.search import indexProject, indexFile
+    for project in model.Project.query.options(selectinload(model.Project.tags)).all():
+        indexProject(project)
+    for file in model.File.query.options(selectinload(model.File.tags)).all():
+        indexFile(file)
+    db.session.commit()
+    print('search index rebuilt.')
+
+
+@app.cli.command()
+def bench():
+    # compare marshal with the compiled serializers on stored data
+    from .restful.serializer import benchmark
+    from .restful.projects import M_PROJECT, L_PROJECT
+    from .restful.users import M_USER, L_USER
+    projects = model.Project.query.options(*L_PROJECT).limit(100).all()
+    users = model.User.query.options(*L_USER).limit(100).all()
+    for name, fields, data in (('project', M_PROJECT, projects), ('user', M_USER, users)):
+        result = benchmark(fields, data)
+        print('%s x%d: identical=%s marshal=%.2fms compiled=%.2fms speedup=%.1fx' % (
+            name, len(data), result['identical'], result['marshal']*1000, result['compiled']*1000, result['speedup']))
+
+
+@app.cli.command('scheduler')
+def run_scheduler():
+    # run the scheduled jobs while this process holds the leader lock
+    from .leader import runScheduler
+    runScheduler()
+
+
+@app.cli.command()
+def deadlines():
+    # drop the old per-project delay jobs and flag what is overdue
+    removed, project_ids = model.project.reconcileDeadlines()
+    print('%d delay jobs removed, %d projects flagged as delayed.' % (removed, len(project_ids)))
+
+
+@app.cli.command()
+def rollup():
+    # rebuild the per user and day dashboard stats from the whole history
+    from .model.stats import rollupStats
+    print('%d day stats rows written.' % rollupStats())
+
+
+@app.cli.command('wechat-stub')
+@click.option('--port', default=8090)
+@click.option('--limit', default=0, help='Messages a second before answering 45009, 0 for no limit.')
+@click.option('--expires-in', default=7200, help='Seconds an access token lasts.')
+def wechat_stub(port, limit, expires_in):
+    # stands in for api.weixin.qq.com, set WECHAT_API_URL = 'http://localhost:<port>'
+    from .wxstub import wechatStub
+    run_simple('localhost', port, wechatStub(limit, expires_in), threaded=True)
+
+
 @app.cli.command()
 def doc():
     with app.app_context(), app.test_request_context():
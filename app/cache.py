@@ -0,0 +1,248 @@
+"""
+Cache helpers
+
+Values are stored as JSON in Redis (r_db). With CACHE_BACKEND = 'local' a
+process-local dict stands in for Redis, for development and tests only: it
+is not shared between gunicorn workers. Redis errors never fail a request,
+a read just misses and a write is dropped.
+"""
+from . import app, r_db
+import json
+import time
+import redis
+import threading
+
+
+class LocalCache:
+    """The few Redis commands we use, kept in this process.
+
+    With size, the keys set longest ago are dropped past that many keys.
+    """
+
+    def __init__(self, size=None):
+        self.data = {}
+        self.size = size
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        value, expire = self.data.get(key, (None, None))
+        if expire and expire < time.time():
+            del self.data[key]
+            return None
+        return value
+
+    def set(self, key, value, ex=None, nx=False):
+        with self.lock:
+            if nx and key in self.data:
+                expire = self.data[key][1]
+                if not expire or expire >= time.time():
+                    return None
+            self.data.pop(key, None)
+            self.data[key] = (value, time.time() + ex if ex else None)
+            if self.size and len(self.data) > self.size:
+                del self.data[next(iter(self.data))]
+        return True
+
+    def mget(self, keys):
+        with self.lock:
+            return [self._get(key) for key in keys]
+
+    def incr(self, key):
+        with self.lock:
+            value, expire = self.data.get(key, (0, None))
+            value = int(value) + 1
+            self.data[key] = (value, expire)
+            return value
+
+    def delete(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+
+    def renew(self, key, value, ex):
+        with self.lock:
+            if self._get(key) != value:
+                return 0
+            self.data[key] = (value, time.time() + ex)
+            return 1
+
+    def release(self, key, value):
+        with self.lock:
+            if self._get(key) != value:
+                return 0
+            del self.data[key]
+            return 1
+
+
+local_cache = LocalCache()
+
+# compare-and-set on the Redis side, so a lock is only renewed or released
+# by the process holding it
+RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def cacheClient():
+    if app.config.get('CACHE_BACKEND', 'redis') == 'local':
+        return local_cache
+    return r_db
+
+
+def cacheGet(key, raw=False):
+    """Cached value of key, or None. raw returns the stored JSON text."""
+    try:
+        value = cacheClient().get(key)
+    except redis.RedisError as e:
+        print(e)
+        return None
+    if value is None or raw:
+        return value
+    return json.loads(value)
+
+
+def cacheSet(key, value, ttl=None, raw=False):
+    """Store value as JSON, or as it is when raw."""
+    try:
+        cacheClient().set(
+            key, value if raw else json.dumps(value, ensure_ascii=False), ex=ttl)
+    except redis.RedisError as e:
+        print(e)
+
+
+def cacheAdd(key, value, ttl=None):
+    """Set key only if it isn't set yet, True if this call did."""
+    try:
+        return bool(cacheClient().set(
+            key, json.dumps(value, ensure_ascii=False), ex=ttl, nx=True))
+    except redis.RedisError as e:
+        print(e)
+        return False
+
+
+def cacheRenew(key, value, ttl):
+    """Reset the ttl of key if it still holds value, True if it did."""
+    value = json.dumps(value, ensure_ascii=False)
+    try:
+        client = cacheClient()
+        if client is local_cache:
+            return bool(client.renew(key, value, ttl))
+        return bool(client.eval(RENEW, 1, key, value, ttl))
+    except redis.RedisError as e:
+        print(e)
+        return False
+
+
+def cacheRelease(key, value):
+    """Delete key if it still holds value."""
+    value = json.dumps(value, ensure_ascii=False)
+    try:
+        client = cacheClient()
+        if client is local_cache:
+            return bool(client.release(key, value))
+        return bool(client.eval(RELEASE, 1, key, value))
+    except redis.RedisError as e:
+        print(e)
+        return False
+
+
+def cacheDelete(*keys):
+    try:
+        cacheClient().delete(*keys)
+    except redis.RedisError as e:
+        print(e)
+
+
+def cachePublish(channel, message):
+    """Send message to every cacheSubscribe of channel, in any process."""
+    client = cacheClient()
+    if client is local_cache:
+        return
+    try:
+        client.publish(channel, json.dumps(message, ensure_ascii=False))
+    except redis.RedisError as e:
+        print(e)
+
+
+def cacheSubscribe(channel, handler, on_connect=None):
+    """Call handler(message) for every message published on channel.
+
+    Listens in a daemon thread and reconnects when Redis goes away. Messages
+    sent meanwhile are lost, so on_connect() runs every time the
+    subscription starts, to catch up. Does nothing on the local backend.
+    """
+    if cacheClient() is local_cache:
+        return
+
+    def listen():
+        while True:
+            try:
+                pubsub = r_db.pubsub()
+                pubsub.subscribe(channel)
+                for item in pubsub.listen():
+                    if item['type'] == 'subscribe' and on_connect:
+                        on_connect()
+                    elif item['type'] == 'message':
+                        handler(json.loads(item['data']))
+            except Exception as e:
+                print(e)
+                time.sleep(1)
+
+    threading.Thread(target=listen, name='subscribe:' + channel, daemon=True).start()
+
+
+def _versionSeed():
+    # counters start from the clock, in microseconds, so one lost with a
+    # Redis flush or restart comes back above every value it had before
+    return int(time.time() * 1000000)
+
+
+def getVersion(name):
+    """Current value of a version counter, see getVersions."""
+    versions = getVersions([name])
+    return versions[0] if versions else None
+
+
+def getVersions(names):
+    """Current values of version counters with one round trip, None on error.
+
+    A missing counter is started from the clock first, never from 0, so a
+    token or ETag taken before the cache was lost can't match again.
+    """
+    keys = ['version:' + name for name in names]
+    try:
+        client = cacheClient()
+        values = client.mget(keys)
+        if None in values:
+            for key, value in zip(keys, values):
+                if value is None:
+                    client.set(key, _versionSeed(), nx=True)
+            values = client.mget(keys)
+        return [int(value) for value in values]
+    except (redis.RedisError, TypeError, ValueError) as e:
+        print(e)
+        return None
+
+
+def bumpVersion(name):
+    key = 'version:' + name
+    try:
+        client = cacheClient()
+        client.set(key, _versionSeed(), nx=True)
+        return client.incr(key)
+    except redis.RedisError as e:
+        print(e)
+        return None
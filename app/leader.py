@@ -0,0 +1,57 @@
+"""
+Scheduler leader
+
+Every process starts the scheduler paused: adding or removing a job only
+writes the Redis jobstore, nothing runs there. Jobs run in `flask scheduler`
+processes. The one holding the LEADER_KEY lock resumes its scheduler and
+renews the lock every SCHEDULER_HEARTBEAT seconds; the others stand by until
+the lock expires, SCHEDULER_LEADER_TTL seconds after the last heartbeat.
+"""
+from . import app, scheduler
+from .cache import cacheAdd, cacheGet, cacheRenew, cacheRelease
+from apscheduler.schedulers.base import STATE_PAUSED, STATE_RUNNING
+import os
+import socket
+import time
+import uuid
+
+LEADER_KEY = 'scheduler:leader'
+
+
+def schedulerLeader():
+    """Identity of the process running the jobs, None if there is none."""
+    return cacheGet(LEADER_KEY)
+
+
+def lead(identity):
+    from .model.project import startSweeper
+    scheduler.resume()
+    startSweeper()
+    print('%s leads the scheduler' % identity)
+
+
+def runScheduler():
+    identity = '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    ttl = app.config.get('SCHEDULER_LEADER_TTL', 30)
+    heartbeat = app.config.get('SCHEDULER_HEARTBEAT', 10)
+    leading = False
+    try:
+        while True:
+            if leading:
+                leading = cacheRenew(LEADER_KEY, identity, ttl)
+            else:
+                leading = cacheAdd(LEADER_KEY, identity, ttl)
+
+            if leading and scheduler.state == STATE_PAUSED:
+                lead(identity)
+            elif not leading and scheduler.state == STATE_RUNNING:
+                scheduler.pause()
+                print('%s lost the scheduler lock, standing by' % identity)
+            elif leading:
+                # jobs added by other processes are only seen on a wakeup
+                scheduler.wakeup()
+            time.sleep(heartbeat)
+    finally:
+        if leading:
+            scheduler.pause()
+            cacheRelease(LEADER_KEY, identity)
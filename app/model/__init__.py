@@ -1,6 +1,6 @@
 from .post import Post, Comment, Category, Tag
 
-from .project import Project, Stage, Phase, ProjectPause, ProjectLog, ProjectNotice
+from .project import Project, Stage, Phase, ProjectPause, ProjectLog, ProjectNotice, WxOutbox
 
 from .file import File, Preview
 
@@ -8,3 +8,12 @@ from .user import User, Role, Group, WxUser
 
 from .misc import Option
 
+from .search import SearchTerm
+
+from .stats import UserDayStats
+
+
+from .. import db
+
+# set up the backrefs now, the loader profiles refer to them at import time
+db.configure_mappers()
@@ -4,7 +4,8 @@ import os
 import shortuuid
 from psd_tools import PSDImage
 from PIL import Image
-from .post import Tag
+from .post import Tag, resolveTags
+from .search import indexFile, removeDocument
 from ..utility import word2List
 FILE_TAG = db.Table(
     'file_tags',
@@ -32,7 +33,7 @@ class File(db.Model):
     public = db.Column(db.Boolean, nullable=False, default=False)
     tags = db.relationship(
         'Tag', secondary=FILE_TAG,
-        lazy='subquery', backref=db.backref('files', lazy=True))
+        lazy=True, backref=db.backref('files', lazy=True))
 
     @staticmethod
     def create_file(uploader_id, file, description, tags, public):
@@ -71,15 +72,14 @@ class File(db.Model):
                 tag_list = word2List(tag)
                 all_tag_list += tag_list
 
-            for tag in all_tag_list:
-                _tag = Tag.query.filter_by(name=tag).first()
-                if not _tag:
-                    _tag = Tag(name=tag)
-                    db.session.add(_tag)
-                new_file.tags.append(_tag)
+            new_file.tags = resolveTags(all_tag_list)
 
         db.session.add(new_file)
+        db.session.flush()
+        indexFile(new_file)
         db.session.commit()
+        if new_file.public:
+            fileStatsChanged(new_file)
 
         if format in ['png','jpg','psd','jpeg','gif','bmp','tga','tiff','tif']:
             try:
@@ -114,6 +114,7 @@ class File(db.Model):
             if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], file.url)):
                 for preview in file.previews:
                     db.session.delete(preview)
+                removeDocument('file', file.id)
                 db.session.delete(file)
         db.session.commit()
 
@@ -129,4 +130,10 @@ class Preview(db.Model):
     size = db.Column(db.Integer)
 
     def __repr__(self):
-        return '<Preview %r>' % self.nickname
\ No newline at end of file
+        return '<Preview %r>' % self.nickname
+
+
+def fileStatsChanged(file):
+    """Call once a public file or its tags changed, see model.stats."""
+    from .stats import refreshStats
+    refreshStats([(file.uploader_user_id, file.upload_date)])
@@ -1,4 +1,28 @@
 from .. import db
+from ..cache import cachePublish, cacheSubscribe
+import os
+import threading
+
+# every option of this process, name: value
+OPTIONS = {}
+OPTIONS_LOCK = threading.Lock()
+OPTIONS_PID = [None]
+OPTIONS_START = threading.Lock()
+
+
+def getByIds(model, ids):
+    """Load the rows of model with these ids in one IN query.
+
+    Returns (rows, missing): rows in the order of ids, missing the ids no row
+    has, in the same order.
+    """
+    ids = [int(_id) for _id in ids or []]
+    found = {}
+    if ids:
+        found = {row.id: row for row in model.query.filter(model.id.in_(set(ids))).all()}
+    rows = [found[_id] for _id in ids if _id in found]
+    missing = [_id for _id in ids if _id not in found]
+    return rows, missing
 
 
 class Option(db.Model):
@@ -9,13 +33,61 @@ class Option(db.Model):
 
     @staticmethod
     def init_option():
-        new_option = Option(
-            name='allow_sign_in',
-            value=1
-        )
-
-        db.session.add(new_option)
-        db.session.commit()
+        setOption('allow_sign_in', 1)
 
     def __repr__(self):
         return '<Option %r>' % self.name
+
+
+def loadOptions():
+    values = dict(db.session.query(Option.name, Option.value).all())
+    with OPTIONS_LOCK:
+        OPTIONS.clear()
+        OPTIONS.update(values)
+
+
+def _reloadOptions():
+    loadOptions()
+    db.session.remove()
+
+
+def _optionPublished(message):
+    with OPTIONS_LOCK:
+        OPTIONS[message['name']] = message['value']
+
+
+def getOption(name, default=None, type=str):
+    """Value of an option as type, default if it is unset or won't convert.
+
+    Options are read from the database once per process and kept in memory.
+    setOption pushes changes to every process through Redis pub/sub.
+    """
+    if OPTIONS_PID[0] != os.getpid():
+        # first read in this process, forked children start over
+        with OPTIONS_START:
+            if OPTIONS_PID[0] != os.getpid():
+                loadOptions()
+                cacheSubscribe('options', _optionPublished, _reloadOptions)
+                OPTIONS_PID[0] = os.getpid()
+
+    value = OPTIONS.get(name)
+    if value is None:
+        return default
+    try:
+        return type(value)
+    except ValueError:
+        return default
+
+
+def setOption(name, value):
+    """Store an option and push it to every process. Commits the session."""
+    value = None if value is None else str(value)
+    option = Option.query.filter_by(name=name).first()
+    if option:
+        option.value = value
+    else:
+        db.session.add(Option(name=name, value=value))
+    db.session.commit()
+    with OPTIONS_LOCK:
+        OPTIONS[name] = value
+    cachePublish('options', {'name': name, 'value': value})
@@ -1,5 +1,8 @@
 from .. import db
 from datetime import datetime
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+import threading
 
 post_tag = db.Table('post_tags',
                     db.Column('tag_id', db.Integer, db.ForeignKey('tags.id')),
@@ -127,4 +130,55 @@ class Tag(db.Model):
     description = db.Column(db.String(512))
 
     def __repr__(self):
-        return '<Tag %r>' % self.name
\ No newline at end of file
+        return '<Tag %r>' % self.name
+
+
+# tag name -> id of this process, tags are never renamed or deleted
+TAG_IDS = {}
+TAG_IDS_LOCK = threading.Lock()
+MAX_TAG_IDS = 10000
+
+
+def _tagIds(names, remember=True):
+    rows = db.session.query(Tag.name, Tag.id).filter(Tag.name.in_(names)).all()
+    if remember:
+        with TAG_IDS_LOCK:
+            if len(TAG_IDS) + len(rows) > MAX_TAG_IDS:
+                TAG_IDS.clear()
+            TAG_IDS.update(rows)
+    return dict(rows)
+
+
+def resolveTags(names):
+    """Tags of these names in the session, missing ones are created.
+
+    Names are looked up in TAG_IDS first, then with one IN query. New names
+    go in with a single INSERT that ignores names another request inserted
+    meanwhile, and one more query reads their ids. Returns the tags in the
+    order of names, without duplicates.
+    """
+    names = list(dict.fromkeys(name for name in names if name))
+    ids = {name: TAG_IDS[name] for name in names if name in TAG_IDS}
+    misses = [name for name in names if name not in ids]
+    if misses:
+        ids.update(_tagIds(misses))
+        new = [name for name in misses if name not in ids]
+        if new:
+            db.session.execute(
+                Tag.__table__.insert()
+                .prefix_with('IGNORE', dialect='mysql')
+                .prefix_with('OR IGNORE', dialect='sqlite'),
+                [{'name': name} for name in new])
+            # not remembered yet, the insert may still be rolled back
+            ids.update(_tagIds(new, remember=False))
+
+    tags = []
+    for name in names:
+        tag = db.session.identity_map.get(identity_key(Tag, ids[name]))
+        if tag is None:
+            # known id and name, no need to load the row
+            tag = Tag(id=ids[name], name=name)
+            make_transient_to_detached(tag)
+            db.session.add(tag)
+        tags.append(tag)
+    return tags
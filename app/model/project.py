@@ -3,14 +3,18 @@ Project Stage Phase Propose
 """
 
 from datetime import datetime, timedelta
+from sqlalchemy import or_, and_, func
+from pytz import utc
+from sqlalchemy.orm import joinedload
 from .. import db, scheduler, app
-from .user import User, Group
-from .misc import Option
+from .user import User, Group, userUpdated
+from .misc import getByIds
 from .file import File
-from .post import Tag
+from .post import Tag, resolveTags
+from .search import indexProject, removeDocuments
+from ..cache import bumpVersion
 import math
 import json
-import requests
 from ..utility import UTC2Local, excerptHtml, word2List, getPhaseIndex, getStageIndex
 
 PROJECT_TAG = db.Table(
@@ -52,10 +56,10 @@ class Project(db.Model):
     design = db.Column(db.Text)
     remark = db.Column(db.Text)
     files = db.relationship('File', secondary=PROJECT_FILE,
-                            lazy='subquery', backref=db.backref('projects', lazy=True))
+                            lazy=True, backref=db.backref('projects', lazy=True))
     tags = db.relationship(
         'Tag', secondary=PROJECT_TAG,
-        lazy='subquery', backref=db.backref('projects', lazy=True))
+        lazy=True, backref=db.backref('projects', lazy=True))
 
     # user data
     client_user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -83,7 +87,7 @@ class Project(db.Model):
     # just for query more earily
     start_date = db.Column(db.DateTime)
     finish_date = db.Column(db.DateTime)
-    deadline_date = db.Column(db.DateTime)
+    deadline_date = db.Column(db.DateTime, index=True)
 
     def current_stage(self):
         """Get current stage."""
@@ -130,26 +134,26 @@ class Project(db.Model):
         )
         db.session.add(new_log)
 
-        # create a new delay counter
-        addDelayCounter(self.id, deadline)
+        # the sweeper flags it once the deadline passes
+        wakeSweeper(deadline)
         db.session.commit()
+        projectUpdated(self.id)
 
     def editUpload(self, operator_id, creator_id, upload, files, upload_files):
         current_phase = self.current_phase()
+        # the upload moves to the new creator's stats
+        uploaded = bool(current_phase.upload_date)
+        stats_keys = statsKeys([self.id]) if uploaded else ()
         current_phase.creator_user_id = creator_id
         current_phase.creator_upload = upload
-        current_phase.upload_files = []
+        current_phase.upload_files = getFiles([f['id'] for f in upload_files])
         if files:
-            current_phase.files = []
-            for file_id in files:
-                file = File.query.get(file_id)
-                current_phase.files.append(file)
-
-        for upload_file in upload_files:
-            current_phase.upload_files.append(
-                File.query.get(upload_file['id']))
+            current_phase.files = getFiles(files)
 
         db.session.commit()
+        projectUpdated(self.id)
+        if uploaded:
+            statsChanged([self.id], stats_keys)
 
     def doUpload(self, operator_id, creator_id, upload_content, files, upload_files):
         """upload current stage."""
@@ -159,16 +163,9 @@ class Project(db.Model):
         current_phase = self.current_phase()
         current_phase.creator_user_id = creator_id
         current_phase.creator_upload = upload_content
-        current_phase.upload_files = []
+        current_phase.upload_files = getFiles([f['id'] for f in upload_files])
         if files:
-            current_phase.files = []
-            for file_id in files:
-                file = File.query.get(file_id)
-                current_phase.files.append(file)
-
-        for upload_file in upload_files:
-            current_phase.upload_files.append(
-                File.query.get(upload_file['id']))
+            current_phase.files = getFiles(files)
         current_phase.upload_date = datetime.utcnow()
 
         # project update
@@ -176,8 +173,6 @@ class Project(db.Model):
         self.delay = False
 
         self.deadline_date = None
-        # stop the delay counter
-        removeDelayCounter(self.id)
 
         # logging
         new_log = ProjectLog(
@@ -188,13 +183,16 @@ class Project(db.Model):
             operator_user_id=operator_id
         )
         db.session.add(new_log)
+        db.session.flush()
+
+        # notices go in with the log: every editor and the client
+        to_user_ids = sendNotices(
+            new_log, or_(User.role_id == 2, User.id == self.client_user_id))
 
         db.session.commit()
-        editors = User.query.filter(User.role_id==2).all()
-        for editor in editors:
-            if self.client_user_id != editor.id:
-                send_message(new_log, editor)
-        send_message(new_log, self.client)
+        projectUpdated(self.id)
+        statsChanged([self.id])
+        notifyUsers(to_user_ids)
 
     def editFeedback(self, operator_id, client_id, feedback_content, files):
         """Set the status to 'modify'."""
@@ -203,12 +201,10 @@ class Project(db.Model):
         current_phase.client_feedback = feedback_content
         current_phase.client_user_id = client_id
         if files:
-            current_phase.files = []
-            for file_id in files:
-                file = File.query.get(file_id)
-                current_phase.files.append(file)
+            current_phase.files = getFiles(files)
 
         db.session.commit()
+        projectUpdated(self.id)
 
     def doFeedback(self, operator_id, client_id, feedback_content, files, is_pass):
         """Set the status to 'modify'."""
@@ -222,12 +218,7 @@ class Project(db.Model):
         current_phase.feedback_date = datetime.utcnow()
         
         if files:
-            print(files)
-            current_phase.files = []
-            for file_id in files:
-                print(file_id)
-                file = File.query.get(file_id)
-                current_phase.files.append(file)
+            current_phase.files = getFiles(files)
 
         if is_pass:
             # if current stage is not the last one, then go into next stage
@@ -247,8 +238,8 @@ class Project(db.Model):
                 )
                 db.session.add(new_phase)
                 self.deadline_date = deadline
-                # create a new delay counter
-                addDelayCounter(self.id, deadline)
+                # the sweeper flags it once the deadline passes
+                wakeSweeper(deadline)
             else:
                 # project update
                 self.progress = -1
@@ -269,8 +260,8 @@ class Project(db.Model):
             )
             db.session.add(new_phase)
             self.deadline_date = deadline
-            # create a new delay counter
-            addDelayCounter(self.id, deadline)
+            # the sweeper flags it once the deadline passes
+            wakeSweeper(deadline)
 
         # logging
         new_log = ProjectLog(
@@ -281,13 +272,20 @@ class Project(db.Model):
             operator_user_id=operator_id
         )
         db.session.add(new_log)
+        db.session.flush()
+        to_user_ids = sendNotices(new_log, User.id == self.creator_user_id)
+
         db.session.commit()
-        send_message(new_log, self.creator)
+        projectUpdated(self.id)
+        statsChanged([self.id])
+        notifyUsers(to_user_ids)
 
     def doChangeStage(self, operator_id, progress_index):
         """change stage"""
         if self.discard or self.pause:
             raise Exception("Discard or paused project can't change stage!")
+        # the removed phase and finish date no longer count on their days
+        stats_keys = statsKeys([self.id])
 
         current_phase = self.current_phase()
         if current_phase:
@@ -305,8 +303,6 @@ class Project(db.Model):
             else:
                 self.status = 'finish'
                 self.finish_date = datetime.utcnow()
-
-            removeDelayCounter(self.id)
         else:
             next_stage = self.stages[progress_index-1]
             deadline = datetime.utcnow() + timedelta(days=next_stage.days_planned)
@@ -317,7 +313,7 @@ class Project(db.Model):
             )
             db.session.add(new_phase)
             self.deadline_date = deadline
-            addDelayCounter(self.id, deadline)
+            wakeSweeper(deadline)
 
             self.status = 'progress'
 
@@ -329,6 +325,8 @@ class Project(db.Model):
         )
         db.session.add(new_log)
         db.session.commit()
+        projectUpdated(self.id)
+        statsChanged([self.id], stats_keys)
 
     def doDiscard(self, operator_id):
         """Discard this project."""
@@ -347,6 +345,7 @@ class Project(db.Model):
         )
         db.session.add(new_log)
         db.session.commit()
+        projectUpdated(self.id)
 
     def doRecover(self, operator_id):
         """Recover this project."""
@@ -362,6 +361,7 @@ class Project(db.Model):
         db.session.add(new_log)
 
         db.session.commit()
+        projectUpdated(self.id)
 
         if self.pause:
             self.doResume(operator_id, logging=False)
@@ -379,9 +379,8 @@ class Project(db.Model):
             )
             db.session.add(new_pause)
             current_phase.pauses.append(new_pause)
+            current_phase.open_pause = new_pause
             self.deadline_date = None
-            # stop the delay counter
-            removeDelayCounter(self.id)
 
         # update projcet
         self.pause = True
@@ -396,6 +395,7 @@ class Project(db.Model):
             )
             db.session.add(new_log)
         db.session.commit()
+        projectUpdated(self.id)
 
     def doResume(self, operator_id, logging=True):
         """Resume this project."""
@@ -404,17 +404,31 @@ class Project(db.Model):
 
         # update phase deadline
         current_phase = self.current_phase()
+        pause = None
         if current_phase:
-            offset = datetime.utcnow() - current_phase.pauses[-1].pause_date
+            # phases paused before open_pause was kept only have the row
+            pause = current_phase.open_pause or ProjectPause.query\
+                .filter_by(phase_id=current_phase.id, resume_date=None)\
+                .order_by(ProjectPause.pause_date.desc()).first()
+        if pause:
+            pause.resume_date = datetime.utcnow()
+            offset = pause.resume_date - pause.pause_date
             deadline = current_phase.deadline_date + offset
             current_phase.deadline_date = deadline
-            current_phase.pauses[-1].resume_date = datetime.utcnow()
+            current_phase.open_pause = None
+            # time paused before the upload counts for neither the upload
+            # nor the deadline
+            if not current_phase.upload_date or current_phase.upload_date > pause.pause_date:
+                current_phase.paused_seconds = (current_phase.paused_seconds or 0) + \
+                    int(offset.total_seconds())
             self.deadline_date = deadline
-            # create a new delay counter
-            addDelayCounter(self.id, deadline)
+            # the sweeper flags it once the deadline passes
+            wakeSweeper(deadline)
 
         # update projcet
         self.pause = False
+        # an uploaded phase has its overtime moved
+        uploaded = bool(pause and current_phase.upload_date)
 
         # logging
         if logging:
@@ -426,6 +440,9 @@ class Project(db.Model):
             )
             db.session.add(new_log)
         db.session.commit()
+        projectUpdated(self.id)
+        if uploaded:
+            statsChanged([self.id])
 
     def doChangeDDL(self, operator_id, deadline):
         """change the current ddl."""
@@ -434,14 +451,16 @@ class Project(db.Model):
 
         # current phase update
         current_phase = self.current_phase()
+        # an uploaded phase has its deadline time and overtime counted
+        uploaded = bool(current_phase.upload_date)
         current_phase.deadline_date = deadline
         self.deadline_date = deadline
         if deadline < datetime.utcnow():
             self.delay = True
         else:
             self.delay = False
-            # create a new delay counter
-            addDelayCounter(self.id, deadline)
+            # the sweeper flags it once the deadline passes
+            wakeSweeper(deadline)
 
         new_log = ProjectLog(
             project=self,
@@ -451,38 +470,19 @@ class Project(db.Model):
         )
         db.session.add(new_log)
         db.session.commit()
+        projectUpdated(self.id)
+        if uploaded:
+            statsChanged([self.id])
 
     def doDelete(self):
         """Delete this project."""
-        pauses = self.pauses
-        for pause in pauses:
-            db.session.delete(pause)
-
-        files = self.files
-        for file in files:
-            db.session.delete(file)
-
-        logs = self.logs
-        for log in logs:
-            db.session.delete(log)
-
-        phases = self.phases
-        for phase in phases:
-            db.session.delete(phase)
-
-        stages = self.stages
-        for stage in stages:
-            db.session.delete(stage)
-
-        db.session.delete(self)
-        removeDelayCounter(self.id)
-        db.session.commit()
+        deleteProjects([self.id])
 
     @staticmethod
-    def delete_all_project():
-        projects = Project.query.all()
-        for project in projects:
-            project.doDelete()
+    def delete_all_project(chunk_size=500):
+        project_ids = [_id for _id, in db.session.query(Project.id).order_by(Project.id)]
+        for i in range(0, len(project_ids), chunk_size):
+            deleteProjects(project_ids[i:i+chunk_size])
         print('all project deleted.')
 
     @staticmethod
@@ -512,18 +512,10 @@ class Project(db.Model):
                 tag_list = word2List(tag)
                 all_tag_list += tag_list
 
-            for tag in all_tag_list:
-                _tag = Tag.query.filter_by(name=tag).first()
-                if not _tag:
-                    _tag = Tag(name=tag)
-                    db.session.add(_tag)
-                new_project.tags.append(_tag)
+            new_project.tags = resolveTags(all_tag_list)
 
         if files:
-            for file in files:
-                _file = File.query.get(file)
-                if _file:
-                    new_project.files.append(_file)
+            new_project.files += getByIds(File, files)[0]
 
         new_log = ProjectLog(
             project=new_project,
@@ -532,7 +524,10 @@ class Project(db.Model):
         )
         db.session.add(new_log)
 
+        db.session.flush()
+        indexProject(new_project)
         db.session.commit()
+        projectUpdated(new_project.id)
         return new_project
 
     def __repr__(self):
@@ -581,17 +576,46 @@ class Phase(db.Model):
     upload_date = db.Column(db.DateTime)
     feedback_date = db.Column(db.DateTime)
 
+    # pauses: seconds of the resumed ones that began before the upload, and
+    # the one still running, kept by doPause and doResume
+    paused_seconds = db.Column(db.Integer, default=0)
+    open_pause_id = db.Column(db.Integer, db.ForeignKey(
+        'project_pauses.id', use_alter=True, name='fk_phases_open_pause_id'))
+    open_pause = db.relationship('ProjectPause', foreign_keys=open_pause_id, post_update=True)
+
     # many-many: File.phases-Phase.files
     upload_files = db.relationship('File', secondary=PHASE_UPLOAD_FILE,
-                                   lazy='subquery', backref=db.backref('phases_as_upload', lazy=True))
+                                   lazy=True, backref=db.backref('phases_as_upload', lazy=True))
 
     # many-many: File.phases-Phase.files
     files = db.relationship('File', secondary=PHASE_FILE,
-                            lazy='subquery', backref=db.backref('phases', lazy=True))
+                            lazy=True, backref=db.backref('phases', lazy=True))
 
     def __repr__(self):
         return '<Phase id %s>' % self.id
 
+    @staticmethod
+    def fill_pauses():
+        """Set paused_seconds and open_pause of every phase from its pauses."""
+        paused = {}
+        open_pause = {}
+        for phase_id, upload_date, pause_id, pause_date, resume_date in db.session.query(
+                Phase.id, Phase.upload_date, ProjectPause.id, ProjectPause.pause_date, ProjectPause.resume_date)\
+                .join(ProjectPause, ProjectPause.phase_id == Phase.id)\
+                .order_by(ProjectPause.pause_date):
+            paused.setdefault(phase_id, 0)
+            if not resume_date:
+                open_pause[phase_id] = pause_id
+            elif not upload_date or upload_date > pause_date:
+                paused[phase_id] += int((resume_date - pause_date).total_seconds())
+        Phase.query.update({Phase.paused_seconds: 0, Phase.open_pause_id: None},
+                           synchronize_session=False)
+        db.session.bulk_update_mappings(Phase, [
+            {'id': phase_id, 'paused_seconds': seconds, 'open_pause_id': open_pause.get(phase_id)}
+            for phase_id, seconds in paused.items()
+        ])
+        db.session.commit()
+
 
 class ProjectPause(db.Model):
     """Pause Model"""
@@ -663,57 +687,291 @@ class ProjectNotice(db.Model):
         self.read = True
         self.read_date = datetime.utcnow()
         db.session.commit()
+        userUpdated(self.to_user_id)
         return self
 
     def __repr__(self):
         return '<ProjectNotice id %s>' % self.id
 
 
-def delay(project_id):
-    project = Project.query.get(project_id)
-    if project.status == 'modify' or project.status == 'progress':
-        project.delay = True
+class WxOutbox(db.Model):
+    """WeChat message waiting to be sent, see restful.wechat.sendWxOutbox"""
+    __tablename__ = 'wx_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    create_date = db.Column(db.DateTime, default=datetime.utcnow)
+
+    to_user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    to_user = db.relationship('User', foreign_keys=to_user_id)
+
+    log_id = db.Column(db.Integer, db.ForeignKey('project_logs.id'))
+    log = db.relationship('ProjectLog', foreign_keys=log_id)
+
+    # request body of the template message, without the access token
+    payload = db.Column(db.Text)
+    status = db.Column(db.Enum('pending', 'sent', 'failed'), default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_try_date = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_date = db.Column(db.DateTime)
+    error = db.Column(db.String(256))
+
+    __table_args__ = (
+        db.Index('ix_wx_outbox_due', 'status', 'next_try_date'),
+    )
+
+    def __repr__(self):
+        return '<WxOutbox id %s %s>' % (self.id, self.status)
+
+
+def deleteProjects(project_ids):
+    """Delete projects with everything hanging off them, one DELETE per table.
+
+    Children go first so no foreign key is left dangling: notices and
+    outbox messages, the phase file links, pauses, logs, phases, stages, the project tag and file links,
+    the search terms and at last the projects. Files themselves are only
+    unlinked, other projects and phases may use them too. Commits once.
+    """
+    if not project_ids:
+        return
+    phase_ids = db.session.query(Phase.id).filter(Phase.project_id.in_(project_ids))
+    log_ids = db.session.query(ProjectLog.id).filter(ProjectLog.project_id.in_(project_ids))
+    # their unread counts change
+    user_ids = [_id for _id, in db.session.query(ProjectNotice.to_user_id)
+                .filter(ProjectNotice.log_id.in_(log_ids)).distinct()]
+    stats_keys = statsKeys(project_ids)
+
+    for model in (ProjectNotice, WxOutbox):
+        model.query.filter(model.log_id.in_(log_ids))\
+            .delete(synchronize_session=False)
+    for table in (PHASE_FILE, PHASE_UPLOAD_FILE):
+        db.session.execute(table.delete().where(table.c.phase_id.in_(phase_ids)))
+    # pauses are hung on the phase, project_id is usually empty, and the
+    # phase points back at its open one
+    Phase.query.filter(Phase.project_id.in_(project_ids))\
+        .update({Phase.open_pause_id: None}, synchronize_session=False)
+    ProjectPause.query.filter(or_(ProjectPause.project_id.in_(project_ids),
+                                  ProjectPause.phase_id.in_(phase_ids)))\
+        .delete(synchronize_session=False)
+    for model in (ProjectLog, Phase, Stage):
+        model.query.filter(model.project_id.in_(project_ids))\
+            .delete(synchronize_session=False)
+    for table in (PROJECT_TAG, PROJECT_FILE):
+        db.session.execute(table.delete().where(table.c.project_id.in_(project_ids)))
+    removeDocuments('project', project_ids)
+    Project.query.filter(Project.id.in_(project_ids))\
+        .delete(synchronize_session=False)
     db.session.commit()
-    print('%d project delay!' % project_id)
+
+    projectsUpdated(project_ids)
+    for user_id in user_ids:
+        userUpdated(user_id)
+    statsChanged([], stats_keys)
+
+
+def getFiles(file_ids):
+    """Files of these ids in their order, raise if any of them is missing."""
+    files, missing = getByIds(File, file_ids)
+    if missing:
+        raise Exception('File %s is not exist.' % ', '.join(map(str, missing)))
+    return files
 
 
-def addDelayCounter(project_id, deadline):
+def delay(project_id):
+    """Job of the per-project delay counters, kept for the ones still stored."""
+    sweepDeadlines()
+
+
+def sweepDeadlines():
+    """Flag every project past its deadline as delayed, with one UPDATE.
+
+    Runs every DEADLINE_SWEEP_INTERVAL seconds. wakeSweeper adds a run at the
+    next deadline when it falls before that, so flags are set on time.
+    """
+    now = datetime.utcnow()
+    running = and_(Project.delay == False, Project.status.in_(['modify', 'progress']))
+    overdue = and_(running, Project.deadline_date <= now)
+    project_ids = [_id for _id, in db.session.query(Project.id).filter(overdue)]
+    if project_ids:
+        Project.query.filter(Project.id.in_(project_ids), overdue)\
+            .update({'delay': True}, synchronize_session=False)
+        db.session.commit()
+        for project_id in project_ids:
+            projectUpdated(project_id)
+            print('%d project delay!' % project_id)
+
+    # the earliest deadline still ahead, straight from the deadline_date index
+    next_deadline = db.session.query(func.min(Project.deadline_date))\
+        .filter(running, Project.deadline_date > now).scalar()
+    db.session.remove()
+    if next_deadline:
+        wakeSweeper(next_deadline)
+    return project_ids
+
+
+def wakeSweeper(deadline):
+    """Have the sweeper run at deadline if its next run is later than that."""
+    run_date = utc.localize(deadline)
+    for job_id in ('sweep_deadlines', 'sweep_deadlines_next'):
+        job = scheduler.get_job(job_id)
+        if job and job.next_run_time and job.next_run_time <= run_date:
+            return
     scheduler.add_job(
-        id='delay_project_' + str(project_id),
-        func=delay,
-        args=[project_id],
+        id='sweep_deadlines_next',
+        func=sweepDeadlines,
         trigger='date',
-        run_date=deadline,
+        run_date=run_date,
         replace_existing=True,
         misfire_grace_time=2592000
     )
-    print('%d project addCounter: %s' % (project_id, deadline))
 
 
-def removeDelayCounter(project_id):
-    if scheduler.get_job('delay_project_'+str(project_id)):
-        scheduler.remove_job('delay_project_'+str(project_id))
-        print('%d project removeCounter' % project_id)
+def startSweeper():
+    scheduler.add_job(
+        id='sweep_deadlines',
+        func=sweepDeadlines,
+        trigger='interval',
+        seconds=app.config.get('DEADLINE_SWEEP_INTERVAL', 60),
+        replace_existing=True,
+        coalesce=True,
+        misfire_grace_time=2592000
+    )
+
 
+def reconcileDeadlines():
+    """Bring delay flags and jobs in line after downtime or an upgrade.
+
+    Drops the per-project delay jobs of the old scheduler, flags what went
+    overdue meanwhile and restarts the sweeper. Returns the number of jobs
+    dropped and the ids of the projects flagged.
+    """
+    removed = 0
+    for job in scheduler.get_jobs():
+        if job.id.startswith('delay_project_'):
+            job.remove()
+            removed += 1
+    startSweeper()
+    return removed, sweepDeadlines()
+
+
+def statsKeys(project_ids):
+    """(user_id, day) keys the phases and finish of these projects count in."""
+    if not project_ids:
+        return set()
+    user_ids = set(db.session.query(Phase.project_id, Phase.creator_user_id)
+                   .filter(Phase.project_id.in_(project_ids), Phase.creator_user_id != None))
+    dates = set(db.session.query(Phase.project_id, Phase.upload_date)
+                .filter(Phase.project_id.in_(project_ids), Phase.upload_date != None))
+    dates |= set(db.session.query(Project.id, Project.finish_date)
+                 .filter(Project.id.in_(project_ids), Project.finish_date != None))
+    # a stage counts for all of its creators, on the day of its last upload
+    return set((user_id, date.date()) for project_id, user_id in user_ids
+               for _project_id, date in dates if _project_id == project_id)
+
+
+def statsChanged(project_ids, keys=()):
+    """Call once phases or the finish of these projects changed.
+
+    keys are (user_id, day) the projects counted in before the change.
+    """
+    from .stats import refreshStats
+    refreshStats(set(keys) | statsKeys(project_ids))
+
+
+def projectUpdated(project_id):
+    """Call once a change of this project is committed."""
+    # every cached project listing is keyed by this version
+    bumpVersion('projects')
+    # write through: render the document of the new version right away, so
+    # readers don't have to
+    from ..restful.projects import storeProjectDoc
+    version = bumpVersion('project:%s' % project_id)
+    if version is not None:
+        storeProjectDoc(project_id, version)
+
+
+def projectsUpdated(project_ids):
+    """Call once a change shown on these projects is committed elsewhere.
+
+    Unlike projectUpdated the documents are not rendered again here, there
+    may be many of them, the next read does it.
+    """
+    bumpVersion('projects')
+    for project_id in project_ids:
+        bumpVersion('project:%s' % project_id)
+
+
+def userProjects(user_id):
+    """Ids of the projects showing this user, as creator, client or operator."""
+    return {_id for _id, in Project.query.with_entities(Project.id).filter(or_(
+        Project.creator_user_id == user_id, Project.client_user_id == user_id)).union(
+        db.session.query(Phase.project_id).filter(or_(
+            Phase.creator_user_id == user_id, Phase.client_user_id == user_id)),
+        db.session.query(ProjectLog.project_id).filter(ProjectLog.operator_user_id == user_id))}
+
+
+def fileProjects(file_id):
+    """Ids of the projects showing this file, on the project or on a phase."""
+    phase_ids = db.session.query(PHASE_FILE.c.phase_id).filter(PHASE_FILE.c.file_id == file_id).union(
+        db.session.query(PHASE_UPLOAD_FILE.c.phase_id).filter(PHASE_UPLOAD_FILE.c.upload_file_id == file_id))
+    return {_id for _id, in db.session.query(PROJECT_FILE.c.project_id)
+            .filter(PROJECT_FILE.c.file_id == file_id).union(
+                db.session.query(Phase.project_id).filter(Phase.id.in_(phase_ids)))}
+
+
+def sendNotices(log, recipients):
+    """Notify the users matching recipients, a filter on User, of log.
+
+    The users and their WeChat bindings come in one query, the notices and
+    the outbox messages go in with one bulk insert each. Nothing is sent and
+    nothing is committed: the rows are part of the caller's transaction,
+    which then calls notifyUsers. The log has to be flushed already.
+    Returns the ids of the users notified.
+    """
+    to_users = User.query.options(joinedload(User.wx_user)).filter(recipients).all()
+    now = datetime.utcnow()
+    db.session.bulk_insert_mappings(ProjectNotice, [
+        {'log_id': log.id, 'to_user_id': to_user.id, 'read': False, 'sned_date': now}
+        for to_user in to_users
+    ])
+
+    messages = []
+    for to_user in to_users:
+        data = wxTemplate(log, to_user)
+        if data:
+            messages.append({
+                'log_id': log.id,
+                'to_user_id': to_user.id,
+                'payload': json.dumps(data, ensure_ascii=False),
+                'status': 'pending',
+                'attempts': 0,
+                'create_date': now,
+                'next_try_date': now,
+            })
+    db.session.bulk_insert_mappings(WxOutbox, messages)
+    return [to_user.id for to_user in to_users]
+
+
+def notifyUsers(user_ids):
+    """Call once the notices of sendNotices are committed."""
+    for user_id in user_ids:
+        userUpdated(user_id)
+    dispatchWxOutbox()
+
+
+def dispatchWxOutbox():
+    """Have a worker send what is due in the outbox."""
+    from ..restful.wechat import sendWxOutbox
+    try:
+        sendWxOutbox.apply_async(retry=False)
+    except Exception as e:
+        # the rows wait for the next dispatch
+        print(e)
 
-def send_message(log, to_user):
-    new_notice = ProjectNotice(
-        log=log,
-        to_user=to_user
-    )
-    db.session.add(new_notice)
-    db.session.commit()
 
-    option = Option.query.filter_by(name='wechat_access_token').first()
-    if not option:
-        return False
+def wxTemplate(log, to_user):
+    """Template message about log for to_user, None if there is nothing to send."""
     if not to_user.wx_user:
-        return False
+        return None
 
-    url = "https://api.weixin.qq.com/cgi-bin/message/template/send"
-    params = {
-        "access_token": option.value,
-    }
     if log.log_type == 'upload':
         data = {
             "touser": to_user.wx_user.openid,
@@ -783,11 +1041,6 @@ def send_message(log, to_user):
                 }
             }
         }
-    try:
-        res = requests.post(url, params=params, data=json.dumps(
-            data, ensure_ascii=False).encode('utf-8'))
-        data = res.json()
-        print('Send wx message to {}.'.format(to_user.name))
-
-    except Exception as e:
-        print(e)
+    else:
+        return None
+    return data
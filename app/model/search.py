@@ -0,0 +1,129 @@
+"""
+SearchTerm
+"""
+
+from sqlalchemy import or_, and_, case, func, false
+from .. import db
+import re
+
+CJK = '\u3400-\u9fff\uf900-\ufaff'
+HTML_TAG = re.compile(r'<[^>]+>', re.S)
+
+
+class SearchTerm(db.Model):
+    """Inverted index row: one term of one project or file."""
+    __tablename__ = 'search_terms'
+    id = db.Column(db.Integer, primary_key=True)
+    doc_type = db.Column(db.Enum('project', 'file'))
+    doc_id = db.Column(db.Integer)
+    term = db.Column(db.String(64))
+    weight = db.Column(db.Integer, default=1)
+
+    __table_args__ = (
+        db.Index('ix_search_terms_lookup', 'doc_type', 'term'),
+        db.Index('ix_search_terms_doc', 'doc_type', 'doc_id'),
+    )
+
+    def __repr__(self):
+        return '<SearchTerm %s %s %r>' % (self.doc_type, self.doc_id, self.term)
+
+
+def _runs(text):
+    """Yield (run, is_chinese) for every word of text, split by script."""
+    for word in re.findall(r'\w+', HTML_TAG.sub(' ', text or '').lower()):
+        for run in re.findall(r'[%s]+|[^%s]+' % (CJK, CJK), word):
+            yield run, re.match(r'[%s]' % CJK, run) is not None
+
+
+def tokenize(text):
+    """Split text into index terms.
+
+    Latin words are kept whole, Chinese runs are cut into overlapping
+    bigrams (a lone character is kept as it is).
+    """
+    terms = []
+    for run, chinese in _runs(text):
+        if chinese and len(run) > 1:
+            terms += [run[i:i+2] for i in range(len(run)-1)]
+        else:
+            terms.append(run[:64])
+    return terms
+
+
+def indexDocument(doc_type, doc_id, fields):
+    """Replace the terms of a document. fields is a list of (text, weight).
+
+    Runs in the caller's session, the caller commits.
+    """
+    removeDocument(doc_type, doc_id)
+    weights = {}
+    for text, weight in fields:
+        for term in tokenize(text):
+            weights[term] = weights.get(term, 0) + weight
+    db.session.bulk_insert_mappings(SearchTerm, [
+        {'doc_type': doc_type, 'doc_id': doc_id, 'term': term, 'weight': weight}
+        for term, weight in weights.items()
+    ])
+
+
+def removeDocument(doc_type, doc_id):
+    removeDocuments(doc_type, [doc_id])
+
+
+def removeDocuments(doc_type, doc_ids):
+    SearchTerm.query.filter(SearchTerm.doc_type == doc_type, SearchTerm.doc_id.in_(doc_ids))\
+        .delete(synchronize_session=False)
+
+
+def indexProject(project):
+    indexDocument('project', project.id, [
+        (project.title, 3),
+        (' '.join(tag.name for tag in project.tags), 2),
+        (project.design, 1),
+    ])
+
+
+def indexFile(file):
+    indexDocument('file', file.id, [
+        (file.name, 3),
+        (' '.join(tag.name for tag in file.tags), 2),
+        (file.description, 1),
+    ])
+
+
+def _termMatches(text):
+    """One SQL condition per query token, all of them have to match."""
+    matches = []
+    for run, chinese in _runs(text):
+        if chinese and len(run) > 1:
+            matches += [SearchTerm.term == run[i:i+2] for i in range(len(run)-1)]
+        elif chinese:
+            matches.append(or_(SearchTerm.term.startswith(run, autoescape=True),
+                               SearchTerm.term.endswith(run, autoescape=True)))
+        else:
+            # prefix match, still served by the (doc_type, term) index
+            matches.append(SearchTerm.term.startswith(run[:64], autoescape=True))
+    return matches
+
+
+def matchQuery(doc_type, text):
+    """Query of the ids of every document matching all tokens of text."""
+    matches = _termMatches(text)
+    query = db.session.query(SearchTerm.doc_id)\
+        .filter(SearchTerm.doc_type == doc_type)
+    if not matches:
+        return query.filter(false()).group_by(SearchTerm.doc_id)
+
+    return query.filter(or_(*matches))\
+        .group_by(SearchTerm.doc_id)\
+        .having(and_(*[func.max(case([(match, 1)], else_=0)) == 1 for match in matches]))
+
+
+def searchDocuments(doc_type, text, limit=None):
+    """Ids of the documents matching text, best match first."""
+    score = func.sum(SearchTerm.weight)
+    query = matchQuery(doc_type, text).add_columns(score)\
+        .order_by(score.desc(), SearchTerm.doc_id.desc())
+    if limit:
+        query = query.limit(limit)
+    return [doc_id for doc_id, _ in query.all()]
@@ -0,0 +1,298 @@
+"""
+UserDayStats
+
+One row per user and day with the numbers the dashboard sums up, so any date
+range costs a sum over its days. A row is never patched: refreshStats
+recomputes the rows of the (user, day) keys a change touched from the
+projects and files themselves, `flask rollup` does it for the whole history.
+
+Sums of a user over whole days are cached, see cachedSumStats.
+
+What a row counts, all by UTC day:
+- phases the user uploaded that day, their feedback, overtime and durations
+- stages the user has a phase in, last uploaded that day, by outcome
+- public files the user uploaded that day, by number of tags
+- '样图' projects finished that day that the user has a phase in
+"""
+from datetime import datetime, timedelta, date
+from sqlalchemy import or_, and_, case, func, exists
+from sqlalchemy.orm import aliased
+from numpy import zeros, array
+import json
+from .. import app, db
+from ..cache import LocalCache, cacheGet, cacheSet, getVersions, bumpVersion
+from .project import Project, Stage, Phase
+from .file import File, FILE_TAG
+from .post import Tag
+from .user import User
+
+# reference files are scored by number of tags, these are the lower bounds
+# of the bands getAttr tells apart
+REF_TAG_BANDS = [0, 4, 6, 7, 8, 10]
+# sums kept in this process while Redis is down, only trusted for
+# STATS_LOCAL_CACHE_TTL seconds since nothing tells them apart from stale
+LOCAL_SUMS = LocalCache(size=1024)
+STAGE_COUNTS = ['stages_%s_pass_%s' % (status, kind)
+                for kind in ('c', 'd') for status in ('one', 'mod', 'no')]
+COUNTS = [
+    'phases_all', 'phases_pass', 'phases_modify', 'phases_pending', 'phases_overtime',
+    'overtime_sum', 'upload_seconds', 'deadline_seconds', 'pause_seconds',
+    'phases_pass_c', 'phases_pass_d', 'files_ref', 'project_sample',
+] + STAGE_COUNTS + ['files_ref_tags_%d' % band for band in REF_TAG_BANDS]
+
+
+class UserDayStats(db.Model):
+    __tablename__ = 'user_day_stats'
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    day = db.Column(db.Date)
+
+    phases_all = db.Column(db.Integer, default=0)
+    phases_pass = db.Column(db.Integer, default=0)
+    phases_modify = db.Column(db.Integer, default=0)
+    phases_pending = db.Column(db.Integer, default=0)
+    phases_overtime = db.Column(db.Integer, default=0)
+    overtime_sum = db.Column(db.BigInteger, default=0)
+    upload_seconds = db.Column(db.BigInteger, default=0)
+    deadline_seconds = db.Column(db.BigInteger, default=0)
+    pause_seconds = db.Column(db.BigInteger, default=0)
+
+    # stages by outcome, c for 成图 and d for 草图, and the phases of the passed ones
+    stages_one_pass_c = db.Column(db.Integer, default=0)
+    stages_mod_pass_c = db.Column(db.Integer, default=0)
+    stages_no_pass_c = db.Column(db.Integer, default=0)
+    stages_one_pass_d = db.Column(db.Integer, default=0)
+    stages_mod_pass_d = db.Column(db.Integer, default=0)
+    stages_no_pass_d = db.Column(db.Integer, default=0)
+    phases_pass_c = db.Column(db.Integer, default=0)
+    phases_pass_d = db.Column(db.Integer, default=0)
+
+    files_ref = db.Column(db.Integer, default=0)
+    files_ref_tags_0 = db.Column(db.Integer, default=0)
+    files_ref_tags_4 = db.Column(db.Integer, default=0)
+    files_ref_tags_6 = db.Column(db.Integer, default=0)
+    files_ref_tags_7 = db.Column(db.Integer, default=0)
+    files_ref_tags_8 = db.Column(db.Integer, default=0)
+    files_ref_tags_10 = db.Column(db.Integer, default=0)
+    project_sample = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'day', name='uq_user_day_stats'),
+    )
+
+    def __repr__(self):
+        return '<UserDayStats %s %s>' % (self.user_id, self.day)
+
+
+def _day(value):
+    # DATE() comes back as a date from MySQL and as text from SQLite
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return datetime.strptime(str(value)[:10], '%Y-%m-%d').date()
+
+
+def _during(column, days):
+    return or_(*[and_(column >= datetime.combine(day, datetime.min.time()),
+                      column < datetime.combine(day + timedelta(days=1), datetime.min.time()))
+                 for day in days])
+
+
+def _band(tags):
+    return [band for band in REF_TAG_BANDS if tags >= band][-1]
+
+
+def computeStats(user_ids, days):
+    """Counts of these users on these days, {(user_id, day): {count: value}}."""
+    rows = {}
+
+    def row(user_id, day):
+        key = (user_id, _day(day))
+        if key not in rows:
+            rows[key] = dict.fromkeys(COUNTS, 0)
+        return rows[key]
+
+    later = aliased(Phase)
+    is_last = ~exists().where(and_(
+        later.stage_id == Phase.stage_id, later.start_date > Phase.start_date))
+    phases = db.session.query(
+        Phase.creator_user_id, Phase.start_date, Phase.deadline_date,
+        Phase.upload_date, Phase.feedback_date, Phase.paused_seconds, is_last)\
+        .filter(Phase.creator_user_id.in_(user_ids), _during(Phase.upload_date, days))
+    for user_id, start_date, deadline_date, upload_date, feedback_date, paused_seconds, _is_last in phases:
+        data = row(user_id, upload_date)
+        data['phases_all'] += 1
+        if not feedback_date:
+            data['phases_pending'] += 1
+        elif _is_last:
+            data['phases_pass'] += 1
+        else:
+            data['phases_modify'] += 1
+        overtime = int((upload_date - deadline_date).total_seconds())
+        if overtime > 0:
+            data['phases_overtime'] += 1
+            data['overtime_sum'] += overtime
+        data['upload_seconds'] += int((upload_date - start_date).total_seconds())
+        data['deadline_seconds'] += int((deadline_date - start_date).total_seconds())
+        data['pause_seconds'] += paused_seconds or 0
+
+    # a stage counts for every user with a phase in it, on the day of its
+    # last upload; its outcome is read from its last phase
+    stats = db.session.query(
+        Phase.stage_id.label('stage_id'),
+        func.count(Phase.id).label('phases'),
+        func.max(Phase.upload_date).label('last_upload'),
+        func.max(Phase.start_date).label('last_start'))\
+        .filter(Phase.stage_id.in_(
+            db.session.query(Phase.stage_id).filter(_during(Phase.upload_date, days))))\
+        .group_by(Phase.stage_id).subquery()
+    member = aliased(Phase)
+    last = aliased(Phase)
+    stages = db.session.query(
+        stats.c.stage_id, stats.c.phases, stats.c.last_upload,
+        member.creator_user_id.label('user_id'),
+        func.min(case([(last.feedback_date == None, 0)], else_=1)).label('passed'))\
+        .join(member, member.stage_id == stats.c.stage_id)\
+        .join(last, and_(last.stage_id == stats.c.stage_id, last.start_date == stats.c.last_start))\
+        .group_by(stats.c.stage_id, stats.c.phases, stats.c.last_upload, member.creator_user_id)\
+        .subquery()
+    kind = case([(Stage.name == '草图', 'd')], else_='c')
+    status = case([(stages.c.passed == 0, 'no'), (stages.c.phases > 1, 'mod')], else_='one')
+    day = func.date(stages.c.last_upload)
+    for user_id, last_day, _kind, _status, count, phases in db.session.query(
+            stages.c.user_id, day, kind, status, func.count(), func.sum(stages.c.phases))\
+            .join(Stage, Stage.id == stages.c.stage_id)\
+            .filter(stages.c.user_id.in_(user_ids), _during(stages.c.last_upload, days))\
+            .group_by(stages.c.user_id, day, kind, status):
+        data = row(user_id, last_day)
+        data['stages_%s_pass_%s' % (_status, _kind)] += count
+        if _status != 'no':
+            data['phases_pass_' + _kind] += int(phases)
+
+    for user_id, upload_date, tags in db.session.query(
+            File.uploader_user_id, File.upload_date, func.count(FILE_TAG.c.tag_id))\
+            .outerjoin(FILE_TAG, FILE_TAG.c.file_id == File.id)\
+            .filter(File.public == True)\
+            .filter(File.uploader_user_id.in_(user_ids), _during(File.upload_date, days))\
+            .group_by(File.id, File.uploader_user_id, File.upload_date):
+        data = row(user_id, upload_date)
+        data['files_ref'] += 1
+        data['files_ref_tags_%d' % _band(tags)] += 1
+
+    for user_id, finish_date in db.session.query(Phase.creator_user_id, Project.finish_date)\
+            .join(Phase, Phase.project_id == Project.id)\
+            .filter(Project.tags.any(Tag.name == '样图'))\
+            .filter(Phase.creator_user_id.in_(user_ids), _during(Project.finish_date, days))\
+            .group_by(Project.id, Phase.creator_user_id, Project.finish_date):
+        row(user_id, finish_date)['project_sample'] += 1
+
+    return rows
+
+
+def refreshStats(keys):
+    """Recompute the rows of these (user_id, day) keys and commit."""
+    keys = set((user_id, _day(day)) for user_id, day in keys if user_id and day)
+    if not keys:
+        return
+    user_ids = set(user_id for user_id, _ in keys)
+    days = set(day for _, day in keys)
+    rows = computeStats(user_ids, days)
+    UserDayStats.query\
+        .filter(UserDayStats.user_id.in_(user_ids), UserDayStats.day.in_(days))\
+        .delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(UserDayStats, [
+        dict(data, user_id=user_id, day=row_day) for (user_id, row_day), data in rows.items()
+    ])
+    db.session.commit()
+    bumpVersion('stats')
+    for user_id in user_ids:
+        bumpVersion('stats:%s' % user_id)
+
+
+def rollupStats(days=31):
+    """Rebuild every row, days at a time. Returns the number of rows."""
+    first = min(filter(None, [
+        db.session.query(func.min(Phase.upload_date)).scalar(),
+        db.session.query(func.min(File.upload_date)).scalar(),
+        db.session.query(func.min(Project.finish_date)).scalar(),
+    ]), default=None)
+    UserDayStats.query.delete(synchronize_session=False)
+    db.session.commit()
+    if not first:
+        bumpVersion('stats')
+        return 0
+    user_ids = [user_id for user_id, in db.session.query(User.id)]
+    total = 0
+    day = first.date()
+    while day <= datetime.utcnow().date():
+        window = [day + timedelta(days=i) for i in range(days)]
+        rows = computeStats(user_ids, window)
+        db.session.bulk_insert_mappings(UserDayStats, [
+            dict(data, user_id=user_id, day=row_day) for (user_id, row_day), data in rows.items()
+        ])
+        db.session.commit()
+        total += len(rows)
+        day += timedelta(days=days)
+    bumpVersion('stats')
+    return total
+
+
+def sumStats(user_id, start=None, end=None):
+    """Counts of a user summed over the days from start to end, both included."""
+    query = db.session.query(*[func.sum(getattr(UserDayStats, count)) for count in COUNTS])\
+        .filter(UserDayStats.user_id == user_id)
+    if start:
+        query = query.filter(UserDayStats.day >= start)
+    if end:
+        query = query.filter(UserDayStats.day <= end)
+    return {count: int(value or 0) for count, value in zip(COUNTS, query.one())}
+
+
+def cachedSumStats(user_id, start, end):
+    """sumStats from the day start to the day end, both dates.
+
+    Cached until the stats of the user are refreshed or rebuilt.
+    """
+    key = 'stats:sum:%s:%s:%s' % (user_id, start, end)
+    versions = getVersions(['stats', 'stats:%s' % user_id])
+    if versions is None:
+        data = LOCAL_SUMS.get(key)
+        if data is not None:
+            return json.loads(data)
+        data = sumStats(user_id, start, end)
+        LOCAL_SUMS.set(key, json.dumps(data), ex=app.config.get('STATS_LOCAL_CACHE_TTL', 60))
+        return data
+
+    key += ':%s:%s' % tuple(versions)
+    data = cacheGet(key)
+    if data is None:
+        data = sumStats(user_id, start, end)
+        cacheSet(key, data, app.config.get('STATS_CACHE_TTL', 86400))
+    return data
+
+
+def sumStatsColumns(user_ids, start=None, end=None):
+    """sumStats of many users with one query, {count: array} in the order of user_ids.
+
+    Without start each user is counted from the day they registered.
+    """
+    columns = {count: zeros(len(user_ids), dtype='int64') for count in COUNTS}
+    query = db.session.query(
+        UserDayStats.user_id, *[func.sum(getattr(UserDayStats, count)) for count in COUNTS])\
+        .filter(UserDayStats.user_id.in_(user_ids))
+    if start:
+        query = query.filter(UserDayStats.day >= start)
+    else:
+        query = query.join(User, User.id == UserDayStats.user_id)\
+            .filter(UserDayStats.day >= func.date(User.reg_date))
+    if end:
+        query = query.filter(UserDayStats.day <= end)
+    rows = [[int(value or 0) for value in row] for row in query.group_by(UserDayStats.user_id)]
+    if rows:
+        index = {user_id: i for i, user_id in enumerate(user_ids)}
+        rows = array(rows, dtype='int64')
+        at = [index[user_id] for user_id in rows[:, 0]]
+        for i, count in enumerate(COUNTS):
+            columns[count][at] = rows[:, i + 1]
+    return columns
@@ -6,7 +6,8 @@ from datetime import datetime
 from werkzeug.security import generate_password_hash
 from .. import db, app
 import shortuuid
-from .misc import Option
+from .misc import getOption, getByIds
+from ..cache import bumpVersion
 
 PERMISSIONS = app.config['PERMISSIONS']
 ROLE_PRESSENT = app.config['ROLE_PRESSENT']
@@ -55,7 +56,7 @@ class User(db.Model):
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     # many-many: User.groups-Group.users
     groups = db.relationship('Group', secondary=USER_GROUP,
-                             lazy='subquery', backref=db.backref('users', lazy=True))
+                             lazy=True, backref=db.backref('users', lazy=True))
     # one-one: WxUser.user-User.wx_user
     wx_user = db.relationship('WxUser', backref='user', uselist=False)
 
@@ -70,7 +71,7 @@ class User(db.Model):
                             backref=db.backref('uploader', lazy=True))
     # manay-many in same table:User.followed_users-User.follower_users
     followed_users = db.relationship('User',
-                                     secondary=USER_FOLLOW, lazy='subquery',
+                                     secondary=USER_FOLLOW, lazy=True,
                                      primaryjoin=(USER_FOLLOW.c.user_id == id),
                                      secondaryjoin=(
                                          USER_FOLLOW.c.follower_user_id == id),
@@ -90,10 +91,15 @@ class User(db.Model):
         return self.can(PERMISSIONS['ADMIN'])
 
     def delete(self):
+        user_id = self.id
         if self.wx_user:
             db.session.delete(self.wx_user)
         db.session.delete(self)
         db.session.commit()
+        userUpdated(user_id)
+        principalUpdated(user_id)
+        from .project import projectsUpdated, userProjects
+        projectsUpdated(userProjects(user_id))
 
     @staticmethod
     def create_admin():
@@ -107,8 +113,7 @@ class User(db.Model):
 
     @staticmethod
     def create_user(login=str(shortuuid.uuid()), password=str(shortuuid.uuid()), name='', role_id=3, email='', phone='', sex='unknown'):
-        option = Option.query.filter_by(name='allow_sign_in').first()
-        if option.value == '0':
+        if getOption('allow_sign_in') == '0':
             raise Exception('Registration closed')
 
         if not name:
@@ -168,6 +173,8 @@ class Role(db.Model):
             role.default = (role.name == default_role)
             db.session.add(role)
         db.session.commit()
+        # permissions in tokens and principal snapshots are checked against it
+        bumpVersion('roles')
 
     def add_permission(self, perm):
         """Adding particular permission to this role."""
@@ -199,13 +206,16 @@ class Group(db.Model):
     description = db.Column(db.String(512))
     admins = db.relationship(
         'User', secondary=GROUP_ADMIN,
-        lazy='subquery', backref=db.backref('groups_as_admin', lazy=True))
+        lazy=True, backref=db.backref('groups_as_admin', lazy=True))
     reg_date = db.Column(db.DateTime, default=datetime.utcnow)
 
     def delete(self):
         """Delte this project."""
+        user_ids = {user.id for user in self.users + self.admins}
         db.session.delete(self)
         db.session.commit()
+        for user_id in user_ids:
+            userUpdated(user_id)
 
     @staticmethod
     def create_group(name, description, admin_id, user_id):
@@ -217,12 +227,12 @@ class Group(db.Model):
         )
         db.session.add(new_group)
 
-        for _id in admin_id:
-            new_group.admins.append(User.query.get(_id))
-        for _id in user_id:
-            new_group.users.append(User.query.get(_id))
+        new_group.admins = getByIds(User, admin_id)[0]
+        new_group.users = getByIds(User, user_id)[0]
 
         db.session.commit()
+        for user in new_group.users + new_group.admins:
+            userUpdated(user.id)
         return new_group
 
     def __repr__(self):
@@ -247,8 +257,7 @@ class WxUser(db.Model):
 
     @staticmethod
     def create_wx_user(data):
-        option = Option.query.filter_by(name='allow_sign_in').first()
-        if option.value == '0':
+        if getOption('allow_sign_in') == '0':
             raise Exception('Registration closed')
 
         new_wx_user = WxUser(
@@ -287,6 +296,17 @@ class WxUser(db.Model):
     def __repr__(self):
         return '<WxUser %r>' % self.nickname
 
+
+def userUpdated(user_id):
+    """Call once a change shown on this user's profile or notices is committed."""
+    bumpVersion('user:%s' % user_id)
+
+
+def principalUpdated(user_id):
+    """Call once the name, role or existence of this user changed."""
+    bumpVersion('principal:%s' % user_id)
+
+
 class Message(db.Model):
     """Message Model"""
     __tablename__ = 'messages'
@@ -1,13 +1,16 @@
 from flask_restplus import Resource, reqparse, marshal,fields
+from sqlalchemy.orm import selectinload
 from .. import api, app, db
 from ..model import User, WxUser
 from ..utility import buildUrl, getAvatar
 from werkzeug.security import check_password_hash, generate_password_hash
+from .serializer import marshal_compiled
+from .decorator import etag_version, tokenUserId, issueToken
+from .users import L_USER
 import jwt
 import base64
 import requests
 import shortuuid
-from datetime import datetime, timedelta
 
 n_auth = api.namespace('api/auth', description='Authorization Operations')
 
@@ -51,6 +54,8 @@ M_USER = api.model('user', {
     ),
     'wx_user': fields.Nested(m_wx_user),
 })
+# L_USER plus the notices unread_count reads
+L_AUTH_USER = L_USER + [selectinload(User.project_notices)]
 
 M_AUTH = api.model('user_auth', {
     'user': fields.Nested(M_USER),
@@ -70,11 +75,9 @@ class AuthApi(Resource):
         user = User.query.filter_by(login=auth[0]).first()
         if user:
             if check_password_hash(user.password, auth[1]):
-                token = jwt.encode({'id': user.id, 'exp': datetime.utcnow(
-                )+timedelta(days=24)}, app.config['SECRET_KEY'])
                 output = {
                     'user': user,
-                    'token': token.decode('UTF-8')
+                    'token': issueToken(user.id)
                 }
                 return marshal(output, M_AUTH), 200
             else:
@@ -86,9 +89,14 @@ N_ME = api.namespace('api/me', description='Me')
 G_USER = reqparse.RequestParser()\
     .add_argument('token', location='cookies')
 
+def meVersion():
+    user_id = tokenUserId()
+    return 'user:%s' % user_id if user_id else None
+
 @N_ME.route('')
 class MeApi(Resource):
-    @api.marshal_with(M_USER)
+    @etag_version(meVersion)
+    @marshal_compiled(M_USER)
     @api.expect(G_USER)
     def get(self):
         args = G_USER.parse_args()
@@ -98,7 +106,7 @@ class MeApi(Resource):
             print(e)
             return api.abort(401, "Bad token.")
 
-        user = User.query.get(data['id'])
+        user = User.query.options(*L_AUTH_USER).get(data['id'])
         if user:
             print("%s is log in."%user.name)
             return user, 200
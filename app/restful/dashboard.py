@@ -6,45 +6,113 @@ from sqlalchemy import or_, case, and_
 from .. import api, app, db
 from ..model import Stage, Phase, User, File, Project, Tag, Group
 from ..utility import buildUrl, getAvatar
-from .utility import getData, projectCheck, userCheck, getAttr
+from .utility import getStats, getStatsColumns, projectCheck, userCheck, getAttr, getAttrs
 from .decorator import permission_required, admin_required
+from ..cache import cacheGet, cacheSet, getVersion
+import hashlib
+import heapq
+import json
 import time
 from datetime import datetime, timedelta
 import math
 
 N_DASH = api.namespace('api/dashboard', description='projects operations')
 
+# what DashboardApi and DashboardDataApi return
+DASH_KEYS = [
+    'overtime_sum', 'phases_overtime', 'phases_all', 'phases_pass', 'phases_modify',
+    'phases_pending', 'stages_all', 'stages_one_pass_c', 'stages_mod_pass_c',
+    'stages_no_pass_c', 'stages_one_pass_d', 'stages_mod_pass_d', 'stages_no_pass_d',
+    'files_ref', 'project_sample',
+]
+ATTR_KEYS = ['power', 'speed', 'knowledge', 'energy', 'contribution', 'score']
+
 GET_DASH = reqparse.RequestParser()\
     .add_argument('date_range', location='args', action='split')\
 
+GET_BOARD = GET_DASH.copy()\
+    .add_argument('order_by', location='args', default='score', choices=DASH_KEYS + ATTR_KEYS)\
+    .add_argument('order', location='args', default='desc', choices=['asc', 'desc'])\
+    .add_argument('limit', location='args', type=int)
+
 @N_DASH.route('/data/<int:user_id>')
 class DashboardApi(Resource):
     def get(self, user_id):
         args = GET_DASH.parse_args()
         user = userCheck(user_id)
-        data_raw = getData(user_id, args['date_range'])
-        return {
-            'overtime_sum': data_raw['overtime_sum'],
-            'phases_overtime': len(data_raw['phases_overtime']),
-            'phases_all': len(data_raw['phases_all']),
-            'phases_pass': len(data_raw['phases_pass']),
-            'phases_modify': len(data_raw['phases_modify']),
-            'phases_pending': len(data_raw['phases_pending']),
-            'stages_all': len(data_raw['stages_all']),
-            'stages_one_pass_c': len(data_raw['stages_one_pass_c']),
-            'stages_mod_pass_c': len(data_raw['stages_mod_pass_c']),
-            'stages_no_pass_c': len(data_raw['stages_no_pass_c']),
-            'stages_one_pass_d': len(data_raw['stages_one_pass_d']),
-            'stages_mod_pass_d': len(data_raw['stages_mod_pass_d']),
-            'stages_no_pass_d': len(data_raw['stages_no_pass_d']),
-            'files_ref': len(data_raw['files_ref']),
-            'project_sample': len(data_raw['project_sample']),
-        }, 200
+        data_raw = getStats(user_id, args['date_range'])
+        return {key: data_raw[key] for key in DASH_KEYS}, 200
 
 @N_DASH.route('/attr/<int:user_id>')
 class DashboardDataApi(Resource):
     def get(self, user_id):
         args = GET_DASH.parse_args()
         user = userCheck(user_id)
-        data_raw = getData(user_id, args['date_range'])
+        data_raw = getStats(user_id, args['date_range'])
         return getAttr(data_raw), 200
+
+
+def boardKey(scope, users, date_range):
+    """Cache key of a board, None when the cache can't be used.
+
+    Any refresh of the day stats bumps the version, a change of members
+    changes the digest.
+    """
+    version = getVersion('stats')
+    if version is None:
+        return None
+    if not date_range:
+        # counted from registration to today
+        date_range = ['', datetime.utcnow().strftime('%Y-%m-%d')]
+    digest = hashlib.sha1(json.dumps(
+        [sorted(user.id for user in users), date_range]).encode('utf-8')).hexdigest()
+    return 'dashboard:%s:%s:%s' % (scope, version, digest)
+
+
+def boardRows(scope, users, date_range):
+    """Metrics and attributes of every user, scored together."""
+    key = boardKey(scope, users, date_range)
+    rows = cacheGet(key) if key else None
+    if rows is None:
+        data = getStatsColumns(users, date_range)
+        columns = {key: data[key].tolist() for key in DASH_KEYS}
+        columns.update({key: value.tolist() for key, value in getAttrs(data).items()})
+        rows = [dict({key: value[i] for key, value in columns.items()}, id=user.id, name=user.name)
+                for i, user in enumerate(users)]
+        if key:
+            cacheSet(key, rows, app.config.get('DASHBOARD_CACHE_TTL', 300))
+    return rows
+
+
+def board(scope, users, args):
+    rows = boardRows(scope, users, args['date_range'])
+    # ties keep the order of user ids
+    rows.sort(key=lambda row: row['id'])
+    limit = len(rows) if args['limit'] is None else max(args['limit'], 0)
+    pick = heapq.nlargest if args['order'] == 'desc' else heapq.nsmallest
+    return {
+        'users': pick(limit, rows, key=lambda row: row[args['order_by']]),
+        'total': len(rows),
+    }
+
+
+@N_DASH.route('/groups/<int:group_id>')
+class DashboardGroupApi(Resource):
+    @permission_required()
+    @api.expect(GET_BOARD)
+    def get(self, group_id):
+        args = GET_BOARD.parse_args()
+        group = Group.query.get(group_id)
+        if not group:
+            api.abort(400, "group is not exist.")
+        return board('group:%s' % group_id, group.users, args), 200
+
+
+@N_DASH.route('/leaderboard')
+class DashboardLeaderboardApi(Resource):
+    @permission_required()
+    @api.expect(GET_BOARD)
+    def get(self):
+        args = GET_BOARD.parse_args()
+        creators = User.query.filter(User.projects_as_creator.any()).all()
+        return board('creators', creators, args), 200
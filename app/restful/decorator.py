@@ -1,10 +1,13 @@
 from flask_restplus import reqparse
 from functools import wraps
-from flask import g, request
-from .. import api, app
-from ..model import User
+from flask import g, request, after_this_request
+from .. import api, app, db
+from ..model import User, Role
+from ..cache import cacheGet, cacheSet, getVersion, getVersions
 from werkzeug.security import check_password_hash
 import jwt, base64
+import hashlib
+from datetime import datetime, timedelta
 PERMISSIONS = app.config['PERMISSIONS']
 g_user = reqparse.RequestParser()
 # g_user.add_argument('Authorization', required=True, location='headers',
@@ -12,35 +15,145 @@ g_user = reqparse.RequestParser()
 g_user.add_argument('token',location='cookies',
                     help="Basic authorization or token.")
 
+class Principal:
+    """The user a request runs as, all that permission checks need."""
+
+    def __init__(self, id, name, role_id, permissions):
+        self.id = id
+        self.name = name
+        self.role_id = role_id
+        self.permissions = permissions
+
+    def can(self, perm):
+        """Check user's role has particular permission."""
+        return self.permissions is not None and self.permissions & perm == perm
+
+    def is_admin(self):
+        return self.can(PERMISSIONS['ADMIN'])
+
+
+def principalVersions(user_id):
+    # a token or snapshot taken at other versions may be out of date
+    return getVersions(['roles', 'principal:%s' % user_id])
+
+
+def loadPrincipal(user_id):
+    """Principal fields of a user, one query, None if it is gone."""
+    row = db.session.query(User.id, User.name, User.role_id, Role.permissions)\
+        .outerjoin(Role, Role.id == User.role_id)\
+        .filter(User.id == user_id).first()
+    if row:
+        return dict(zip(('id', 'name', 'role_id', 'permissions'), row))
+
+
+def issueToken(user_id):
+    """JWT of a user, it carries the principal while that stays current."""
+    claims = {'id': user_id, 'exp': datetime.utcnow()+timedelta(days=24)}
+    # versions first: a change right after leaves the claims stale, not wrong
+    versions = principalVersions(user_id)
+    principal = loadPrincipal(user_id)
+    if versions is not None and principal:
+        claims.update(principal, ver=versions)
+    return jwt.encode(claims, app.config['SECRET_KEY']).decode('UTF-8')
+
+
+def getPrincipal(data):
+    """Principal of decoded token claims, None if the user is gone.
+
+    Current claims cost no query. Otherwise the snapshot is read from the
+    cache, keyed by the versions, and from the database on a miss.
+    """
+    versions = principalVersions(data['id'])
+    if versions is None:
+        principal = loadPrincipal(data['id'])
+        return Principal(**principal) if principal else None
+    if data.get('ver') == versions and 'permissions' in data:
+        return Principal(data['id'], data['name'], data['role_id'], data['permissions'])
+
+    key = 'principal:%s:%s:%s' % (data['id'], versions[0], versions[1])
+    principal = cacheGet(key)
+    if principal is None:
+        principal = loadPrincipal(data['id'])
+        if not principal:
+            return None
+        cacheSet(key, principal, ttl=app.config.get('PRINCIPAL_CACHE_TTL', 300))
+    return Principal(**principal)
+
+
 def permission_required(permission=None):
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
             # token = g_user.parse_args()['Authorization'].split(" ")[1]
-            args = g_user.parse_args()
-            if not args['token']:
+            token = g_user.parse_args()['token']
+            if not token:
                 return api.abort(401, "No token was given.")
 
-            try:
-                data = jwt.decode(args['token'], app.config['SECRET_KEY'])
-            except Exception as e:
-                print(e)
-                return api.abort(401, "Bad token.")
+            if g.get('principal_token') != token:
+                try:
+                    data = jwt.decode(token, app.config['SECRET_KEY'])
+                except Exception as e:
+                    print(e)
+                    return api.abort(401, "Bad token.")
 
-            user = User.query.get(data['id'])
-            if user:
-                g.current_user = User.query.get(data['id'])
+                principal = getPrincipal(data)
+                if not principal:
+                    return api.abort(401, "User is not exist")
+                g.current_user = principal
+                g.principal_token = token
                 g.token_used = True
-            else:
-                return api.abort(401, "User is not exist")
-            
+
             if permission:
                 if not g.current_user.can(permission):
                     api.abort(403, "More privileges required.")
-    
+
             return f(*args, **kwargs)
         return decorated_function
     return decorator
 
 def admin_required(f):
-    return permission_required(PERMISSIONS['ADMIN'])(f)
\ No newline at end of file
+    return permission_required(PERMISSIONS['ADMIN'])(f)
+
+
+def tokenUserId():
+    """Id in the token cookie, None if it is missing or bad."""
+    token = g_user.parse_args()['token']
+    try:
+        return jwt.decode(token, app.config['SECRET_KEY'])['id']
+    except Exception:
+        return None
+
+
+def etag_version(version_name):
+    """Strong ETag from a version counter, see cache.getVersion.
+
+    version_name(**kwargs) names the counter of the entity the view renders.
+    While the counter is unchanged, a request with a matching If-None-Match
+    gets 304 without running the view. The path, the query string and the
+    field mask are part of the tag, they change the body too.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            name = version_name(**kwargs)
+            version = getVersion(name) if name else None
+            if version is None:
+                return f(*args, **kwargs)
+
+            etag = hashlib.sha1(('%s:%s:%s:%s:%s' % (
+                name, version, request.path, request.query_string.decode('utf-8'),
+                request.headers.get(app.config.get('RESTPLUS_MASK_HEADER', 'X-Fields'), ''))
+            ).encode('utf-8')).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+            @after_this_request
+            def setETag(response):
+                if response.status_code == 200:
+                    response.set_etag(etag)
+                return response
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
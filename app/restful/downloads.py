@@ -1,16 +1,19 @@
 from flask_restplus import Resource, reqparse, fields
-from flask import g, request
+from flask import g, request, stream_with_context
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 from .. import api, db, app, celery
 from celery.result import AsyncResult
-from ..model import File, Project, User
+from ..model import File, Project, User, Phase
 from werkzeug import utils, datastructures
 from .decorator import permission_required, admin_required
-from .utility import getData, projectCheck, userCheck, getAttr
+from .utility import getStatsColumns, getAttrs, projectCheck, userCheck
 from datetime import datetime
 from psd_tools import PSDImage
 from PIL import Image
 import time
 import os
+import io
 import csv
 import shortuuid
 import zipfile
@@ -106,10 +109,13 @@ class DownloadProjectTableApi(Resource):
     @api.expect(PROJECT_TABLE)
     def get(self):
         args = PROJECT_TABLE.parse_args()
-        project_list = Project.query.filter(
-            Project.id.in_(args['project_id'])).all()
+        total = db.session.query(func.count(Project.id))\
+            .filter(Project.id.in_(args['project_id'])).scalar()
 
-        if project_list:
+        if total and total <= app.config.get('EXPORT_INLINE_ROWS', 2000):
+            return csvResponse('projects.csv', projectTableRows(
+                args['project_id'], args['keys'], args['order'], args['order_by']))
+        elif total:
             task = exportTableTask.delay(
                 args['project_id'], args['keys'], args['order'], args['order_by'])
 
@@ -150,6 +156,84 @@ def project_query_order(query, order, order_by):
     return query
 
 
+def chunks(ids):
+    size = app.config.get('EXPORT_CHUNK', 500)
+    for i in range(0, len(ids), size):
+        yield ids[i:i+size]
+
+
+def csvStream(rows):
+    """CSV text of rows a few rows at a time, as the exported files are written."""
+    buffer = io.StringIO()
+    csvWriter = csv.writer(
+        buffer, dialect='excel', quoting=csv.QUOTE_NONNUMERIC,)
+    # the BOM utf-8-sig writes, Excel needs it to read utf-8
+    yield '\ufeff'
+    for i, row in enumerate(rows):
+        csvWriter.writerow(row)
+        if i % 100 == 99:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def csvResponse(filename, rows):
+    """Stream rows as a CSV download, built while the client reads it."""
+    response = app.response_class(
+        stream_with_context(csvStream(rows)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
+
+
+def csvFile(task, rows, total):
+    """Write rows to a new file of download/temp, returns its url.
+
+    Files older than DOWNLOAD_TEMP_TTL are removed first.
+    """
+    csv_path = os.path.join(app.config['DOWNLOAD_FOLDER'], 'temp')
+    if not os.path.exists(csv_path):
+        os.makedirs(csv_path)
+    expired = time.time() - app.config.get('DOWNLOAD_TEMP_TTL', 86400)
+    for name in os.listdir(csv_path):
+        path = os.path.join(csv_path, name)
+        try:
+            if os.path.isfile(path) and os.path.getmtime(path) < expired:
+                os.remove(path)
+        except OSError as e:
+            print(e)
+    csv_file = os.path.join(csv_path, str(shortuuid.uuid())+'.csv')
+
+    with open(csv_file, 'w', newline='', encoding="utf-8-sig") as csvfile:
+        csvWriter = csv.writer(
+            csvfile, dialect='excel', quoting=csv.QUOTE_NONNUMERIC,)
+        for i, row in enumerate(rows):
+            csvWriter.writerow(row)
+            # the header is row 0
+            if i and (i % 100 == 0 or i == total):
+                task.update_state(
+                    state='PROGRESS',
+                    meta={'current': i, 'total': total}
+                )
+    return buildUrl(csv_file, dir='')
+
+
+def projectTableRows(project_id, keys, order, order_by):
+    """Header and rows of the project table, EXPORT_CHUNK projects loaded at a time."""
+    yield transfer2Header(keys)
+    ids = [_id for _id, in project_query_order(
+        db.session.query(Project.id).filter(Project.id.in_(project_id)), order, order_by)]
+    for chunk in chunks(ids):
+        projects = {project.id: project for project in Project.query.options(
+            selectinload(Project.tags),
+            selectinload(Project.stages),
+            joinedload(Project.client),
+            joinedload(Project.creator),
+        ).filter(Project.id.in_(chunk))}
+        for _id in chunk:
+            yield transfer2Content(keys, projects[_id])
+
+
 def transfer2Header(keys):
     header = []
     for key in keys:
@@ -318,9 +402,25 @@ def transfer2Header2(keys):
     return header
 
 
-def transfer2Content2(keys, user, date_range):
-    data_raw = getData(user.id, date_range)
-    attr_raw = getAttr(data_raw)
+def userTableRows(user_id, keys, date_range):
+    """Header and rows of the user table, EXPORT_CHUNK users scored at a time."""
+    yield transfer2Header2(keys)
+    ids = [_id for _id, in db.session.query(User.id)
+           .filter(User.id.in_(user_id)).order_by(User.id)]
+    for chunk in chunks(ids):
+        users = User.query.filter(User.id.in_(chunk)).order_by(User.id).all()
+        # the chunk is scored in one pass, rows then read their column
+        data = getStatsColumns(users, date_range)
+        attr = getAttrs(data)
+        data = {key: value.tolist() for key, value in data.items()}
+        attr = {key: value.tolist() for key, value in attr.items()}
+        for i, user in enumerate(users):
+            data_raw = {key: value[i] for key, value in data.items()}
+            attr_raw = {key: value[i] for key, value in attr.items()}
+            yield transfer2Content2(keys, user, data_raw, attr_raw)
+
+
+def transfer2Content2(keys, user, data_raw, attr_raw):
     content = []
     for key in keys:
         if key == 'id':
@@ -330,39 +430,39 @@ def transfer2Content2(keys, user, date_range):
         elif key == 'overtime_sum':
             content.append(round(data_raw['overtime_sum']/3600))
         elif key == 'phases_overtime':
-            content.append(len(data_raw['phases_overtime']))
+            content.append(data_raw['phases_overtime'])
         elif key == 'phases_all':
-            content.append(len(data_raw['phases_all']))
+            content.append(data_raw['phases_all'])
         elif key == 'phases_pass':
-            content.append(len(data_raw['phases_pass']))
+            content.append(data_raw['phases_pass'])
         elif key == 'phases_modify':
-            content.append(len(data_raw['phases_modify']))
+            content.append(data_raw['phases_modify'])
         elif key == 'phases_pending':
-            content.append(len(data_raw['phases_pending']))
+            content.append(data_raw['phases_pending'])
         elif key == 'stages_all':
-            content.append(len(data_raw['stages_all']))
+            content.append(data_raw['stages_all'])
         elif key == 'stages_one_pass':
-            content.append(len(data_raw['stages_one_pass_c'])+len(data_raw['stages_one_pass_d']))
+            content.append(data_raw['stages_one_pass_c']+data_raw['stages_one_pass_d'])
         elif key == 'stages_mod_pass':
-            content.append(len(data_raw['stages_mod_pass_c'])+len(data_raw['stages_mod_pass_d']))
+            content.append(data_raw['stages_mod_pass_c']+data_raw['stages_mod_pass_d'])
         elif key == 'stages_no_pass':
-            content.append(len(data_raw['stages_no_pass_c'])+len(data_raw['stages_no_pass_d']))
+            content.append(data_raw['stages_no_pass_c']+data_raw['stages_no_pass_d'])
         elif key == 'stages_one_pass_c':
-            content.append(len(data_raw['stages_one_pass_c']))
+            content.append(data_raw['stages_one_pass_c'])
         elif key == 'stages_mod_pass_c':
-            content.append(len(data_raw['stages_mod_pass_c']))
+            content.append(data_raw['stages_mod_pass_c'])
         elif key == 'stages_no_pass_c':
-            content.append(len(data_raw['stages_no_pass_c']))
+            content.append(data_raw['stages_no_pass_c'])
         elif key == 'stages_one_pass_d':
-            content.append(len(data_raw['stages_one_pass_d']))
+            content.append(data_raw['stages_one_pass_d'])
         elif key == 'stages_mod_pass_d':
-            content.append(len(data_raw['stages_mod_pass_d']))
+            content.append(data_raw['stages_mod_pass_d'])
         elif key == 'stages_no_pass_d':
-            content.append(len(data_raw['stages_no_pass_d']))
+            content.append(data_raw['stages_no_pass_d'])
         elif key == 'files_ref':
-            content.append(len(data_raw['files_ref']))
+            content.append(data_raw['files_ref'])
         elif key == 'project_sample':
-            content.append(len(data_raw['project_sample']))
+            content.append(data_raw['project_sample'])
         elif key == 'speed':
             content.append(attr_raw['speed'])
         elif key == 'power':
@@ -390,10 +490,13 @@ class DownloadUserTableApi(Resource):
     @api.expect(USER_DATA_TABLE)
     def get(self):
         args = USER_DATA_TABLE.parse_args()
-        user_list = User.query.filter(
-            User.id.in_(args['user_id'])).all()
+        total = db.session.query(func.count(User.id))\
+            .filter(User.id.in_(args['user_id'])).scalar()
 
-        if user_list:
+        if total and total <= app.config.get('EXPORT_INLINE_ROWS', 2000):
+            return csvResponse('users.csv', userTableRows(
+                args['user_id'], args['keys'], args['date_range']))
+        elif total:
             task = exportTableUserData.delay(
                 args['user_id'], args['keys'], args['date_range'])
 
@@ -430,57 +533,30 @@ class TaskApi(Resource):
 
 @celery.task(bind=True)
 def exportTableTask(self, project_id, keys, order, order_by):
-    query = Project.query.filter(Project.id.in_(project_id))
-    query = project_query_order(query, order, order_by)
-    project_list = query.all()
-
-    if project_list:
-        csv_path = os.path.join(app.config['DOWNLOAD_FOLDER'], 'temp')
-        if not os.path.exists(csv_path):
-            os.makedirs(csv_path)
-        csv_file = os.path.join(csv_path, str(shortuuid.uuid())+'.csv')
-
-        with open(csv_file, 'w', newline='', encoding="utf-8-sig") as csvfile:
-            csvWriter = csv.writer(
-                csvfile, dialect='excel', quoting=csv.QUOTE_NONNUMERIC,)
-            csvWriter.writerow(transfer2Header(keys))
-            for i, project in enumerate(project_list):
-                csvWriter.writerow(transfer2Content(keys, project))
-                self.update_state(
-                    state='PROGRESS',
-                    meta={'current': i+1, 'total': len(project_list)}
-                )
+    total = db.session.query(func.count(Project.id))\
+        .filter(Project.id.in_(project_id)).scalar()
 
-    return {'current': 100, 'total': 100, 'result': buildUrl(csv_file, dir='')}
+    if total:
+        result = csvFile(self, projectTableRows(project_id, keys, order, order_by), total)
+        return {'current': 100, 'total': 100, 'result': result}
 
 
 @celery.task(bind=True)
 def exportTableUserData(self, user_id, keys, date_range):
-    user_list = User.query.filter(User.id.in_(user_id)).all()
-
-    if user_list:
-        csv_path = os.path.join(app.config['DOWNLOAD_FOLDER'], 'temp')
-        if not os.path.exists(csv_path):
-            os.makedirs(csv_path)
-        csv_file = os.path.join(csv_path, str(shortuuid.uuid())+'.csv')
-
-        with open(csv_file, 'w', newline='', encoding="utf-8-sig") as csvfile:
-            csvWriter = csv.writer(
-                csvfile, dialect='excel', quoting=csv.QUOTE_NONNUMERIC,)
-            csvWriter.writerow(transfer2Header2(keys))
-            for i, user in enumerate(user_list):
-                csvWriter.writerow(transfer2Content2(keys, user, date_range))
-                self.update_state(
-                    state='PROGRESS',
-                    meta={'current': i+1, 'total': len(user_list)}
-                )
+    total = db.session.query(func.count(User.id))\
+        .filter(User.id.in_(user_id)).scalar()
 
-    return {'current': 100, 'total': 100, 'result': buildUrl(csv_file, dir='')}
+    if total:
+        result = csvFile(self, userTableRows(user_id, keys, date_range), total)
+        return {'current': 100, 'total': 100, 'result': result}
 
 
 @celery.task(bind=True)
 def downloadZipTask(self, project_id, mode):
-    project_list = Project.query.filter(Project.id.in_(project_id)).all()
+    project_list = Project.query.options(
+        selectinload(Project.stages),
+        selectinload(Project.phases).selectinload(Phase.upload_files),
+    ).filter(Project.id.in_(project_id)).all()
 
     zip_path = os.path.join(app.config['DOWNLOAD_FOLDER'], 'temp')
     if not os.path.exists(zip_path):
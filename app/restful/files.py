@@ -2,6 +2,10 @@ from flask_restplus import Resource, reqparse, fields
 from flask import g, request
 from .. import api, db, app
 from ..model import File, Stage, Preview, Tag, User, Group
+from ..model.file import fileStatsChanged
+from ..model.project import projectsUpdated, fileProjects
+from ..model.post import resolveTags
+from ..model.search import matchQuery, indexFile
 
 from werkzeug import utils, datastructures
 from .decorator import permission_required, admin_required
@@ -12,6 +16,7 @@ from ..utility import buildUrl, getAvatar
 from psd_tools import PSDImage
 from PIL import Image
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, selectinload
 
 PERMISSIONS = app.config['PERMISSIONS']
 
@@ -41,6 +46,12 @@ m_file = api.model('file', {
     'tags': fields.List(fields.Nested(M_TAG)),
     'upload_date': fields.String(description="Registration date for the user.")
 })
+L_FILE = [
+    joinedload(File.uploader).joinedload(User.wx_user),
+    joinedload(File.uploader).joinedload(User.avatar),
+    selectinload(File.previews),
+    selectinload(File.tags),
+]
 
 g_file = reqparse.RequestParser()\
     .add_argument('user_id', location='args', action='split')\
@@ -71,7 +82,7 @@ class UploadApi(Resource):
     @permission_required()
     def get(self):
         args = g_file.parse_args()
-        query = File.query
+        query = File.query.options(*L_FILE)
 
         if args['public'] != None:
             query = query.filter_by(public=args['public'])
@@ -87,10 +98,8 @@ class UploadApi(Resource):
             query = query.filter_by(format=args['format'])
 
         if args['search']:
-            query = query.join(File.tags).filter(
-                or_(File.name.in_(args['search']),
-                    Tag.name.in_(args['search']))
-            )
+            query = query.filter(
+                or_(*[File.id.in_(matchQuery('file', search)) for search in args['search']]))
 
         if args['include']:
             if args['exclude']:
@@ -164,15 +173,15 @@ class FileTagAddApi(Resource):
     def put(self, file_id):
         args = u_file_tags.parse_args()
         file = fileCheck(file_id)
-        for tag in args['tags']:
-            _tag = Tag.query.filter_by(name=tag).first()
-            if not _tag:
-                _tag = Tag(name=tag)
-                db.session.add(_tag)
+        for _tag in resolveTags(args['tags']):
             if _tag not in file.tags:
                 file.tags.append(_tag)
 
+        indexFile(file)
         db.session.commit()
+        projectsUpdated(fileProjects(file.id))
+        if file.public:
+            fileStatsChanged(file)
         return file, 200
 
 
@@ -2,7 +2,8 @@ from flask_restplus import Resource, reqparse, fields, marshal
 from flask import g
 from sqlalchemy import or_, case, and_
 from .. import api, app, db
-from ..model import Option, Phase, User, File, Project, Tag, Group
+from ..model import Phase, User, File, Project, Tag, Group
+from ..model.misc import getOption, setOption
 from ..utility import buildUrl, getAvatar
 from .utility import getData, projectCheck, userCheck
 from .decorator import permission_required, admin_required
@@ -18,17 +19,14 @@ UPDATE_OPTION = reqparse.RequestParser()\
 class OptionsApi(Resource):
     @permission_required()
     def get(self):
-        allow_sign_in = Option.query.filter_by(name='allow_sign_in').first()
         return {
-            'allow_sign_in': allow_sign_in.value,
+            'allow_sign_in': getOption('allow_sign_in'),
         }, 200
     
     @permission_required()
     def put(self):
         args = UPDATE_OPTION.parse_args()
-        allow_sign_in = Option.query.filter_by(name='allow_sign_in').first()
-        allow_sign_in.value = args['allow_sign_in']
-        db.session.commit()
+        setOption('allow_sign_in', args['allow_sign_in'])
         return {
             'message': 'ok',
         }, 200
@@ -2,14 +2,23 @@
 Project Api
 """
 from flask_restplus import Resource, reqparse, fields, marshal
-from flask import g
+from flask_restplus.mask import Mask, ParseError
+from flask import g, request
 from sqlalchemy import or_, case, and_
+from sqlalchemy.orm import joinedload, selectinload, defer
 from .. import api, app, db
-from ..model import Stage, Phase, User, File, Project, Tag, Group
+from ..model import Stage, Phase, User, File, Project, Tag, Group, ProjectLog
+from ..model.search import matchQuery, indexProject
+from ..model.project import projectUpdated, getFiles
+from ..model.misc import getByIds
 from ..utility import buildUrl, getAvatar
-from .utility import getData, projectCheck, userCheck
-from .decorator import permission_required, admin_required
+from .utility import getData, projectCheck, userCheck, paginate
+from .decorator import permission_required, admin_required, etag_version
+from .serializer import compileModel, marshal_compiled
+from ..cache import cacheGet, cacheSet, getVersion
 import time
+import json
+import hashlib
 from datetime import datetime
 
 PERMISSIONS = app.config['PERMISSIONS']
@@ -97,6 +106,15 @@ M_PROJECT_LOG = api.model('project_log', {
     'log_date': fields.String,
 })
 
+def avatarLoader(option):
+    """Extend a loader option pointing at a User with what getAvatar reads."""
+    return [option.joinedload(User.wx_user), option.joinedload(User.avatar)]
+
+
+def fileLoader(option):
+    return option.selectinload(File.previews)
+
+
 M_PROJECT = api.model('project', {
     'id': fields.Integer,
     'title': fields.String,
@@ -117,6 +135,22 @@ M_PROJECT = api.model('project', {
     'delay': fields.Boolean,
     'pause': fields.Boolean,
 })
+# loading profile of M_PROJECT: a fixed number of queries per request,
+# however many stages, phases or files the projects have
+L_PROJECT = [
+    *avatarLoader(joinedload(Project.creator)),
+    *avatarLoader(joinedload(Project.client)),
+    selectinload(Project.tags),
+    fileLoader(selectinload(Project.files)),
+    *avatarLoader(selectinload(Project.logs).joinedload(ProjectLog.operator)),
+    selectinload(Project.stages).selectinload(Stage.phases).joinedload(Phase.creator),
+    selectinload(Project.stages).selectinload(Stage.phases).joinedload(Phase.client),
+    selectinload(Project.stages).selectinload(Stage.phases).selectinload(Phase.pauses),
+    fileLoader(selectinload(Project.stages).selectinload(
+        Stage.phases).selectinload(Phase.upload_files)),
+    fileLoader(selectinload(Project.stages).selectinload(
+        Stage.phases).selectinload(Phase.files)),
+]
 
 M_PROJECT_MIN = api.model('project_min', {
     'id': fields.Integer,
@@ -135,11 +169,20 @@ M_PROJECT_MIN = api.model('project_min', {
     'delay': fields.Boolean,
     'pause': fields.Boolean,
 })
+L_PROJECT_MIN = [
+    *avatarLoader(joinedload(Project.creator)),
+    *avatarLoader(joinedload(Project.client)),
+    selectinload(Project.stages),
+    selectinload(Project.tags),
+]
 
 M_PROJECTS = api.model('projects', {
     'projects': fields.List(fields.Nested(M_PROJECT)),
     'total': fields.Integer,
+    'next_cursor': fields.String,
 })
+S_PROJECTS = compileModel(M_PROJECTS, skip_none=True)
+S_PROJECT = compileModel(M_PROJECT)
 
 GET_PROJECT = reqparse.RequestParser()\
     .add_argument('creator_id', location='args', action='split')\
@@ -158,9 +201,224 @@ GET_PROJECT = reqparse.RequestParser()\
     .add_argument('exclude', location='args', action='split')\
     .add_argument('page', location='args', type=int, default=1)\
     .add_argument('pre_page', location='args', type=int, default=10)\
+    .add_argument('cursor', location='args')\
+    .add_argument('fields', location='args')\
+    .add_argument('expand', location='args')\
     .add_argument('order', location='args', default='asc', choices=['asc', 'desc'])\
     .add_argument('order_by', location='args', default='id', choices=['id', 'title', 'start_date', 'finish_date', 'deadline_date', 'status', 'creator_id', 'client_id', 'progress'])
 
+G_PROJECT_FIELDS = reqparse.RequestParser()\
+    .add_argument('fields', location='args')\
+    .add_argument('expand', location='args')
+
+# MySQL sorts an ENUM column by declaration index, so rank it explicitly to
+# keep ORDER BY and keyset comparisons in line.
+STATUS_RANK = case(
+    {status: i for i, status in enumerate(Project.status.type.enums)}, value=Project.status)
+
+
+def projectOrderKeys(order_by, order):
+    desc = order == 'desc'
+    if order_by == 'title':
+        return [(Project.title, desc), (Project.id, True)]
+    elif order_by == 'start_date':
+        return [(Project.start_date, desc), (Project.id, False)]
+    elif order_by == 'finish_date':
+        return [(Project.finish_date, desc), (Project.id, False)]
+    elif order_by == 'deadline_date':
+        return [(Project.deadline_date, desc), (Project.id, False)]
+    elif order_by == 'status':
+        return [(STATUS_RANK, desc), (Project.pause, False), (Project.delay, True), (Project.id, True)]
+    elif order_by == 'progress':
+        return [(Project.progress, desc), (STATUS_RANK, True), (Project.id, True)]
+    elif order_by == 'creator_id':
+        return [(User.id, desc), (STATUS_RANK, True), (Project.pause, False), (Project.delay, True), (Project.id, True)]
+    elif order_by == 'client_id':
+        return [(User.id, desc), (STATUS_RANK, True), (Project.pause, False), (Project.delay, True), (Project.id, True)]
+    return [(Project.id, desc)]
+
+
+# list arguments whose order does not change the result
+UNORDERED_ARGS = ['creator_id', 'client_id', 'tags', 'progress', 'status', 'include', 'exclude']
+# arguments that only shape the output, not which projects are listed
+OUTPUT_ARGS = ['fields', 'expand']
+
+
+def projectListKey(args):
+    """Cache key of a listing, None when the cache can't be used."""
+    version = getVersion('projects')
+    if version is None:
+        return None
+    normalized = {}
+    for key, value in args.items():
+        if value is None or value == [] or key in OUTPUT_ARGS:
+            continue
+        if key in UNORDERED_ARGS:
+            value = sorted(set(value))
+        normalized[key] = value
+    digest = hashlib.sha1(json.dumps(
+        normalized, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return 'projects:list:%d:%s' % (version, digest)
+
+
+def projectsByIds(ids, options=None):
+    """Load projects by id, keeping the order of ids."""
+    query = Project.query
+    if options:
+        query = query.options(*options)
+    projects = {project.id: project for project in query.filter(Project.id.in_(ids)).all()}
+    return [projects[_id] for _id in ids if _id in projects]
+
+
+def projectDocKey(project_id, version):
+    return 'project:doc:%s:%s' % (project_id, version)
+
+
+def storeProjectDoc(project_id, version=None):
+    """Render M_PROJECT of a project and store it under its version.
+
+    Returns the JSON text, or None if the project doesn't exist. A document
+    is written once for a version and never changed, so a reader gets either
+    the old version or the new one, never a mix of both.
+    """
+    if version is None:
+        version = getVersion('project:%s' % project_id)
+    project = Project.query.options(*L_PROJECT).populate_existing().get(project_id)
+    if not project:
+        return None
+    doc = json.dumps(S_PROJECT(project), ensure_ascii=False)
+    if version is not None:
+        cacheSet(projectDocKey(project_id, version), doc,
+                 app.config.get('PROJECT_DOC_CACHE_TTL', 86400), raw=True)
+    return doc
+
+
+def projectDoc(project_id):
+    """JSON text of M_PROJECT, from the cache when it holds this version."""
+    version = getVersion('project:%s' % project_id)
+    if version is not None:
+        doc = cacheGet(projectDocKey(project_id, version), raw=True)
+        if doc is not None:
+            return doc
+    return storeProjectDoc(project_id, version)
+
+
+# relationships of M_PROJECT, expand= names some of them
+PROJECT_RELATIONS = ['creator', 'client', 'stages', 'tags', 'logs', 'files']
+# compiled serializers of the masks seen so far, at most MAX_MASKS of them
+_MASKED = {}
+MAX_MASKS = 64
+
+
+def projectMask(args, header=False):
+    """Parsed fields mask of a request, None for every field.
+
+    fields= picks the fields of M_PROJECT, with the X-Fields syntax for
+    nested ones: fields=id,title,stages{name,phases{id,deadline_date}}.
+    expand= adds relationships; on its own it means every plain field plus
+    the relationships named. With header, an X-Fields header counts as
+    fields= as well.
+    """
+    text = args.get('fields')
+    if args.get('expand'):
+        if not text:
+            text = ','.join(key for key in M_PROJECT if key not in PROJECT_RELATIONS)
+        text += ',' + args['expand']
+    if not text and header:
+        text = request.headers.get(app.config.get('RESTPLUS_MASK_HEADER', 'X-Fields'))
+    if not text:
+        return None
+    try:
+        return Mask(text, skip=True)
+    except ParseError as e:
+        print(e)
+        api.abort(400, "Bad fields.")
+
+
+def _has(mask, key):
+    return mask is None or '*' in mask or key in mask
+
+
+def _sub(mask, key):
+    """Mask of a nested field, None when the whole field is asked for."""
+    if mask is None or not isinstance(mask.get(key), Mask):
+        return None
+    return mask[key]
+
+
+def _files(option, mask):
+    return fileLoader(option) if _has(mask, 'previews') else option
+
+
+def projectLoader(mask):
+    """L_PROJECT cut down to the relationships and Text columns of mask."""
+    if mask is None or '*' in mask:
+        return L_PROJECT
+    options = [defer(column) for key, column in
+               (('design', Project.design), ('remark', Project.remark))
+               if key not in mask]
+    for key, relation in (('creator', Project.creator), ('client', Project.client)):
+        if key in mask:
+            options += avatarLoader(joinedload(relation))
+    if 'tags' in mask:
+        options.append(selectinload(Project.tags))
+    if 'files' in mask:
+        options.append(_files(selectinload(Project.files), _sub(mask, 'files')))
+
+    if 'logs' in mask:
+        logs = _sub(mask, 'logs')
+        option = selectinload(Project.logs)
+        if _has(logs, 'operator'):
+            options += avatarLoader(option.joinedload(ProjectLog.operator))
+        options.append(option if _has(logs, 'content') else option.defer(ProjectLog.content))
+
+    if 'stages' in mask:
+        if _has(_sub(mask, 'stages'), 'phases'):
+            options += phaseLoader(_sub(_sub(mask, 'stages'), 'phases'))
+        else:
+            options.append(selectinload(Project.stages))
+    return options
+
+
+def phaseLoader(mask):
+    option = selectinload(Project.stages).selectinload(Stage.phases)
+    options = [option]
+    for key, relation in (('creator', Phase.creator), ('client', Phase.client)):
+        if _has(mask, key):
+            options.append(option.joinedload(relation))
+    if _has(mask, 'pauses'):
+        options.append(option.selectinload(Phase.pauses))
+    for key, relation in (('upload_files', Phase.upload_files), ('files', Phase.files)):
+        if _has(mask, key):
+            options.append(_files(option.selectinload(relation), _sub(mask, key)))
+    for key, column in (('creator_upload', Phase.creator_upload),
+                        ('client_feedback', Phase.client_feedback)):
+        if not _has(mask, key):
+            options.append(option.defer(column))
+    return options
+
+
+def projectSerializer(mask, listing=False):
+    """Compiled serializer of M_PROJECT, or M_PROJECTS, restricted to mask."""
+    if mask is None:
+        return S_PROJECTS if listing else S_PROJECT
+    key = (str(mask), listing)
+    if key not in _MASKED:
+        # the mask picks the fields of each project, never of the envelope
+        project = mask.apply(M_PROJECT.resolved)
+        model = project
+        if listing:
+            model = {
+                'projects': fields.List(fields.Nested(project)),
+                'total': fields.Integer,
+                'next_cursor': fields.String,
+            }
+        if len(_MASKED) >= MAX_MASKS:
+            return lambda data: marshal(data, model, skip_none=listing)
+        _MASKED[key] = (compileModel(model, skip_none=listing), project)
+    return _MASKED[key][0]
+
+
 POST_PROJECT = reqparse.RequestParser()\
     .add_argument('title', required=True)\
     .add_argument('creator_id', type=int, required=True)\
@@ -175,6 +433,20 @@ class PorjectsApi(Resource):
     @api.expect(GET_PROJECT)
     def get(self):
         args = GET_PROJECT.parse_args()
+        # the listing only changes when a project change is committed, which
+        # bumps the version the key is built on
+        key = projectListKey(args)
+        cached = cacheGet(key) if key else None
+        mask = projectMask(args)
+        serialize = projectSerializer(mask, listing=True)
+        if cached:
+            output = {
+                'projects': projectsByIds(cached['ids'], projectLoader(mask)),
+                'total': cached['total'],
+                'next_cursor': cached['next_cursor']
+            }
+            return serialize(output), 200
+
         query = Project.query
         if args['discard']:
             query = query.filter(Project.discard == True)
@@ -235,12 +507,10 @@ class PorjectsApi(Resource):
                 args['progress']))
 
         if args['search']:
-            query = query.join(Project.tags).filter(
-                or_(Project.title.contains(args['search']), Tag.name.contains(args['search'])))
+            query = query.filter(Project.id.in_(matchQuery('project', args['search'])))
 
         if args['tags']:
-            query = query.join(Project.tags).filter(
-                Tag.name.in_(args['tags']))
+            query = query.filter(Project.tags.any(Tag.name.in_(args['tags'])))
 
         if args['include']:
             if args['exclude']:
@@ -249,78 +519,30 @@ class PorjectsApi(Resource):
         elif args['exclude']:
             query = query.filter(Project.id.notin_(args['exclude']))
 
-        query = query.from_self()
-
-        if args['order_by'] == 'id':
-            if args['order'] == 'asc':
-                query = query.order_by(Project.id.asc())
-            else:
-                query = query.order_by(Project.id.desc())
-
-        elif args['order_by'] == 'title':
-            if args['order'] == 'asc':
-                query = query.order_by(Project.title.asc(), Project.id.desc())
-            else:
-                query = query.order_by(Project.title.desc(), Project.id.desc())
-
-        elif args['order_by'] == 'start_date':
-            if args['order'] == 'asc':
-                query = query.order_by(Project.start_date.asc())
-            else:
-                query = query.order_by(Project.start_date.desc())
-        elif args['order_by'] == 'finish_date':
-            if args['order'] == 'asc':
-                query = query.order_by(Project.finish_date.asc())
-            else:
-                query = query.order_by(Project.finish_date.desc())
-        elif args['order_by'] == 'deadline_date':
-            if args['order'] == 'asc':
-                query = query.order_by(Project.deadline_date.asc())
-            else:
-                query = query.order_by(Project.deadline_date.desc())
-        elif args['order_by'] == 'status':
-            if args['order'] == 'asc':
-                query = query.order_by(Project.status.asc(), Project.pause.asc(
-                ), Project.delay.desc(), Project.id.desc())
-            else:
-                query = query.order_by(
-                    Project.status.desc(), Project.pause.asc(), Project.delay.desc(), Project.id.desc())
-
-        elif args['order_by'] == 'progress':
-            if args['order'] == 'asc':
-                query = query.order_by(Project.progress.asc(
-                ), Project.status.desc(), Project.id.desc())
-            else:
-                query = query.order_by(Project.progress.desc(
-                ), Project.status.desc(), Project.id.desc())
-
-        elif args['order_by'] == 'creator_id':
-            if args['order'] == 'asc':
-                query = query.join(Project.creator).order_by(
-                    User.id.asc(), Project.status.desc(), Project.pause.asc(), Project.delay.desc(), Project.id.desc())
-            else:
-                query = query.join(Project.creator).order_by(
-                    User.id.desc(), Project.status.desc(), Project.pause.asc(), Project.delay.desc(), Project.id.desc())
-
+        if args['order_by'] == 'creator_id':
+            query = query.join(Project.creator)
         elif args['order_by'] == 'client_id':
-            if args['order'] == 'asc':
-                query = query.join(Project.client).order_by(
-                    User.id.asc(), Project.status.desc(), Project.pause.asc(), Project.delay.desc(), Project.id.desc())
-            else:
-                query = query.join(Project.client).order_by(
-                    User.id.desc(), Project.status.desc(), Project.pause.asc(), Project.delay.desc(), Project.id.desc())
-
-        total = len(query.all())
-        projects = query.limit(args['pre_page']).offset(
-            (args['page']-1)*args['pre_page']).all()
+            query = query.join(Project.client)
+
+        query = query.options(*projectLoader(mask))
+        projects, total, next_cursor = paginate(
+            query, projectOrderKeys(args['order_by'], args['order']),
+            '%s %s' % (args['order_by'], args['order']), args['page'], args['pre_page'], args['cursor'])
+        if key:
+            cacheSet(key, {
+                'ids': [project.id for project in projects],
+                'total': total,
+                'next_cursor': next_cursor
+            }, app.config.get('PROJECT_LIST_CACHE_TTL', 600))
 
         output = {
             'projects': projects,
-            'total': total
+            'total': total,
+            'next_cursor': next_cursor
         }
-        return marshal(output, M_PROJECTS, skip_none=True), 200
+        return serialize(output), 200
 
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @api.expect(POST_PROJECT)
     @permission_required()
     def post(self):
@@ -345,7 +567,7 @@ class PorjectsApi(Resource):
                 args['tags'],
                 args['files'],
             )
-            return new_project, 201
+            return projectCheck(new_project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -363,12 +585,25 @@ UPDATE_PROJECT = reqparse.RequestParser()\
 
 @N_PROJECT.route('/<int:project_id>')
 class PorjectApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @etag_version(lambda project_id: 'project:%s' % project_id)
+    @api.response(200, 'Success', M_PROJECT)
+    @api.expect(G_PROJECT_FIELDS)
     def get(self, project_id):
-        project = projectCheck(project_id)
-        return project, 200
-
-    @api.marshal_with(M_PROJECT)
+        mask = projectMask(G_PROJECT_FIELDS.parse_args(), header=True)
+        if mask is None:
+            doc = projectDoc(project_id)
+            if doc is None:
+                api.abort(400, "Project is not exist.")
+            return app.response_class(doc, mimetype='application/json')
+
+        # a cached full document is cheaper to cut down than a new query
+        version = getVersion('project:%s' % project_id)
+        doc = cacheGet(projectDocKey(project_id, version)) if version is not None else None
+        if doc is not None:
+            return mask.apply(doc), 200
+        return projectSerializer(mask)(projectCheck(project_id, projectLoader(mask))), 200
+
+    @marshal_compiled(M_PROJECT)
     @api.expect(UPDATE_PROJECT)
     @permission_required()
     def put(self, project_id):
@@ -395,15 +630,15 @@ class PorjectApi(Resource):
                 project.design = args['design']
             if args['remark'] != None:
                 project.remark = args['remark']
+            if args['title'] != None or args['design'] != None:
+                indexProject(project)
 
             if args['files']:
-                project.files = []
-                for file_id in args['files']:
-                    file = File.query.get(file_id)
-                    project.files.append(file)
+                project.files = getFiles(args['files'])
 
             db.session.commit()
-            return project, 201
+            projectUpdated(project.id)
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: ' + str(error))
@@ -417,7 +652,7 @@ class PorjectApi(Resource):
 
 @N_PROJECT.route('/<int:project_id>/start')
 class PorjectStartApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         project = projectCheck(project_id)
@@ -435,7 +670,7 @@ class PorjectStartApi(Resource):
 
         try:
             project.doStart(g.current_user.id)
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -450,7 +685,7 @@ UPLOAD_PROJECT = reqparse.RequestParser()\
 
 @N_PROJECT.route('/<int:project_id>/upload')
 class PorjectUploadApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         args = UPLOAD_PROJECT.parse_args()
@@ -460,9 +695,8 @@ class PorjectUploadApi(Resource):
                 api.abort(
                     403, "Only the project's creator can upload(Administrator privileges required).")
 
-        for upload_file in args['upload_files']:
-            if not File.query.get(upload_file['id']):
-                api.abort(401, "File is not exist.")
+        if getByIds(File, [f['id'] for f in args['upload_files']])[1]:
+            api.abort(401, "File is not exist.")
         if project.status != 'modify' and project.status != 'progress':
             api.abort(
                 401, "Creator can upload only during 'modify' or 'progress'.")
@@ -488,7 +722,7 @@ class PorjectUploadApi(Resource):
                     args['files'],
                     args['upload_files'],
                 )
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -504,7 +738,7 @@ FEEDBACK_PROJECT = reqparse.RequestParser()\
 
 @N_PROJECT.route('/<int:project_id>/feedback')
 class PorjectModifyApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         args = FEEDBACK_PROJECT.parse_args()
@@ -535,6 +769,7 @@ class PorjectModifyApi(Resource):
                     project.doPause(1)
                     project.creator_user_id = 1
                     db.session.commit()
+                    projectUpdated(project.id)
             else:
                 project.editFeedback(
                     g.current_user.id,
@@ -542,7 +777,7 @@ class PorjectModifyApi(Resource):
                     args['feedback'],
                     args['files'],
                 )
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -554,7 +789,7 @@ CHANGEDDL_PROJECT = reqparse.RequestParser()\
 
 @N_PROJECT.route('/<int:project_id>/change_ddl')
 class PorjectChangeDDLApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         args = CHANGEDDL_PROJECT.parse_args()
@@ -573,7 +808,7 @@ class PorjectChangeDDLApi(Resource):
         ddl = datetime.strptime(args['ddl'], '%Y-%m-%d %H:%M:%S')
         try:
             project.doChangeDDL(g.current_user.id, ddl)
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -581,7 +816,7 @@ class PorjectChangeDDLApi(Resource):
 
 @N_PROJECT.route('/<int:project_id>/discard')
 class PorjectDiscardApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         project = Project.query.get(project_id)
@@ -590,7 +825,7 @@ class PorjectDiscardApi(Resource):
                 403, "Administrator privileges required for request update action.")
         try:
             project.doDiscard(g.current_user.id)
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -598,7 +833,7 @@ class PorjectDiscardApi(Resource):
 
 @N_PROJECT.route('/<int:project_id>/recover')
 class PorjectRecoverApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         project = Project.query.get(project_id)
@@ -607,7 +842,7 @@ class PorjectRecoverApi(Resource):
                 403, "Administrator privileges required for request update action.")
         try:
             project.doRecover(g.current_user.id)
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -615,7 +850,7 @@ class PorjectRecoverApi(Resource):
 
 @N_PROJECT.route('/<int:project_id>/resume')
 class PorjectResumeApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         project = Project.query.get(project_id)
@@ -629,7 +864,7 @@ class PorjectResumeApi(Resource):
 
         try:
             project.doResume(g.current_user.id)
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -637,7 +872,7 @@ class PorjectResumeApi(Resource):
 
 @N_PROJECT.route('/<int:project_id>/pause')
 class PorjectPauseApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         project = Project.query.get(project_id)
@@ -651,7 +886,7 @@ class PorjectPauseApi(Resource):
 
         try:
             project.doPause(g.current_user.id)
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
@@ -659,7 +894,7 @@ class PorjectPauseApi(Resource):
 
 @N_PROJECT.route('/<int:project_id>/back')
 class PorjectChangeStageApi(Resource):
-    @api.marshal_with(M_PROJECT)
+    @marshal_compiled(M_PROJECT)
     @permission_required()
     def put(self, project_id):
         project = Project.query.get(project_id)
@@ -680,7 +915,7 @@ class PorjectChangeStageApi(Resource):
             progress_index = project.progress-1
         try:
             project.doChangeStage(g.current_user.id, progress_index)
-            return project, 201
+            return projectCheck(project.id, L_PROJECT), 201
         except Exception as error:
             print('[Sever Error]: %s' % error)
             api.abort(500, '[Sever Error]: %s' % error)
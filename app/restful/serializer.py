@@ -0,0 +1,187 @@
+"""
+Compiled serializers
+
+marshal() looks every field up again for every object it renders. For the hot
+response models we generate a plain Python function once, at import time,
+that builds exactly the dict marshal() would build. The api.model itself is
+left untouched, so Swagger docs stay the same.
+"""
+from functools import wraps
+from flask import request
+from flask_restplus import fields, marshal
+from flask_restplus.utils import unpack
+from .. import api, app
+import json
+import time
+
+_COMPILED = {}
+_EMPTY = {}
+
+
+def _dictValue(obj, key):
+    try:
+        return obj[key]
+    except (IndexError, TypeError, KeyError):
+        return getattr(obj, key, None)
+
+
+def _listOf(value, serialize, field, key, obj):
+    if isinstance(value, list):
+        return [serialize(item) for item in value]
+    return field.output(key, obj)
+
+
+def _isPlain(field):
+    return getattr(field, 'default', None) is None
+
+
+def compileModel(model, skip_none=False):
+    """Return a function doing the same as marshal(obj, model, skip_none)."""
+    cache_key = (id(model), skip_none)
+    if cache_key in _COMPILED:
+        return _COMPILED[cache_key]
+
+    ns = {
+        'marshal': marshal,
+        'model': model,
+        'skip_none': skip_none,
+        '_dictValue': _dictValue,
+        '_listOf': _listOf,
+        '_EMPTY': _EMPTY,
+    }
+    # stands in for the real function while nested models compile, in case
+    # a model refers back to itself
+    _COMPILED[cache_key] = lambda obj: ns['serialize'](obj)
+
+    getters = []
+    formats = []
+    for i, (key, field) in enumerate(getattr(model, 'resolved', model).items()):
+        if isinstance(field, type):
+            field = field()
+        ns['_f%d' % i] = field
+
+        if isinstance(field, dict):
+            ns['_n%d' % i] = compileModel(field, skip_none)
+            getters.append(None)
+            formats.append('_n%d(obj)' % i)
+            continue
+
+        attribute = field.attribute if field.attribute is not None else key
+        if callable(attribute):
+            ns['_c%d' % i] = attribute
+            getters.append('_c%d(obj)' % i)
+        elif isinstance(attribute, str) and '.' not in attribute:
+            getters.append(repr(attribute))
+        else:
+            getters.append(None)
+            formats.append('_f%d.output(%r, obj)' % (i, key))
+            continue
+
+        v = 'v%d' % i
+        kind = type(field)
+        if kind is fields.String and _isPlain(field) and not getattr(field, 'discriminator', None):
+            formats.append('None if %s is None else str(%s)' % (v, v))
+        elif kind is fields.Integer and _isPlain(field):
+            formats.append('None if %s is None else int(%s)' % (v, v))
+        elif kind is fields.Boolean and _isPlain(field):
+            formats.append('None if %s is None else bool(%s)' % (v, v))
+        elif kind is fields.Nested and _isPlain(field) and not field.allow_null:
+            ns['_n%d' % i] = compileModel(field.nested, field.skip_none)
+            formats.append('_n%d(%s)' % (i, v))
+        elif kind is fields.List and _isPlain(field)\
+                and type(field.container) is fields.Nested\
+                and field.container.attribute is None\
+                and _isPlain(field.container)\
+                and not field.container.allow_null:
+            ns['_n%d' % i] = compileModel(
+                field.container.nested, field.container.skip_none)
+            formats.append('_listOf(%s, _n%d, _f%d, %r, obj)' % (v, i, i, key))
+        else:
+            getters[-1] = None
+            formats.append('_f%d.output(%r, obj)' % (i, key))
+
+    keys = list(getattr(model, 'resolved', model).keys())
+    lines = []
+    # loaded ORM attributes live in the instance __dict__, reading them there
+    # skips the descriptor; anything else goes through getattr as before
+    fetches = (
+        ('fromObj', '    d = getattr(obj, "__dict__", _EMPTY)',
+         'd[%s] if %s in d else getattr(obj, %s, None)'),
+        ('fromDict', None, '_dictValue(obj, %s)'),
+    )
+    for name, prelude, fetch in fetches:
+        lines.append('def %s(obj):' % name)
+        if prelude:
+            lines.append(prelude)
+        for i, getter in enumerate(getters):
+            if getter is None:
+                continue
+            if getter.startswith('_c'):
+                lines.append('    v%d = %s' % (i, getter))
+            else:
+                lines.append('    v%d = %s' % (i, fetch.replace('%s', getter)))
+        items = ', '.join('%r: %s' % (key, fmt) for key, fmt in zip(keys, formats))
+        if skip_none:
+            lines.append('    out = {%s}' % items)
+            lines.append(
+                '    return {k: v for k, v in out.items() if v is not None and v != {}}')
+        else:
+            lines.append('    return {%s}' % items)
+
+    lines += [
+        'def serialize(obj):',
+        '    if isinstance(obj, (list, tuple)):',
+        '        return [serialize(item) for item in obj]',
+        '    if isinstance(obj, dict):',
+        '        return fromDict(obj)',
+        "    if isinstance(obj, str) or hasattr(obj, '__getitem__'):",
+        '        return marshal(obj, model, skip_none=skip_none)',
+        '    return fromObj(obj)',
+    ]
+    exec(compile('\n'.join(lines), '<serializer %s>' % getattr(model, 'name', ''), 'exec'), ns)
+
+    _COMPILED[cache_key] = ns['serialize']
+    return ns['serialize']
+
+
+def marshal_compiled(model, code=200, skip_none=False):
+    """Drop-in for api.marshal_with(model) using a compiled serializer."""
+    serialize = compileModel(model, skip_none)
+
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            resp = f(*args, **kwargs)
+            mask = request.headers.get(app.config.get('RESTPLUS_MASK_HEADER', 'X-Fields'))
+            if isinstance(resp, tuple):
+                data, status, headers = unpack(resp)
+                if mask:
+                    return marshal(data, model, skip_none=skip_none, mask=mask), status, headers
+                return serialize(data), status, headers
+            if mask:
+                return marshal(resp, model, skip_none=skip_none, mask=mask)
+            return serialize(resp)
+        return api.response(code, 'Success', model)(wrapper)
+    return decorator
+
+
+def benchmark(model, data, rounds=10, skip_none=False):
+    """Time marshal() against the compiled serializer and check both agree."""
+    serialize = compileModel(model, skip_none)
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        expected = marshal(data, model, skip_none=skip_none)
+    marshal_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = serialize(data)
+    compiled_time = time.perf_counter() - start
+
+    return {
+        'identical': json.dumps(expected, ensure_ascii=False) == json.dumps(result, ensure_ascii=False),
+        'marshal': marshal_time/rounds,
+        'compiled': compiled_time/rounds,
+        'speedup': marshal_time/compiled_time if compiled_time else 0,
+    }
@@ -1,11 +1,16 @@
 from flask_restplus import Resource, reqparse, fields, marshal
 from flask import g, request
+from sqlalchemy.orm import joinedload, selectinload
 from .. import api, db, app
-from ..model import User, Group, ProjectNotice
+from ..model import User, Group, ProjectNotice, ProjectLog
+from ..model.user import userUpdated, principalUpdated
+from ..model.project import projectsUpdated, userProjects
+from ..model.misc import getByIds
 from ..utility import buildUrl, getAvatar,getStageIndex,getPhaseIndex
-from .utility import groupCheck, userCheck, projectNoticeCheck
+from .utility import groupCheck, userCheck, projectNoticeCheck, paginate
 from werkzeug.security import generate_password_hash
-from .decorator import permission_required, admin_required
+from .decorator import permission_required, admin_required, etag_version
+from .serializer import compileModel, marshal_compiled
 PERMISSIONS = app.config['PERMISSIONS']
 N_USER = api.namespace('api/users', description='User Operations')
 
@@ -29,6 +34,12 @@ M_GROUP = api.model('group', {
     'admins': fields.List(fields.Nested(M_MIN_USER)),
     'users': fields.List(fields.Nested(M_MIN_USER)),
 })
+L_GROUP = [
+    selectinload(Group.admins).joinedload(User.wx_user),
+    selectinload(Group.admins).joinedload(User.avatar),
+    selectinload(Group.users).joinedload(User.wx_user),
+    selectinload(Group.users).joinedload(User.avatar),
+]
 M_GROUP_MIN = api.model('group_min)', {
     'id': fields.Integer(),
     'name': fields.String(),
@@ -59,11 +70,22 @@ M_USER = api.model('user', {
     ),
     'wx_user': fields.Nested(m_wx_user),
 })
+L_USER = [
+    joinedload(User.role),
+    joinedload(User.wx_user),
+    joinedload(User.avatar),
+    selectinload(User.groups),
+    selectinload(User.groups_as_admin),
+    selectinload(User.followed_users),
+    selectinload(User.follower_users),
+]
 
 M_USERS = api.model('users', {
     'users': fields.List(fields.Nested(M_USER)),
     'total': fields.Integer(description="Unique identifier for the user."),
+    'next_cursor': fields.String(description="Cursor of the next page."),
 })
+S_USERS = compileModel(M_USERS)
 
 g_user = reqparse.RequestParser()
 g_user.add_argument('role_id', location='args', action='split',
@@ -83,6 +105,8 @@ g_user.add_argument('page', location='args', type=int, default=1,
                     help="Current page of the collection.")
 g_user.add_argument('pre_page', location='args', type=int, default=10,
                     help="Maximum number of items to be returned in result set.")
+g_user.add_argument('cursor', location='args',
+                    help="Continue right after the page this cursor came from.")
 
 p_user = reqparse.RequestParser()
 p_user.add_argument('login', location='args', required=True,
@@ -119,7 +143,7 @@ class UsersApi(Resource):
     # @permission_required()
     def get(self):
         args = g_user.parse_args()
-        query = User.query
+        query = User.query.options(*L_USER)
         if args['role_id']:
             query = query.filter(User.role_id.in_(args['role_id']))
 
@@ -130,30 +154,23 @@ class UsersApi(Resource):
         elif args['exclude']:
             query = query.filter(User.id.notin_(args['exclude']))
 
-        if args['order_by'] == 'id':
-            if args['order'] == 'asc':
-                query = query.order_by(User.id.asc())
-            else:
-                query = query.order_by(User.id.desc())
-        elif args['order_by'] == 'name':
-            if args['order'] == 'asc':
-                query = query.order_by(User.name.asc())
-            else:
-                query = query.order_by(User.name.desc())
+        desc = args['order'] == 'desc'
+        if args['order_by'] == 'name':
+            keys = [(User.name, desc), (User.id, False)]
         elif args['order_by'] == 'reg_date':
-            if args['order'] == 'asc':
-                query = query.order_by(User.reg_date.asc())
-            else:
-                query = query.order_by(User.reg_date.desc())
+            keys = [(User.reg_date, desc), (User.id, False)]
+        else:
+            keys = [(User.id, desc)]
 
-        total = len(query.all())
-        users = query.limit(args['pre_page']).offset((args['page']-1)*args['pre_page']).all()
+        users, total, next_cursor = paginate(
+            query, keys, '%s %s' % (args['order_by'], args['order']), args['page'], args['pre_page'], args['cursor'])
 
         output = {
             'users': users,
-            'total': total
+            'total': total,
+            'next_cursor': next_cursor
         }
-        return marshal(output, M_USERS), 200
+        return S_USERS(output), 200
 
     @api.marshal_with(M_USER)
     @api.expect(p_user)
@@ -201,6 +218,10 @@ class UsersApi(Resource):
                     if args['title']:
                         user.title = args['title']
                     db.session.commit()
+                    userUpdated(user.id)
+                    if args['name']:
+                        principalUpdated(user.id)
+                        projectsUpdated(userProjects(user.id))
                 except Exception as e:
                     print(e)
                     api.abort(400, e)
@@ -213,20 +234,19 @@ class UsersApi(Resource):
         users = User.query.filter(
             User.id.in_(args['user_id'])).all()
         if users:
+            # one at a time, so tokens and cached documents of each expire
             for user in users:
-                if user.wx_user:
-                    db.session.delete(user.wx_user)
-                db.session.delete(user)
-            db.session.commit()
+                user.delete()
             return {'message': 'ok!'}, 200
         else:
             api.abort(400, "user doesn't exist")
 
 @N_USER.route('/<int:user_id>')
 class UserApi(Resource):
-    @api.marshal_with(M_USER)
+    @etag_version(lambda user_id: 'user:%s' % user_id)
+    @marshal_compiled(M_USER)
     def get(self, user_id):
-        user = userCheck(user_id)
+        user = userCheck(user_id, L_USER)
         return user, 200
 
     @admin_required
@@ -269,38 +289,50 @@ M_PROJECT_NOTICE = api.model('project_log', {
     'log': fields.Nested(M_PROJECT_LOG),
     'read': fields.Boolean
 })
+L_PROJECT_NOTICE = [
+    joinedload(ProjectNotice.log).joinedload(ProjectLog.operator).joinedload(User.wx_user),
+    joinedload(ProjectNotice.log).joinedload(ProjectLog.operator).joinedload(User.avatar),
+    joinedload(ProjectNotice.log).joinedload(ProjectLog.project),
+    joinedload(ProjectNotice.log).joinedload(ProjectLog.phase),
+]
 
 M_PROJECT_NOTICES = api.model('project_logs', {
     'project_notices': fields.List(fields.Nested(M_PROJECT_NOTICE)),
     'total': fields.Integer,
     'unread': fields.Integer,
+    'next_cursor': fields.String,
 })
+S_PROJECT_NOTICES = compileModel(M_PROJECT_NOTICES, skip_none=True)
 
 G_PROJECT_NOTICES = reqparse.RequestParser()\
     .add_argument('only_unread', location='args', type=int, default=1)\
     .add_argument('page', location='args', type=int, default=1)\
     .add_argument('pre_page', location='args', type=int, default=10)\
+    .add_argument('cursor', location='args')
 
 @N_USER.route('/<int:user_id>/project_notices')
 class UserProjectNoticesApi(Resource):
+    @etag_version(lambda user_id: 'user:%s' % user_id)
     def get(self, user_id):
         args = G_PROJECT_NOTICES.parse_args()
         user = userCheck(user_id)
         query = ProjectNotice.query.filter_by(to_user_id=user_id)
-        total = query.all()
-        unread = query.filter_by(read=False).all()
+        total = query.count()
+        unread = query.filter_by(read=False).count()
 
         if(args['only_unread']):
             query = query.filter_by(read=False)
 
-        notices = query.order_by(ProjectNotice.id.desc()).limit(args['pre_page']).offset((args['page']-1)*args['pre_page']).all()
+        notices, _, next_cursor = paginate(
+            query.options(*L_PROJECT_NOTICE), [(ProjectNotice.id, True)], 'id desc', args['page'], args['pre_page'], args['cursor'])
 
         output = {
             'project_notices': notices,
-            'total': len(total),
-            'unread':len(unread)
+            'total': total,
+            'unread': unread,
+            'next_cursor': next_cursor
         }
-        return marshal(output, M_PROJECT_NOTICES, skip_none=True), 200
+        return S_PROJECT_NOTICES(output), 200
     
     def put(self, user_id):
         user = userCheck(user_id)
@@ -326,6 +358,7 @@ N_GROUP = api.namespace('api/groups', description='Group Operations')
 M_GROUPS = api.model('groups', {
     'groups': fields.List(fields.Nested(M_GROUP)),
     'total': fields.Integer(description="Unique identifier for the user."),
+    'next_cursor': fields.String(description="Cursor of the next page."),
 })
 
 G_GROUP = reqparse.RequestParser()\
@@ -334,7 +367,8 @@ G_GROUP = reqparse.RequestParser()\
     .add_argument('order', location='args', default='asc',choices=['asc', 'desc'])\
     .add_argument('order_by', location='args', default='id',choices=['id', 'name', 'reg_date'])\
     .add_argument('page', location='args', type=int, default=1)\
-    .add_argument('pre_page', location='args', type=int, default=20)
+    .add_argument('pre_page', location='args', type=int, default=20)\
+    .add_argument('cursor', location='args')
 
 P_GROUP = reqparse.RequestParser()\
     .add_argument('name', required=True)\
@@ -348,7 +382,7 @@ class GroupsApi(Resource):
     # @permission_required()
     def get(self):
         args = G_GROUP.parse_args()
-        query = Group.query
+        query = Group.query.options(*L_GROUP)
 
         if args['include']:
             if args['exclude']:
@@ -357,28 +391,21 @@ class GroupsApi(Resource):
         elif args['exclude']:
             query = query.filter(Group.id.notin_(args['exclude']))
 
-        if args['order_by'] == 'id':
-            if args['order'] == 'asc':
-                query = query.order_by(Group.id.asc())
-            else:
-                query = query.order_by(Group.id.desc())
-        elif args['order_by'] == 'name':
-            if args['order'] == 'asc':
-                query = query.order_by(Group.name.asc())
-            else:
-                query = query.order_by(Group.name.desc())
+        desc = args['order'] == 'desc'
+        if args['order_by'] == 'name':
+            keys = [(Group.name, desc), (Group.id, False)]
         elif args['order_by'] == 'reg_date':
-            if args['order'] == 'asc':
-                query = query.order_by(Group.reg_date.asc())
-            else:
-                query = query.order_by(Group.reg_date.desc())
+            keys = [(Group.reg_date, desc), (Group.id, False)]
+        else:
+            keys = [(Group.id, desc)]
+
+        groups, total, next_cursor = paginate(
+            query, keys, '%s %s' % (args['order_by'], args['order']), args['page'], args['pre_page'], args['cursor'])
 
-        total = len(query.all())
-        groups = query.limit(args['pre_page']).offset((args['page']-1)*args['pre_page']).all()
-        
         output = {
-            'groups':groups,
-            'total':total
+            'groups': groups,
+            'total': total,
+            'next_cursor': next_cursor
         }
         return marshal(output, M_GROUPS), 200
 
@@ -387,13 +414,11 @@ class GroupsApi(Resource):
     def post(self):
         args = P_GROUP.parse_args()
 
-        for _id in args['admin_id']:
-            if not User.query.get(_id):
-                api.abort(401, "Admin is not exist.")
+        if getByIds(User, args['admin_id'])[1]:
+            api.abort(401, "Admin is not exist.")
 
-        for _id in args['user_id']:
-            if not User.query.get(_id):
-                api.abort(401, "User is not exist.")
+        if getByIds(User, args['user_id'])[1]:
+            api.abort(401, "User is not exist.")
 
         try:
             new_group = Group.create_group(
@@ -415,7 +440,7 @@ class GroupAddUserApi(Resource):
     def put(self, group_id, user_id):
         group = groupCheck(group_id)
         if not g.current_user.can(PERMISSIONS['ADMIN']):
-            if not g.current_user in group.admins:
+            if not any(admin.id == g.current_user.id for admin in group.admins):
                 api.abort(
                     403, "Only the group's admin can add member(Administrator privileges required).")
 
@@ -428,6 +453,7 @@ class GroupAddUserApi(Resource):
         group.users.append(user)
 
         db.session.commit()
+        userUpdated(user.id)
         return group, 200
 
 @N_GROUP.route('/<int:group_id>/remove/<int:user_id>')
@@ -437,7 +463,7 @@ class GroupRemoveUserApi(Resource):
     def put(self, group_id, user_id):
         group = groupCheck(group_id)
         if not g.current_user.can(PERMISSIONS['ADMIN']):
-            if not g.current_user in group.admins:
+            if not any(admin.id == g.current_user.id for admin in group.admins):
                 api.abort(
                     403, "Only the group's admin can remove member(Administrator privileges required).")
 
@@ -451,6 +477,7 @@ class GroupRemoveUserApi(Resource):
         group.users.remove(user)
 
         db.session.commit()
+        userUpdated(user.id)
         return group, 200
 
 @N_GROUP.route('/<int:group_id>')
@@ -1,13 +1,24 @@
 from ..model import Stage, Phase, User, File, Project, Tag, Group, ProjectNotice
+from ..model.file import FILE_TAG
+from ..model.stats import cachedSumStats, sumStatsColumns, STAGE_COUNTS, REF_TAG_BANDS
 from datetime import datetime
-from sqlalchemy import or_, case, and_
+from sqlalchemy import or_, case, and_, false, literal, func, exists
+from sqlalchemy.orm import aliased
 from .. import api, app, db
-from numpy import interp, clip
+from numpy import interp, clip, where, maximum, arctan, around, errstate, array
 from datetime import datetime, timedelta
 import math
+import json
+import base64
 
 
 def getData(user_id, date_range=None):
+    """Work metrics of a user over date_range, all counts.
+
+    Stage and phase numbers come from grouped queries, nothing is loaded
+    per stage or phase. Durations are summed here from the bare dates, the
+    same way for MySQL and SQLite.
+    """
     user = User.query.get(user_id)
     if not user:
         raise Exception("User is not exist!")
@@ -22,114 +33,241 @@ def getData(user_id, date_range=None):
         end = datetime.utcnow()
 
     delta_time = end-start
+    in_range = and_(Phase.upload_date <= end, Phase.upload_date >= start)
 
-    stages_all = Stage.query\
-        .filter(Stage.phases.any(and_(Phase.upload_date <= end, Phase.upload_date >= start)))\
-        .filter(Stage.phases.any(Phase.creator_user_id == user_id)).all()
-    stages_one_pass_c = []
-    stages_mod_pass_c = []
-    stages_no_pass_c = []
-    stages_one_pass_d = []
-    stages_mod_pass_d = []
-    stages_no_pass_d = []
-    for stage in stages_all:
-        if not stage.phases[-1].feedback_date:
-            # print('未完成的阶段：%s-%s'%(stage.project, stage))
-            if stage.name == '草图':
-                stages_no_pass_d.append(stage)
-            else:
-                stages_no_pass_c.append(stage)
-        else:
-            # print('完成的阶段：%s-%s'%(stage.project, stage))
-            if len(stage.phases) > 1:
-                if stage.name == '草图':
-                    stages_mod_pass_d.append(stage)
-                else:
-                    stages_mod_pass_c.append(stage)
-            else:
-                if stage.name == '草图':
-                    stages_one_pass_d.append(stage)
-                else:
-                    stages_one_pass_c.append(stage)
-
-    phases_all = Phase.query\
-        .filter(and_(Phase.upload_date <= end, Phase.upload_date >= start))\
-        .filter(Phase.creator_user_id == user_id).all()
-    phases_pass = []
-    phases_modify = []
-    phases_pending = []
-    for phase in phases_all:
-        stage = phase.stage
-        if phase.feedback_date:
-            if stage.phases[-1] == phase:
-                phases_pass.append(phase)
-            else:
-                phases_modify.append(phase)
+    # stages the user worked on: their phase count, whether one was uploaded
+    # in range, and whether the last phase got feedback
+    stats = db.session.query(
+        Phase.stage_id.label('stage_id'),
+        func.count(Phase.id).label('phases'),
+        func.max(case([(in_range, 1)], else_=0)).label('in_range'),
+        func.max(Phase.start_date).label('last_start'))\
+        .filter(Phase.stage_id.in_(
+            db.session.query(Phase.stage_id).filter(Phase.creator_user_id == user_id)))\
+        .group_by(Phase.stage_id).subquery()
+    last = aliased(Phase)
+    stages = db.session.query(
+        stats.c.stage_id, stats.c.phases,
+        func.min(case([(last.feedback_date == None, 0)], else_=1)).label('passed'))\
+        .join(last, and_(last.stage_id == stats.c.stage_id, last.start_date == stats.c.last_start))\
+        .filter(stats.c.in_range == 1)\
+        .group_by(stats.c.stage_id, stats.c.phases).subquery()
+    kind = case([(Stage.name == '草图', 'd')], else_='c')
+    status = case([(stages.c.passed == 0, 'no'), (stages.c.phases > 1, 'mod')], else_='one')
+    data = {
+        'user': user,
+        'delta_time': delta_time,
+        'stages_all': 0,
+    }
+    for _kind in ('c', 'd'):
+        data['phases_pass_' + _kind] = 0
+        for _status in ('one', 'mod', 'no'):
+            data['stages_%s_pass_%s' % (_status, _kind)] = 0
+    for _kind, _status, count, phases in db.session.query(
+            kind, status, func.count(), func.sum(stages.c.phases))\
+            .join(stages, stages.c.stage_id == Stage.id).group_by(kind, status):
+        data['stages_%s_pass_%s' % (_status, _kind)] = count
+        data['stages_all'] += count
+        if _status != 'no':
+            data['phases_pass_' + _kind] += int(phases)
+
+    later = aliased(Phase)
+    is_last = ~exists().where(and_(
+        later.stage_id == Phase.stage_id, later.start_date > Phase.start_date))
+    phases = db.session.query(
+        Phase.start_date, Phase.deadline_date, Phase.upload_date, Phase.feedback_date,
+        Phase.paused_seconds, is_last)\
+        .filter(in_range, Phase.creator_user_id == user_id).all()
+    data.update({
+        'phases_all': len(phases),
+        'phases_pass': 0,
+        'phases_modify': 0,
+        'phases_pending': 0,
+        'phases_overtime': 0,
+        'overtime_sum': 0,
+    })
+    upload_total = timedelta(seconds=0)
+    deadline_total = timedelta(seconds=0)
+    for start_date, deadline_date, upload_date, feedback_date, paused_seconds, _is_last in phases:
+        if not feedback_date:
+            data['phases_pending'] += 1
+        elif _is_last:
+            data['phases_pass'] += 1
         else:
-            phases_pending.append(phase)
+            data['phases_modify'] += 1
 
-    phases_overtime = []
-    overtime_sum = 0
-    for phase in phases_all:
-        duration = phase.upload_date - phase.deadline_date
-        duration_in_s = int(duration.total_seconds())
+        duration_in_s = int((upload_date - deadline_date).total_seconds())
         if duration_in_s > 0:
-            phases_overtime.append(phase)
-            overtime_sum += duration_in_s
+            data['phases_overtime'] += 1
+            data['overtime_sum'] += duration_in_s
+        # time paused before the upload counts for neither
+        paused = timedelta(seconds=paused_seconds or 0)
+        upload_total += upload_date - start_date - paused
+        deadline_total += deadline_date - start_date - paused
+    data['upload_total'] = upload_total
+    data['deadline_total'] = deadline_total
 
-    files_ref = File.query.filter(File.public == True)\
+    # number of reference files by their number of tags
+    tags = db.session.query(File.id, func.count(FILE_TAG.c.tag_id).label('tags'))\
+        .outerjoin(FILE_TAG, FILE_TAG.c.file_id == File.id)\
+        .filter(File.public == True)\
         .filter(and_(File.upload_date <= end, File.upload_date >= start))\
-        .filter(File.uploader_user_id == user_id).all()
+        .filter(File.uploader_user_id == user_id)\
+        .group_by(File.id).subquery()
+    data['files_ref_tags'] = dict(
+        db.session.query(tags.c.tags, func.count()).group_by(tags.c.tags).all())
+    data['files_ref'] = sum(data['files_ref_tags'].values())
 
-    project_sample = Project.query.filter(Project.tags.any(Tag.name == '样图'))\
+    data['project_sample'] = db.session.query(func.count(Project.id))\
+        .filter(Project.tags.any(Tag.name == '样图'))\
         .filter(and_(Project.finish_date <= end, Project.finish_date >= start))\
-        .filter(Project.phases.any(Phase.creator_user_id == user_id)).all()
+        .filter(Project.phases.any(Phase.creator_user_id == user_id)).scalar()
+    return data
 
-    return {
+
+def getStats(user_id, date_range=None):
+    """getData summed from the day stats, see model.stats.
+
+    date_range counts in whole days, from the day it starts to the day it
+    ends, so every range within the same days shares one cached sum. A stage
+    counts on the day of its last upload.
+    """
+    user = User.query.get(user_id)
+    if not user:
+        raise Exception("User is not exist!")
+
+    if date_range:
+        start = datetime.strptime(
+            date_range[0], '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(
+            date_range[1], '%Y-%m-%d %H:%M:%S')
+    else:
+        start = user.reg_date
+        end = datetime.utcnow()
+
+    data = cachedSumStats(user_id, start.date(), end.date())
+    paused = data['pause_seconds']
+    data.update({
         'user': user,
-        'delta_time': delta_time,
-        'overtime_sum': overtime_sum,
-        'phases_overtime': phases_overtime,
-        'phases_all': phases_all,
-        'phases_pass': phases_pass,
-        'phases_modify': phases_modify,
-        'phases_pending': phases_pending,
-        'stages_all': stages_all,
-        'stages_one_pass_c': stages_one_pass_c,
-        'stages_mod_pass_c': stages_mod_pass_c,
-        'stages_no_pass_c': stages_no_pass_c,
-        'stages_one_pass_d': stages_one_pass_d,
-        'stages_mod_pass_d': stages_mod_pass_d,
-        'stages_no_pass_d': stages_no_pass_d,
-        'files_ref': files_ref,
-        'project_sample': project_sample,
+        'delta_time': end-start,
+        'stages_all': sum(data[count] for count in STAGE_COUNTS),
+        'upload_total': timedelta(seconds=data['upload_seconds'] - paused),
+        'deadline_total': timedelta(seconds=data['deadline_seconds'] - paused),
+        'files_ref_tags': {band: data['files_ref_tags_%d' % band] for band in REF_TAG_BANDS},
+    })
+    return data
+
+
+def getStatsColumns(users, date_range=None):
+    """getStats of many users at once, as arrays in the order of users.
+
+    upload_total and deadline_total are in seconds, delta_days replaces
+    delta_time and files_ref_tags has a column per band of REF_TAG_BANDS.
+    """
+    if date_range:
+        start = datetime.strptime(
+            date_range[0], '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(
+            date_range[1], '%Y-%m-%d %H:%M:%S')
+        data = sumStatsColumns([user.id for user in users], start.date(), end.date())
+        delta_days = [(end-start).days]*len(users)
+    else:
+        end = datetime.utcnow()
+        data = sumStatsColumns([user.id for user in users], None, end.date())
+        delta_days = [(end-user.reg_date).days for user in users]
+
+    paused = data['pause_seconds']
+    data.update({
+        'user_id': array([user.id for user in users], dtype='int64'),
+        'delta_days': array(delta_days, dtype='int64'),
+        'stages_all': sum(data[count] for count in STAGE_COUNTS),
+        'upload_total': data['upload_seconds'] - paused,
+        'deadline_total': data['deadline_seconds'] - paused,
+        'files_ref_tags': array(
+            [data['files_ref_tags_%d' % band] for band in REF_TAG_BANDS], dtype='int64').T,
+    })
+    return data
+
+
+def filePoints(tags):
+    """Points of a reference file with this many tags, to contribution and to score."""
+    if tags<4:
+        return 1, 1
+    elif tags<6:
+        return 3, 2
+    elif tags<7:
+        return 5, 2
+    elif tags<8:
+        return 5, 3
+    elif tags<10:
+        return 6, 3
+    else:
+        return 7, 3
+
+
+# filePoints of every band of REF_TAG_BANDS, one column per kind of points
+BAND_POINTS = array([filePoints(band) for band in REF_TAG_BANDS], dtype='int64')
+
+
+def getAttrs(data_raw):
+    """getAttr of a whole getStatsColumns in one pass, {attr: array}.
+
+    Every user gets the same numbers getAttr gives them.
+    """
+    stages_c = data_raw['stages_one_pass_c'] + data_raw['stages_mod_pass_c']
+    stages_d = data_raw['stages_one_pass_d'] + data_raw['stages_mod_pass_d']
+    phases_all = data_raw['phases_all']
+    delta_days = data_raw['delta_days']
+    files_s, files_s2 = (data_raw['files_ref_tags'] @ BAND_POINTS).T
+    project_sample = data_raw['project_sample']
+
+    # the branches getAttr does not take are computed too and thrown away
+    with errstate(divide='ignore', invalid='ignore'):
+        power = clip(1-data_raw['phases_pass_c']/(stages_c*5), 0, 4/5)
+        power = where(stages_c > 0, interp(power, [0, 4/5], [1, 5]), 0)
+        knowledge = clip(1-data_raw['phases_pass_d']/(stages_d*5), 0, 4/5)
+        knowledge = where(stages_d > 0, interp(knowledge, [0, 4/5], [1, 5]), 0)
+        power = (knowledge*1 + power*2)/3
+
+        active = (phases_all > 0) & (delta_days >= 1)
+        speed = arctan(data_raw['deadline_total']*0.8/data_raw['upload_total'])/(math.pi/2)
+        speed = where(active, interp(speed, [0, 1], [0, 5]), 0)
+        energy = clip(phases_all*1.8/delta_days, 0, 2)
+        energy = where(active, interp(energy, [0, 2], [1, 5]), 0)
+
+        contribution_s = (stages_d+stages_c)*10 + files_s + project_sample*20
+        contribution = clip(contribution_s/delta_days/6, 0, 2)
+        contribution = where((delta_days >= 1) & (contribution_s > 0),
+                             interp(contribution, [0, 2], [1, 5]), 0)
+
+    score = stages_d*10+stages_c*20 + files_s2 + project_sample*30-data_raw['overtime_sum']/86400
+    score = maximum(score, 0)
+    return {
+        'power': around(power, 1),
+        'speed': around(speed, 1),
+        'knowledge': around(knowledge, 1),
+        'energy': around(energy, 1),
+        'contribution': around(contribution, 1),
+        'score': around(score).astype('int64'),
     }
 
 
 def getAttr(data_raw):
-    stages_one_pass_c = data_raw['stages_one_pass_c']
-    stages_mod_pass_c = data_raw['stages_mod_pass_c']
-    stages_c = stages_one_pass_c + stages_mod_pass_c
-    phases_count = 0
-    for stage in stages_c:
-        phases_count += len(stage.phases)
+    stages_c = data_raw['stages_one_pass_c'] + data_raw['stages_mod_pass_c']
+    phases_count = data_raw['phases_pass_c']
 
     if stages_c:
-        power = (1-phases_count/(len(stages_c)*5))
+        power = (1-phases_count/(stages_c*5))
         power = clip(power, 0, 4/5)
         power = interp(power, [0, 4/5], [1, 5])
     else:
         power = 0
 
-    stages_one_pass_d = data_raw['stages_one_pass_d']
-    stages_mod_pass_d = data_raw['stages_mod_pass_d']
-    stages_d = stages_one_pass_d + stages_mod_pass_d
-    phases_d_count = 0
-    for stage in stages_d:
-        phases_d_count += len(stage.phases)
+    stages_d = data_raw['stages_one_pass_d'] + data_raw['stages_mod_pass_d']
+    phases_d_count = data_raw['phases_pass_d']
 
     if stages_d:
-        knowledge = (1-phases_d_count/(len(stages_d)*5))
+        knowledge = (1-phases_d_count/(stages_d*5))
         knowledge = clip(knowledge, 0, 4/5)
         knowledge = interp(knowledge, [0, 4/5], [1, 5])
 
@@ -142,46 +280,26 @@ def getAttr(data_raw):
     delta_time = data_raw['delta_time']
     delta_days = delta_time.days
     if phases_all and delta_days >= 1:
-        phases_sort = sorted(phases_all, key=lambda x: x.upload_date)
-        ud_total = timedelta(seconds=0)
-        dd_total = timedelta(seconds=0)
-        for phase in phases_sort:
-            ud = phase.upload_date - phase.start_date
-            dd = phase.deadline_date - phase.start_date
-            pd = timedelta(seconds=0)
-            for pause in phase.pauses:
-                if phase.upload_date > pause.pause_date and pause.resume_date:
-                    pd += pause.resume_date - pause.pause_date
-            ud_total += ud - pd
-            dd_total += dd - pd
+        ud_total = data_raw['upload_total']
+        dd_total = data_raw['deadline_total']
         speed = math.atan(dd_total.total_seconds()*0.8/ud_total.total_seconds())/(math.pi/2)
         speed = interp(speed, [0, 1], [0, 5])
 
-        energy = len(phases_sort)*1.8/delta_time.days
+        energy = phases_all*1.8/delta_time.days
         energy = clip(energy, 0, 2)
         energy = interp(energy, [0, 2], [1, 5])
     else:
         energy = 0
         speed = 0
-    user = data_raw['user']
-    files_ref = data_raw['files_ref']
+    files_ref_tags = data_raw['files_ref_tags']
     project_sample = data_raw['project_sample']
     overtime_sum = data_raw['overtime_sum']
 
     files_s = 0
-    for file in files_ref:
-        if len(file.tags)<4:
-            files_s += 1
-        elif len(file.tags)<6:
-            files_s += 3
-        elif len(file.tags)<8:
-            files_s += 5
-        elif len(file.tags)<10:
-            files_s += 6
-        else:
-            files_s += 7
+    for tags, count in files_ref_tags.items():
+        files_s += filePoints(tags)[0]*count
 
-    contribution_s = (len(stages_d)+len(stages_c))*10 + files_s +len(project_sample)*20
+    contribution_s = (stages_d+stages_c)*10 + files_s +project_sample*20
     if delta_days >= 1 and contribution_s > 0:
         contribution = contribution_s/delta_days/6
         contribution = clip(contribution, 0, 2)
@@ -190,15 +308,10 @@ def getAttr(data_raw):
         contribution = 0
     
     files_s2 = 0
-    for file in files_ref:
-        if len(file.tags)<4:
-            files_s2 += 1
-        elif len(file.tags)<7:
-            files_s2 += 2
-        else:
-            files_s2 += 3
+    for tags, count in files_ref_tags.items():
+        files_s2 += filePoints(tags)[1]*count
 
-    score = len(stages_d)*10+len(stages_c)*20 + files_s2 +len(project_sample)*30-overtime_sum/86400
+    score = stages_d*10+stages_c*20 + files_s2 +project_sample*30-overtime_sum/86400
     score = max(score,0)
     return {
         'power': round(power, 1),
@@ -209,16 +322,24 @@ def getAttr(data_raw):
         'score': round(score),
     }
 
-def projectCheck(project_id):
-    project = Project.query.get(project_id)
+def projectCheck(project_id, options=None):
+    query = Project.query
+    if options:
+        # re-read even if the project is already in the session, so the
+        # loading profile applies to it as well
+        query = query.options(*options).populate_existing()
+    project = query.get(project_id)
     if not project:
         api.abort(400, "Project is not exist.")
     else:
         return project
 
 
-def userCheck(user_id):
-    user = User.query.get(user_id)
+def userCheck(user_id, options=None):
+    query = User.query
+    if options:
+        query = query.options(*options).populate_existing()
+    user = query.get(user_id)
     if not user:
         api.abort(400, "user is not exist.")
     else:
@@ -239,3 +360,87 @@ def projectNoticeCheck(notice_id):
         api.abort(400, "notice is not exist.")
     else:
         return notice
+
+
+def paginate(query, keys, order, page=1, pre_page=10, cursor=None):
+    """Page a query ordered by ``keys``, a list of (expression, descending).
+
+    ``total`` comes from a single COUNT over the unordered query. Without a
+    cursor the page is fetched with LIMIT/OFFSET; with one it continues right
+    after the row the cursor was taken from (keyset pagination), so deep pages
+    cost the same as the first one. ``order`` names the ordering, like
+    'title desc' from the order_by and order arguments; a cursor is only
+    accepted by the ordering it was taken from. Returns (items, total, next_cursor).
+    """
+    total = query.order_by(None).count()
+
+    exprs = [expr for expr, _ in keys]
+    query = query.order_by(
+        *[expr.desc() if desc else expr.asc() for expr, desc in keys])
+    if cursor:
+        query = query.filter(keysetFilter(keys, decodeCursor(cursor, order, len(keys))))
+    else:
+        query = query.offset((page-1)*pre_page)
+
+    rows = query.add_columns(*exprs).limit(pre_page).all()
+    items = [row[0] for row in rows]
+
+    next_cursor = None
+    if len(rows) == pre_page:
+        next_cursor = encodeCursor(rows[-1][1:], order)
+    return items, total, next_cursor
+
+
+def keysetFilter(keys, values):
+    """Rows strictly after ``values`` in the order given by ``keys``.
+
+    NULLs sort first on ascending and last on descending order, as in MySQL.
+    """
+    clauses = []
+    for i, (expr, desc) in enumerate(keys):
+        terms = []
+        for (prev_expr, _), prev_value in zip(keys[:i], values[:i]):
+            if prev_value is None:
+                terms.append(prev_expr.is_(None))
+            else:
+                terms.append(prev_expr == literal(prev_value))
+
+        value = values[i]
+        if desc:
+            if value is None:
+                terms.append(false())
+            else:
+                terms.append(or_(expr < literal(value), expr.is_(None)))
+        else:
+            if value is None:
+                terms.append(expr.isnot(None))
+            else:
+                terms.append(expr > literal(value))
+        clauses.append(and_(*terms))
+    return or_(*clauses)
+
+
+def encodeCursor(values, order):
+    data = [order]
+    for value in values:
+        if isinstance(value, datetime):
+            data.append({'date': value.strftime('%Y-%m-%d %H:%M:%S.%f')})
+        else:
+            data.append(value)
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('utf-8')
+
+
+def decodeCursor(cursor, order, count):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        if data[0] != order or len(data) != count + 1:
+            raise ValueError('cursor does not match the order')
+        values = []
+        for value in data[1:]:
+            if isinstance(value, dict):
+                value = datetime.strptime(value['date'], '%Y-%m-%d %H:%M:%S.%f')
+            values.append(value)
+        return values
+    except Exception as e:
+        print(e)
+        api.abort(400, "Bad cursor.")
@@ -1,12 +1,18 @@
 from flask import request, Response
 import hashlib
 from flask_restplus import Resource, reqparse
-from .. import api, app, db, scheduler, r_db
-from ..model import User, WxUser, Option
+from .. import api, app, db, scheduler, r_db, celery
+from ..model import User, WxUser, WxOutbox
+from ..model.misc import getOption
+from ..model.user import userUpdated
+from ..model.project import projectsUpdated, userProjects
+from ..cache import cacheAdd
+from .decorator import issueToken
+from ..wxclient import wx, TOKEN_EXPIRED
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import func
 from werkzeug.security import check_password_hash, generate_password_hash
-import jwt
 import json
-import requests
 import shortuuid
 import urllib
 import xmltodict
@@ -102,8 +108,6 @@ class WxAuthApi(Resource):
     def get(self):
         # step 1: get access code from client.
         args = g_user.parse_args()
-        url = 'https://api.weixin.qq.com/sns/oauth2/access_token'
-
         appid = secret = ''
 
         if args['wxtype'] == 'gz':
@@ -122,18 +126,15 @@ class WxAuthApi(Resource):
 
         try:
             # step 2: get access_token from wechat serves.
-            data = requests.get(url, params=params).json()
+            data = wx.get('/sns/oauth2/access_token', token=False, params=params)
             if 'access_token' in data:
-                url = "https://api.weixin.qq.com/sns/userinfo"
                 params = {
                     "access_token": data['access_token'],
                     "openid": data['openid'],
                 }
                 try:
                     # step 3: get userinfo with access_token from wechat serves.
-                    res = requests.get(url, params=params)
-                    res.encoding = 'utf-8'
-                    data = res.json()
+                    data = wx.get('/sns/userinfo', token=False, params=params)
                     if 'unionid' in data:
                         return accessUser(data)
                     else:
@@ -151,14 +152,10 @@ class WxAuthApi(Resource):
 @n_wechat.route('/token')
 class WxTokenApi(Resource):
     def post(self):
-        scheduler.add_job(
-            id='update_wechat_access_token',
-            func=getAccessToken,
-            trigger='interval',
-            minutes=110,
-            replace_existing=True,
-            misfire_grace_time=2592000
-        )
+        # tokens are refreshed on demand by wx.accessToken, drop the interval
+        # job earlier versions registered here
+        if scheduler.get_job('update_wechat_access_token'):
+            scheduler.remove_job('update_wechat_access_token')
 
         return getAccessToken()
 
@@ -177,16 +174,11 @@ class WxLoginApi(Resource):
         openid = openid.decode('UTF-8')
         # print(openid)
         if openid != 'None':
-            option = Option.query.filter_by(name='wechat_access_token').first()
-            url = "https://api.weixin.qq.com/cgi-bin/user/info"
             params = {
-                "access_token": option.value,
                 "openid": openid,
             }
             try:
-                res = requests.get(url, params=params)
-                res.encoding = 'utf-8'
-                data = res.json()
+                data = wx.get('/cgi-bin/user/info', params=params)
                 if 'unionid' in data:
                     return accessUser(data)
                 else:
@@ -202,11 +194,6 @@ class WxLoginApi(Resource):
 @n_wechat.route('/menu')
 class WxMenuApi(Resource):
     def post(self):
-        option = Option.query.filter_by(name='wechat_access_token').first()
-        url = "https://api.weixin.qq.com/cgi-bin/menu/create"
-        params = {
-            "access_token": option.value,
-        }
         data = {
             "button": [
                 {
@@ -249,9 +236,8 @@ class WxMenuApi(Resource):
             ]
         }
         try:
-            res = requests.post(url, params=params, data=json.dumps(
+            data = wx.post('/cgi-bin/menu/create', data=json.dumps(
                 data, ensure_ascii=False).encode('utf-8'))
-            data = res.json()
             return data, 200
 
         except Exception as e:
@@ -263,11 +249,6 @@ class WxMenuApi(Resource):
 class WxQrcodeApi(Resource):
     def get(self):
         scene_str = 'login_'+str(shortuuid.uuid())
-        option = Option.query.filter_by(name='wechat_access_token').first()
-        if not option:
-            getAccessToken()
-
-        url = 'https://api.weixin.qq.com/cgi-bin/qrcode/create?access_token=%s' % option.value
         data = {
             "expire_seconds": 604800,
             "action_name": "QR_STR_SCENE",
@@ -278,7 +259,7 @@ class WxQrcodeApi(Resource):
         r_db.set(scene_str, 'None')
         try:
             # json.dumps for json format. Otherwise, wechat will return error.
-            data = requests.post(url, data=json.dumps(data)).json()
+            data = wx.post('/cgi-bin/qrcode/create', data=json.dumps(data))
             if 'ticket' in data:
                 return {'ticket': data['ticket'], 'scene_str': scene_str}, 200
             else:
@@ -289,31 +270,16 @@ class WxQrcodeApi(Resource):
 
 
 def getAccessToken():
-    url = 'https://api.weixin.qq.com/cgi-bin/token?grant_type=client_credential&appid=%s&secret=%s' % (
-        app.config['WECHAT_GZ_APPID'],
-        app.config['WECHAT_GZ_APPSECRET']
-    )
+    """The current access token, shared with every other caller of wx."""
     try:
-        data = requests.get(url).json()
-        if 'access_token' in data:
-            print(data['access_token'])
-            option = Option.query.filter_by(name='wechat_access_token').first()
-            if option:
-                option.value = data['access_token']
-            else:
-                new_option = Option(
-                    name='wechat_access_token',
-                    value=data['access_token']
-                )
-                db.session.add(new_option)
-            db.session.commit()
-            return data, 200
-        else:
-            return data, 400
-
+        access_token = wx.accessToken()
     except Exception as e:
         print(e)
         return api.abort(400, "bad connection")
+    if not access_token:
+        return api.abort(400, "no access token")
+    expires_in = getOption('wechat_access_token_expires', 0, int) - int(time.time())
+    return {'access_token': access_token, 'expires_in': expires_in}, 200
 
 
 def accessUser(data):
@@ -321,19 +287,22 @@ def accessUser(data):
     # check if the wechat unionid is already registed on our serves
     if wx_user:  # if so, update his info
         try:
-            wx_user.openid = data['openid'],
-            wx_user.nickname = data['nickname'],
-            wx_user.sex = data['sex'],
-            wx_user.language = data['language'],
-            wx_user.city = data['city'],
-            wx_user.province = data['province'],
-            wx_user.country = data['country'],
-            wx_user.headimg_url = data['headimgurl'],
+            wx_user.openid = data['openid']
+            wx_user.nickname = data['nickname']
+            wx_user.sex = data['sex']
+            wx_user.language = data['language']
+            wx_user.city = data['city']
+            wx_user.province = data['province']
+            wx_user.country = data['country']
+            wx_user.headimg_url = data['headimgurl']
             wx_user.unionid = data['unionid']
             db.session.commit()
         except Exception as e:
             print(e)
             api.abort(400, "update user failed")
+        userUpdated(wx_user.bind_user_id)
+        # the avatar shows on the projects of the user
+        projectsUpdated(userProjects(wx_user.bind_user_id))
     else:  # otherwise, create a new one
         try:
             wx_user = WxUser.create_wx_user(data)
@@ -342,10 +311,125 @@ def accessUser(data):
             api.abort(400, "create user failed")
 
     # generate a jwt based on user id
-    token = jwt.encode({'id': wx_user.bind_user_id, 'exp': datetime.utcnow(
-    )+timedelta(days=24)}, app.config['SECRET_KEY'])
+    token = issueToken(wx_user.bind_user_id)
 
     return {
-        'token': token.decode('UTF-8'),
+        'token': token,
         'wx_info': data
     }, 200
+
+
+# WeChat errcodes: calls over the quota, worth retrying later, or neither
+WX_LIMITED = [45009, 45011, 45047]
+WX_RETRY = [-1]
+
+
+def postWxMessage(access_token, payload):
+    """Send one template message. Returns (result, error), result is one of
+    'sent', 'limited', 'expired', 'retry' or 'failed'."""
+    try:
+        res = wx.request('POST', '/cgi-bin/message/template/send', access_token,
+                         data=payload.encode('utf-8'))
+        if res.status_code == 429:
+            return 'limited', 'HTTP 429'
+        data = res.json()
+    except Exception as e:
+        return 'retry', str(e)[:256]
+
+    errcode = data.get('errcode', 0)
+    if errcode == 0:
+        return 'sent', None
+    error = '%s %s' % (errcode, data.get('errmsg', ''))
+    if errcode in WX_LIMITED:
+        return 'limited', error[:256]
+    if errcode in TOKEN_EXPIRED:
+        return 'expired', error[:256]
+    if errcode in WX_RETRY:
+        return 'retry', error[:256]
+    return 'failed', error[:256]
+
+
+def claimWxOutbox(limit, lease):
+    """Due outbox rows this worker got. A row is claimed by moving its
+    next_try_date past the lease, so a crashed worker's rows come back."""
+    now = datetime.utcnow()
+    due = WxOutbox.query\
+        .filter(WxOutbox.status == 'pending', WxOutbox.next_try_date <= now)\
+        .order_by(WxOutbox.id).limit(limit).all()
+    claimed = []
+    for message in due:
+        if WxOutbox.query.filter_by(id=message.id, next_try_date=message.next_try_date)\
+                .update({'next_try_date': now + timedelta(seconds=lease)}, synchronize_session=False):
+            claimed.append(message)
+    db.session.commit()
+    return claimed
+
+
+@celery.task(bind=True, ignore_result=True)
+def sendWxOutbox(self):
+    """Send the due WeChat messages of the outbox.
+
+    WX_OUTBOX_CONCURRENCY messages are in flight at once. A failed send is
+    retried with exponential backoff up to WX_OUTBOX_MAX_ATTEMPTS times, and
+    when WeChat says we are over the quota the rest of the batch waits
+    WX_OUTBOX_LIMIT_DELAY seconds without using up an attempt.
+    """
+    concurrency = app.config.get('WX_OUTBOX_CONCURRENCY', 4)
+    max_attempts = app.config.get('WX_OUTBOX_MAX_ATTEMPTS', 5)
+    claimed = claimWxOutbox(app.config.get('WX_OUTBOX_BATCH', 50), 300)
+
+    access_token = wx.accessToken() if claimed else None
+    limited = False
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for i in range(0, len(claimed), concurrency):
+            chunk = claimed[i:i+concurrency]
+            now = datetime.utcnow()
+            if limited:
+                results = [('limited', None)] * len(chunk)
+            elif not access_token:
+                results = [('retry', 'no access token')] * len(chunk)
+            else:
+                payloads = [message.payload for message in chunk]
+                results = list(pool.map(
+                    lambda payload: postWxMessage(access_token, payload), payloads))
+                expired = [j for j, (result, _) in enumerate(results) if result == 'expired']
+                if expired:
+                    # once more with a new token, the rest of the batch uses it too
+                    access_token = wx.accessToken(stale=access_token)
+                    if access_token:
+                        for j, result in zip(expired, pool.map(
+                                lambda j: postWxMessage(access_token, payloads[j]), expired)):
+                            results[j] = result
+
+            for message, (result, error) in zip(chunk, results):
+                if result == 'sent':
+                    message.status = 'sent'
+                    message.sent_date = now
+                    print('Send wx message to user {}.'.format(message.to_user_id))
+                    continue
+                message.error = error or message.error
+                if result == 'limited':
+                    limited = True
+                    message.next_try_date = now + timedelta(
+                        seconds=app.config.get('WX_OUTBOX_LIMIT_DELAY', 60))
+                    continue
+                message.attempts += 1
+                if result == 'failed' or message.attempts >= max_attempts:
+                    message.status = 'failed'
+                else:
+                    message.next_try_date = now + timedelta(seconds=30 * 2 ** (message.attempts-1))
+            db.session.commit()
+
+    if self.request.is_eager:
+        return
+    # come back when the next row is due, one wake-up queued at a time
+    next_try = db.session.query(func.min(WxOutbox.next_try_date))\
+        .filter(WxOutbox.status == 'pending').scalar()
+    if not next_try:
+        return
+    if next_try <= datetime.utcnow():
+        self.apply_async()
+        return
+    countdown = int((next_try - datetime.utcnow()).total_seconds()) + 1
+    if cacheAdd('wx_outbox:wakeup', next_try.isoformat(), countdown):
+        self.apply_async(countdown=countdown)
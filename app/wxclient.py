@@ -0,0 +1,130 @@
+"""
+WeChat API client
+
+All calls to api.weixin.qq.com go through one keep-alive session per process,
+with WECHAT_TIMEOUT on every request. WECHAT_API_URL points it elsewhere,
+`flask wechat-stub` serves a fake WeChat for development.
+
+The access token is kept in the wechat_access_token option, shared by every
+process (see model.misc.getOption). It is refreshed WECHAT_TOKEN_MARGIN
+seconds before it expires, or when WeChat says it is no longer valid; one
+process refreshes while the others wait for the new option.
+"""
+from . import app
+from .cache import cacheAdd, cacheGet, cacheDelete
+from .model.misc import getOption, setOption
+from requests.adapters import HTTPAdapter
+import json
+import os
+import requests
+import threading
+import time
+
+# errcodes of an access token that is invalid or expired
+TOKEN_EXPIRED = [40001, 42001]
+
+
+class WeChatClient:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self._session = None
+
+    @property
+    def session(self):
+        # one per process, a forked celery child must not share the sockets
+        if self.pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=app.config.get('WECHAT_POOL_SIZE', 10))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session, self.pid = session, os.getpid()
+        return self._session
+
+    def request(self, method, path, access_token=None, params=None, **kwargs):
+        """Plain request to the WeChat API, returns the requests Response."""
+        params = dict(params or {})
+        if access_token:
+            params['access_token'] = access_token
+        return self.session.request(
+            method, app.config.get('WECHAT_API_URL', 'https://api.weixin.qq.com') + path,
+            params=params, timeout=app.config.get('WECHAT_TIMEOUT', 5), **kwargs)
+
+    def call(self, method, path, token=True, **kwargs):
+        """Request returning the decoded JSON.
+
+        With token the access token is added, and the call is made once more
+        with a new one when WeChat turns it down.
+        """
+        access_token = self.accessToken() if token else None
+        data = self._json(self.request(method, path, access_token, **kwargs))
+        if token and data.get('errcode') in TOKEN_EXPIRED:
+            access_token = self.accessToken(stale=access_token)
+            data = self._json(self.request(method, path, access_token, **kwargs))
+        return data
+
+    def get(self, path, token=True, **kwargs):
+        return self.call('GET', path, token, **kwargs)
+
+    def post(self, path, token=True, **kwargs):
+        return self.call('POST', path, token, **kwargs)
+
+    @staticmethod
+    def _json(res):
+        return json.loads(res.content.decode('utf-8'))
+
+    def refreshToken(self):
+        """Fetch a new access token and share it, returns WeChat's answer."""
+        data = self.get('/cgi-bin/token', token=False, params={
+            'grant_type': 'client_credential',
+            'appid': app.config['WECHAT_GZ_APPID'],
+            'secret': app.config['WECHAT_GZ_APPSECRET'],
+        })
+        if 'access_token' in data:
+            setOption('wechat_access_token_expires', int(time.time()) + data.get('expires_in', 7200))
+            setOption('wechat_access_token', data['access_token'])
+        return data
+
+    def _current(self, stale):
+        token = getOption('wechat_access_token')
+        expires = getOption('wechat_access_token_expires', 0, int)
+        margin = app.config.get('WECHAT_TOKEN_MARGIN', 300)
+        if token and token != stale and time.time() < expires - margin:
+            return token
+
+    def accessToken(self, stale=None):
+        """A valid access token, None if none can be had.
+
+        stale is a token WeChat just refused, it gets replaced even if it
+        hasn't expired yet.
+        """
+        token = self._current(stale)
+        if token:
+            return token
+        with self.lock:
+            # threads of this process queued behind the one refreshing
+            token = self._current(stale)
+            if token:
+                return token
+            timeout = app.config.get('WECHAT_TIMEOUT', 5)
+            if cacheAdd('wechat:token_refresh', os.getpid(), timeout * 2):
+                try:
+                    return self.refreshToken().get('access_token')
+                finally:
+                    cacheDelete('wechat:token_refresh')
+            # another process is refreshing, its option update is pushed here
+            deadline = time.time() + timeout * 2
+            while time.time() < deadline:
+                time.sleep(0.1)
+                token = self._current(stale)
+                if token:
+                    return token
+                if cacheGet('wechat:token_refresh') is None:
+                    # its refresh failed, or Redis is down and nobody holds
+                    # the lock
+                    break
+            return self.refreshToken().get('access_token')
+
+
+wx = WeChatClient()
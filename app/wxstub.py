@@ -0,0 +1,70 @@
+"""
+WeChat API stub
+
+A Flask app standing in for api.weixin.qq.com, served by `flask wechat-stub`
+for development and in-process by the tests. Point WECHAT_API_URL at it.
+
+Its state is kept on the app: tokens handed out, with their expiry, the
+template messages it accepted, and answers, errcodes (or 429 for HTTP 429)
+the next template sends get instead of a success.
+"""
+from flask import Flask, json, request
+from datetime import datetime, timedelta
+from . import app
+
+
+def wechatStub(limit=0, expires_in=7200):
+    """The stub app, limit is messages a second before it answers 45009, 0 for no limit."""
+    stub = Flask('wechat_stub')
+    stub.tokens = []
+    stub.messages = []
+    stub.answers = []
+    sent = []
+
+    @stub.route('/cgi-bin/token')
+    def token():
+        stub.tokens.append(['stub-token-%d' % len(stub.tokens),
+                            datetime.utcnow() + timedelta(seconds=expires_in)])
+        return json.jsonify(access_token=stub.tokens[-1][0], expires_in=expires_in)
+
+    @stub.before_request
+    def checkToken():
+        # only the latest token is valid
+        if request.path == '/cgi-bin/token' or request.path.startswith('/sns/'):
+            return
+        if not stub.tokens or request.args.get('access_token') != stub.tokens[-1][0]:
+            return json.jsonify(errcode=40001, errmsg='invalid credential')
+        if stub.tokens[-1][1] < datetime.utcnow():
+            return json.jsonify(errcode=42001, errmsg='access_token expired')
+
+    @stub.route('/cgi-bin/message/template/send', methods=['POST'])
+    def send():
+        if stub.answers:
+            answer = stub.answers.pop(0)
+            if answer == 429:
+                return 'too many requests', 429
+            return json.jsonify(errcode=answer, errmsg='stub answer')
+        now = datetime.utcnow()
+        sent[:] = [date for date in sent if now - date < timedelta(seconds=1)]
+        if limit and len(sent) >= limit:
+            return json.jsonify(errcode=45009, errmsg='api freq out of limit')
+        sent.append(now)
+        stub.messages.append(request.get_data(as_text=True))
+        app.logger.debug('wechat stub message: %s', stub.messages[-1])
+        return json.jsonify(errcode=0, errmsg='ok', msgid=len(stub.messages))
+
+    @stub.route('/cgi-bin/user/info')
+    def userInfo():
+        return json.jsonify(openid=request.args['openid'], unionid='union-' + request.args['openid'],
+                            nickname='stub', sex=0, language='zh_CN', city='', province='',
+                            country='', headimgurl='')
+
+    @stub.route('/cgi-bin/menu/create', methods=['POST'])
+    def menu():
+        return json.jsonify(errcode=0, errmsg='ok')
+
+    @stub.route('/cgi-bin/qrcode/create', methods=['POST'])
+    def qrcode():
+        return json.jsonify(ticket='stub-ticket', expire_seconds=604800, url='')
+
+    return stub
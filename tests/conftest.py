@@ -0,0 +1,87 @@
+"""
+Test setup
+
+The app reads its settings from the config module. The tests build it from
+config.example with a SQLite file, the local cache, in-memory jobs and eager
+celery tasks, so neither MySQL nor Redis is needed.
+"""
+import os
+import sys
+import tempfile
+import threading
+import types
+import pytest
+from apscheduler.jobstores.memory import MemoryJobStore
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'test.db')
+
+config = types.ModuleType('config')
+with open(os.path.join(ROOT, 'config.example')) as f:
+    exec(compile(f.read(), 'config.example', 'exec'), config.__dict__)
+for name, value in {
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + DB_FILE,
+    'SECRET_KEY': 'test',
+    'CACHE_BACKEND': 'local',
+    'SCHEDULER_JOBSTORES': {'default': MemoryJobStore()},
+    'CELERY_ALWAYS_EAGER': True,
+    'CELERY_RESULT_BACKEND': 'cache+memory://',
+    # nothing listens there
+    'WECHAT_API_URL': 'http://127.0.0.1:9',
+    'WECHAT_TIMEOUT': 1,
+    'UPLOAD_FOLDER': os.path.join(os.path.dirname(DB_FILE), 'upload/'),
+    'DOWNLOAD_FOLDER': os.path.join(os.path.dirname(DB_FILE), 'download/'),
+}.items():
+    setattr(config.TestingConfig, name, value)
+sys.modules['config'] = config
+sys.path.insert(0, ROOT)
+os.environ['FLASK_ENV'] = 'testing'
+
+from app import app, db  # noqa: E402
+from app.cache import local_cache  # noqa: E402
+from app.model import Role, Option, User  # noqa: E402
+from app.model.misc import OPTIONS_PID  # noqa: E402
+from app.model.post import TAG_IDS  # noqa: E402
+from app.wxstub import wechatStub  # noqa: E402
+
+
+@pytest.fixture
+def database():
+    """Empty tables with the roles and options, in an app context."""
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        # process caches of the rows just dropped
+        local_cache.data.clear()
+        TAG_IDS.clear()
+        OPTIONS_PID[0] = None
+        Role.insert_roles()
+        Option.init_option()
+        yield db
+        db.session.remove()
+
+
+@pytest.fixture
+def client(database):
+    return app.test_client()
+
+
+@pytest.fixture
+def wechat(database):
+    """The WeChat stub served on a free port, WECHAT_API_URL points at it."""
+    stub = wechatStub()
+    server = make_server('127.0.0.1', 0, stub, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = app.config['WECHAT_API_URL']
+    app.config['WECHAT_API_URL'] = 'http://127.0.0.1:%d' % server.server_port
+    yield stub
+    app.config['WECHAT_API_URL'] = url
+    server.shutdown()
+
+
+def makeUser(index, role_id=3):
+    return User.create_user(login='user%d' % index, password='password', name='user%d' % index,
+                            role_id=role_id, email='user%d@test' % index, phone='%d' % index)
@@ -0,0 +1,71 @@
+"""Keyset pagination of the project listing gives the same pages as the full listing."""
+from datetime import datetime, timedelta
+import pytest
+from app import db
+from app.model import Project
+from app.restful.projects import GET_PROJECT
+from conftest import makeUser
+
+ORDER_BY = [arg.choices for arg in GET_PROJECT.args if arg.name == 'order_by'][0]
+
+
+@pytest.fixture
+def projects(client):
+    admin = makeUser(0, role_id=1)
+    users = [makeUser(index) for index in range(1, 4)]
+    stages = [{'stage_name': 'stage', 'days_planned': 3}]
+    for i in range(14):
+        # repeated titles, creators and clients to break ties on
+        project = Project.create_project(admin.id, 'title %d' % (i % 4), users[i % 2].id,
+                                         users[i % 3].id, '', stages, [], [])
+        if i % 4 == 0:
+            # not started, no start or deadline date
+            continue
+        project.doStart(admin.id)
+        if i % 4 == 2:
+            project.doPause(admin.id)
+        elif i % 4 == 3:
+            project.doUpload(admin.id, project.creator_user_id, 'upload', [], [])
+            if i % 8 == 3:
+                project.doFeedback(admin.id, project.client_user_id, 'pass', None, 1)
+        if i % 5 == 1 and project.progress > 0:
+            project.doChangeDDL(admin.id, datetime.utcnow() - timedelta(days=i))
+    return client
+
+
+def listing(client, **args):
+    response = client.get('/api/projects', query_string=dict(args, fields='id'))
+    return response.status_code, response.get_json()
+
+
+def walk(client, order_by, order):
+    """Ids of every page by cursor, 4 at a time."""
+    ids = []
+    status, data = listing(client, order_by=order_by, order=order, pre_page=4)
+    while True:
+        assert status == 200 and data['total'] == 14
+        ids += [project['id'] for project in data['projects']]
+        if not data.get('next_cursor'):
+            return ids
+        status, data = listing(client, order_by=order_by, order=order, pre_page=4,
+                               cursor=data['next_cursor'])
+
+
+def test_cursor(projects):
+    for order_by in ORDER_BY:
+        for order in ('asc', 'desc'):
+            status, data = listing(projects, order_by=order_by, order=order, pre_page=100)
+            assert status == 200 and data['total'] == 14
+            expected = [project['id'] for project in data['projects']]
+            assert sorted(expected) == list(range(1, 15))
+            assert walk(projects, order_by, order) == expected, (order_by, order)
+
+
+def test_bad_cursor(projects):
+    status, data = listing(projects, order_by='title', order='asc', pre_page=4)
+    cursor = data['next_cursor']
+    assert listing(projects, order_by='title', order='asc', pre_page=4, cursor=cursor)[0] == 200
+    assert listing(projects, order_by='title', order='desc', pre_page=4, cursor=cursor)[0] == 400
+    assert listing(projects, order_by='status', order='asc', pre_page=4, cursor=cursor)[0] == 400
+    assert listing(projects, order_by='title', order='asc', pre_page=4, cursor='bm90IGpzb24=')[0] == 400
+    assert listing(projects, order_by='title', order='asc', pre_page=4, cursor='%%%')[0] == 400
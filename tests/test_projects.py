@@ -0,0 +1,90 @@
+"""Cached project documents follow the users and files they show."""
+import json
+from datetime import timedelta
+import pytest
+from app import db
+from app.model import Project, User, File
+from app.model.project import projectsUpdated, userProjects, fileProjects
+from app.restful.projects import projectDoc
+from conftest import makeUser
+
+
+@pytest.fixture
+def projects(database):
+    admin = makeUser(0, role_id=1)
+    creator = makeUser(1)
+    client = makeUser(2)
+    other = makeUser(3)
+    files = [File(uploader_user_id=admin.id, name='file%d' % i, format='png',
+                  url='2020/01/01/file%d.png' % i) for i in range(3)]
+    db.session.add_all(files)
+    db.session.commit()
+    stages = [{'stage_name': 'stage', 'days_planned': 3}]
+    first = Project.create_project(admin.id, 'first', client.id, creator.id, '', stages, [], [files[0].id])
+    first.doStart(admin.id)
+    first.doUpload(admin.id, creator.id, 'upload', [files[1].id], [])
+    # the other user only uploads on this one
+    second = Project.create_project(admin.id, 'second', client.id, creator.id, '', stages, [], [])
+    second.doStart(admin.id)
+    second.doUpload(admin.id, other.id, 'upload', [], [{'id': files[2].id}])
+    return [first.id, second.id], [admin.id, creator.id, client.id, other.id], [f.id for f in files]
+
+
+def test_members(projects):
+    (first, second), (admin, creator, client, other), files = projects
+    assert userProjects(admin) == {first, second}
+    assert userProjects(client) == {first, second}
+    assert userProjects(other) == {second}
+    assert userProjects(other + 1) == set()
+    assert [fileProjects(_id) for _id in files] == [{first}, {first}, {second}]
+
+
+def test_doc(projects):
+    (first, second), users, files = projects
+    other = users[3]
+    assert 'user3' in projectDoc(second)
+    before = projectDoc(first)
+    User.query.get(other).name = 'renamed'
+    db.session.commit()
+    # still the stored version
+    assert 'user3' in projectDoc(second)
+    projectsUpdated(userProjects(other))
+    assert 'renamed' in projectDoc(second)
+    assert projectDoc(first) == before
+    assert json.loads(projectDoc(second))['id'] == second
+
+
+def test_resume_unlinked(projects):
+    (first, second), users, files = projects
+    project = Project.query.get(second)
+    project.doPause(users[0])
+    phase = project.current_phase()
+    deadline = phase.deadline_date
+    pause = phase.open_pause
+    pause.pause_date -= timedelta(hours=2)
+    # paused before the open pause was kept on the phase
+    phase.open_pause = None
+    db.session.commit()
+
+    project.doResume(users[0])
+    assert pause.resume_date is not None
+    assert phase.deadline_date - deadline >= timedelta(hours=2)
+    assert project.deadline_date == phase.deadline_date
+    assert not project.pause
+
+
+@pytest.mark.parametrize('fields', ['id,status', 'id,stages{name},creator{name}'])
+def test_mask_fallback(projects, monkeypatch, fields):
+    from app.restful import projects as restful
+    ids = projects[0]
+    items = Project.query.filter(Project.id.in_(ids)).order_by(Project.id).all()
+    listing = {'projects': items, 'total': 2, 'next_cursor': None}
+    mask = restful.projectMask({'fields': fields})
+    compiled = [restful.projectSerializer(mask, True)(listing), restful.projectSerializer(mask)(items[0])]
+    # every mask seen from now on is marshalled instead
+    monkeypatch.setattr(restful, 'MAX_MASKS', 0)
+    monkeypatch.setattr(restful, '_MASKED', {})
+    marshalled = [restful.projectSerializer(mask, True)(listing), restful.projectSerializer(mask)(items[0])]
+    assert json.dumps(marshalled) == json.dumps(compiled)
+    assert [project['id'] for project in marshalled[0]['projects']] == ids
+    assert sorted(marshalled[1]) == sorted(field.split('{')[0] for field in fields.split(','))
@@ -0,0 +1,84 @@
+"""Compiled serializers give the same JSON as marshal()."""
+import json
+import pytest
+from flask_restplus import marshal
+from app import db
+from app.model import Project, User, File, Preview, Group, WxUser
+from app.restful.serializer import compileModel
+from app.restful.projects import M_PROJECT, M_PROJECTS, M_PROJECT_MIN, L_PROJECT, L_PROJECT_MIN
+from app.restful.users import M_USER, M_USERS, L_USER
+from conftest import makeUser
+
+
+def dumps(data):
+    return json.dumps(data, ensure_ascii=False, sort_keys=True)
+
+
+def assertSame(model, data):
+    for skip_none in (False, True):
+        assert dumps(compileModel(model, skip_none)(data)) == \
+            dumps(marshal(data, model, skip_none=skip_none))
+
+
+@pytest.fixture
+def fixture(database):
+    admin = makeUser(0, role_id=1)
+    creator = makeUser(1)
+    client = makeUser(2)
+    # a wx avatar, a file avatar and none at all
+    admin.wx_user = WxUser(openid='openid', nickname='nick', headimg_url='http://img')
+    avatar = File(uploader_user_id=creator.id, name='avatar', format='png', url='2020/01/01/avatar.png')
+    db.session.add(avatar)
+    creator.avatar = avatar
+    group = Group(name='group', description='')
+    group.users = [admin, creator]
+    group.admins = [admin]
+    admin.followed_users = [creator]
+    files = [File(uploader_user_id=admin.id, name='file%d' % i, format='png',
+                  url='2020/01/01/file%d.png' % i, public=bool(i % 2)) for i in range(3)]
+    db.session.add_all(files)
+    db.session.commit()
+    db.session.add(Preview(bind_file_id=files[0].id, url='2020/01/01/file0.png_256.jpg', size=256))
+    db.session.commit()
+
+    stages = [{'stage_name': '草图', 'days_planned': 3}, {'stage_name': '成图', 'days_planned': 5}]
+    started = Project.create_project(admin.id, 'started', client.id, creator.id, '<p>design</p>',
+                                     stages, ['tag 样图'], [files[0].id])
+    started.doStart(admin.id)
+    started.doUpload(admin.id, creator.id, 'upload', [files[1].id], [{'id': files[2].id}])
+    started.doFeedback(admin.id, client.id, 'feedback', None, 0)
+    started.doPause(admin.id)
+    waiting = Project.create_project(admin.id, 'waiting', client.id, creator.id, '', stages, [], [])
+    # a relationship left empty
+    waiting.client_user_id = None
+    db.session.commit()
+    db.session.expire_all()
+    return [started.id, waiting.id]
+
+
+def test_project(fixture):
+    projects = Project.query.filter(Project.id.in_(fixture)).order_by(Project.id).all()
+    assertSame(M_PROJECT, projects)
+    assertSame(M_PROJECT_MIN, projects)
+    assertSame(M_PROJECTS, {'projects': projects, 'total': 2, 'next_cursor': None})
+
+
+def test_project_loaded(fixture):
+    for options, model in ((L_PROJECT, M_PROJECT), (L_PROJECT_MIN, M_PROJECT_MIN)):
+        db.session.expire_all()
+        projects = Project.query.options(*options).filter(Project.id.in_(fixture)).all()
+        assertSame(model, projects)
+
+
+def test_user(fixture):
+    users = User.query.options(*L_USER).order_by(User.id).all()
+    assertSame(M_USER, users)
+    assertSame(M_USERS, {'users': users, 'total': len(users), 'next_cursor': 'cursor'})
+
+
+def test_dict(fixture):
+    # missing keys and None relationships in plain dicts
+    user = User.query.options(*L_USER).first()
+    assertSame(M_USERS, {'users': [user], 'total': None})
+    assertSame(M_USERS, {'users': None, 'next_cursor': 'cursor'})
+    assertSame(M_PROJECTS, {'projects': [], 'total': 0})
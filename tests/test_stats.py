@@ -0,0 +1,314 @@
+"""The grouped work metrics agree with the loop over stages and phases they replaced."""
+import math
+import random
+from datetime import datetime, timedelta
+import pytest
+from numpy import interp, clip
+from sqlalchemy import and_
+from sqlalchemy.orm import selectinload
+from app import db
+from app.model import Project, Stage, Phase, ProjectPause, File, Tag, User
+from app.model.post import resolveTags
+from app.model.stats import rollupStats
+from app.restful.utility import getData, getAttr, getStats, getStatsColumns, getAttrs
+from conftest import makeUser
+
+BASE = datetime(2020, 6, 1)
+RANGES = [None, ['2020-06-10 00:00:00', '2020-08-01 00:00:00'], ['2020-07-01 00:00:00', '2020-07-03 00:00:00']]
+COUNTS = ['overtime_sum', 'phases_overtime', 'phases_all', 'phases_pass', 'phases_modify', 'phases_pending',
+          'stages_all', 'stages_one_pass_c', 'stages_mod_pass_c', 'stages_no_pass_c', 'stages_one_pass_d',
+          'stages_mod_pass_d', 'stages_no_pass_d', 'files_ref', 'project_sample']
+
+
+def loopData(user_id, date_range=None):
+    """getData as it was, loading every stage and phase."""
+    user = User.query.get(user_id)
+    if date_range:
+        start = datetime.strptime(date_range[0], '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(date_range[1], '%Y-%m-%d %H:%M:%S')
+    else:
+        start = user.reg_date
+        end = datetime.utcnow()
+    data = {key: [] for key in COUNTS}
+    data.update(user=user, delta_time=end-start, overtime_sum=0)
+
+    data['stages_all'] = Stage.query\
+        .filter(Stage.phases.any(and_(Phase.upload_date <= end, Phase.upload_date >= start)))\
+        .filter(Stage.phases.any(Phase.creator_user_id == user_id)).all()
+    for stage in data['stages_all']:
+        kind = 'd' if stage.name == '草图' else 'c'
+        if not stage.phases[-1].feedback_date:
+            data['stages_no_pass_' + kind].append(stage)
+        elif len(stage.phases) > 1:
+            data['stages_mod_pass_' + kind].append(stage)
+        else:
+            data['stages_one_pass_' + kind].append(stage)
+
+    data['phases_all'] = Phase.query\
+        .filter(and_(Phase.upload_date <= end, Phase.upload_date >= start))\
+        .filter(Phase.creator_user_id == user_id).all()
+    for phase in data['phases_all']:
+        if phase.feedback_date:
+            if phase.stage.phases[-1] == phase:
+                data['phases_pass'].append(phase)
+            else:
+                data['phases_modify'].append(phase)
+        else:
+            data['phases_pending'].append(phase)
+        duration_in_s = int((phase.upload_date - phase.deadline_date).total_seconds())
+        if duration_in_s > 0:
+            data['phases_overtime'].append(phase)
+            data['overtime_sum'] += duration_in_s
+
+    data['files_ref'] = File.query.options(selectinload(File.tags))\
+        .filter(File.public == True)\
+        .filter(and_(File.upload_date <= end, File.upload_date >= start))\
+        .filter(File.uploader_user_id == user_id).all()
+    data['project_sample'] = Project.query.filter(Project.tags.any(Tag.name == '样图'))\
+        .filter(and_(Project.finish_date <= end, Project.finish_date >= start))\
+        .filter(Project.phases.any(Phase.creator_user_id == user_id)).all()
+    return data
+
+
+def loopAttr(data_raw):
+    """getAttr as it was, over the lists of loopData."""
+    def passed(stages):
+        phases_count = sum(len(stage.phases) for stage in stages)
+        if not stages:
+            return 0
+        value = clip(1-phases_count/(len(stages)*5), 0, 4/5)
+        return interp(value, [0, 4/5], [1, 5])
+
+    stages_c = data_raw['stages_one_pass_c'] + data_raw['stages_mod_pass_c']
+    stages_d = data_raw['stages_one_pass_d'] + data_raw['stages_mod_pass_d']
+    knowledge = passed(stages_d)
+    power = (knowledge*1 + passed(stages_c)*2)/3
+
+    phases_all = data_raw['phases_all']
+    delta_days = data_raw['delta_time'].days
+    if phases_all and delta_days >= 1:
+        ud_total = timedelta(seconds=0)
+        dd_total = timedelta(seconds=0)
+        for phase in sorted(phases_all, key=lambda x: x.upload_date):
+            pd = timedelta(seconds=0)
+            for pause in phase.pauses:
+                if phase.upload_date > pause.pause_date and pause.resume_date:
+                    pd += pause.resume_date - pause.pause_date
+            ud_total += phase.upload_date - phase.start_date - pd
+            dd_total += phase.deadline_date - phase.start_date - pd
+        speed = math.atan(dd_total.total_seconds()*0.8/ud_total.total_seconds())/(math.pi/2)
+        speed = interp(speed, [0, 1], [0, 5])
+        energy = interp(clip(len(phases_all)*1.8/delta_days, 0, 2), [0, 2], [1, 5])
+    else:
+        energy = 0
+        speed = 0
+
+    files_ref = data_raw['files_ref']
+    files_s = sum(1 if len(f.tags) < 4 else 3 if len(f.tags) < 6 else 5 if len(f.tags) < 8
+                  else 6 if len(f.tags) < 10 else 7 for f in files_ref)
+    files_s2 = sum(1 if len(f.tags) < 4 else 2 if len(f.tags) < 7 else 3 for f in files_ref)
+    project_sample = len(data_raw['project_sample'])
+    contribution_s = (len(stages_d)+len(stages_c))*10 + files_s + project_sample*20
+    if delta_days >= 1 and contribution_s > 0:
+        contribution = interp(clip(contribution_s/delta_days/6, 0, 2), [0, 2], [1, 5])
+    else:
+        contribution = 0
+    score = len(stages_d)*10+len(stages_c)*20 + files_s2 + project_sample*30 - data_raw['overtime_sum']/86400
+    return {
+        'power': round(power, 1),
+        'speed': round(speed, 1),
+        'knowledge': round(knowledge, 1),
+        'energy': round(energy, 1),
+        'contribution': round(contribution, 1),
+        'score': round(max(score, 0)),
+    }
+
+
+def buildProjects(n_projects=30, seed=1):
+    """Projects in every state, dates spread over the summer of 2020, returns the users."""
+    random.seed(seed)
+    users = [makeUser(0, role_id=2)] + [makeUser(index) for index in range(1, 6)]
+    files = [File(uploader_user_id=users[0].id, name='file%d' % i, format='png',
+                  url='2020/01/01/file%d.png' % i, public=bool(i % 2)) for i in range(12)]
+    db.session.add_all(files)
+    db.session.commit()
+    stages = [{'stage_name': '草图', 'days_planned': 3}, {'stage_name': '成图', 'days_planned': 5}]
+    admin = users[0].id
+    for i in range(n_projects):
+        project = Project.create_project(admin, 'project %d' % i, admin, users[1 + i % 5].id, '', stages,
+                                         ['样图'] if i % 7 == 0 else ['tag'], [])
+        if i % 5 == 0:
+            continue
+        project.doStart(admin)
+        for k in range(i % 4):
+            project.doUpload(admin, project.creator_user_id, 'upload', [], [{'id': files[(i+k) % 12].id}])
+            project.doFeedback(admin, admin, 'feedback', None, k % 2)
+            if project.status == 'finish':
+                break
+        if i % 6 == 1 and project.progress > 0:
+            project.doPause(admin)
+            if i % 12 == 1:
+                project.doResume(admin)
+
+    for user in users:
+        user.reg_date = BASE - timedelta(days=30)
+    for phase in Phase.query.order_by(Phase.id):
+        phase.start_date = BASE + timedelta(days=random.randint(0, 90), seconds=random.randint(0, 86400),
+                                            microseconds=phase.id)
+        phase.deadline_date = phase.start_date + timedelta(days=random.randint(1, 6))
+        if phase.upload_date:
+            phase.upload_date = phase.start_date + timedelta(days=random.randint(0, 8),
+                                                             seconds=random.randint(0, 86400))
+        if phase.feedback_date:
+            phase.feedback_date = (phase.upload_date or phase.start_date) + timedelta(hours=5)
+        phase.creator_user_id = random.choice([user.id for user in users[1:5]])
+    for pause in ProjectPause.query.order_by(ProjectPause.id):
+        if pause.phase:
+            pause.pause_date = pause.phase.start_date + timedelta(hours=random.randint(0, 100))
+            if random.random() < .7:
+                pause.resume_date = pause.pause_date + timedelta(hours=random.randint(1, 30))
+    for file in files:
+        file.upload_date = BASE + timedelta(days=random.randint(0, 90))
+        file.uploader_user_id = random.choice([user.id for user in users[1:5]])
+        file.tags = resolveTags(['t%d' % k for k in range(random.randint(0, 11))])
+    for project in Project.query.order_by(Project.id):
+        if project.status == 'finish' or random.random() < .3:
+            project.finish_date = BASE + timedelta(days=random.randint(0, 90))
+    db.session.commit()
+    return users
+
+
+@pytest.fixture
+def users(database):
+    users = buildProjects()
+    Phase.fill_pauses()
+    return [user.id for user in users]
+
+
+@pytest.fixture
+def edge(database):
+    """One project by users 1 and 2, with pauses on both sides of the upload.
+
+    Stage 草图: user 1 uploads the first phase, paused for an hour before the
+    upload and for two after it, user 2 uploads the second and last one,
+    which passes. Stage 成图: user 1 uploads once, the phase is paused when
+    the range ends and gets no feedback.
+    """
+    admin = makeUser(0, role_id=2)
+    first, second = makeUser(1), makeUser(2)
+    admin.reg_date = first.reg_date = second.reg_date = BASE - timedelta(days=30)
+    project = Project.create_project(admin.id, 'edge', admin.id, first.id, '', [
+        {'stage_name': '草图', 'days_planned': 3}, {'stage_name': '成图', 'days_planned': 5}], ['样图'], [])
+    project.doStart(admin.id)
+    sketch = project.stages[0].phases[0]
+    sketch.start_date = BASE
+    project.doPause(admin.id)
+    project.doResume(admin.id)
+    project.doUpload(admin.id, first.id, 'upload', [], [])
+    project.doPause(admin.id)
+    project.doResume(admin.id)
+    project.doFeedback(admin.id, admin.id, 'feedback', None, 0)
+    project.doUpload(admin.id, second.id, 'upload', [], [])
+    project.doFeedback(admin.id, admin.id, 'feedback', None, 1)
+    project.doUpload(admin.id, first.id, 'upload', [], [])
+    project.doPause(admin.id)
+
+    before, after = sorted(sketch.pauses, key=lambda pause: pause.id)
+    before.pause_date, before.resume_date = BASE + timedelta(hours=1), BASE + timedelta(hours=2)
+    sketch.deadline_date = BASE + timedelta(days=3)
+    sketch.upload_date = BASE + timedelta(days=1)
+    after.pause_date, after.resume_date = BASE + timedelta(days=1, hours=1), BASE + timedelta(days=1, hours=3)
+    sketch.feedback_date = BASE + timedelta(days=2)
+    redo, colour = project.stages[0].phases[1], project.stages[1].phases[0]
+    redo.start_date, redo.deadline_date = BASE + timedelta(days=2), BASE + timedelta(days=5)
+    redo.upload_date = redo.feedback_date = BASE + timedelta(days=4)
+    colour.start_date, colour.deadline_date = BASE + timedelta(days=4), BASE + timedelta(days=9)
+    colour.upload_date = BASE + timedelta(days=10)
+    colour.pauses[0].pause_date = BASE + timedelta(days=11)
+    db.session.commit()
+    Phase.fill_pauses()
+    return first.id, second.id
+
+
+def compare(user_id, date_range):
+    db.session.expire_all()
+    old = loopData(user_id, date_range)
+    new = getData(user_id, date_range)
+    counts = {key: old[key] if key == 'overtime_sum' else len(old[key]) for key in COUNTS}
+    assert counts == {key: new[key] for key in COUNTS}
+    assert loopAttr(old) == getAttr(new)
+    return new
+
+
+def test_getData(users):
+    for date_range in RANGES:
+        for user_id in users:
+            compare(user_id, date_range)
+
+
+def test_pauses(edge):
+    first, second = edge
+    data = compare(first, RANGES[0])
+    # the hour paused before the upload is left out, the two after it are not
+    assert data['upload_total'] == timedelta(days=1, hours=-1) + timedelta(days=6)
+    assert data['deadline_total'] == timedelta(days=3, hours=-1) + timedelta(days=5)
+    assert data['overtime_sum'] == 86400
+
+
+def test_last_phase(edge):
+    first, second = edge
+    data = compare(first, RANGES[0])
+    # user 1 worked on both stages, the sketch passed on the second phase,
+    # which is not theirs
+    assert (data['stages_mod_pass_d'], data['stages_no_pass_c']) == (1, 1)
+    assert (data['phases_modify'], data['phases_pass'], data['phases_pending']) == (1, 0, 1)
+    data = compare(second, RANGES[0])
+    assert (data['stages_mod_pass_d'], data['stages_all']) == (1, 1)
+    assert (data['phases_pass'], data['phases_all']) == (1, 1)
+    # only the day of the second phase: the stage still counts for user 1
+    data = compare(first, ['2020-06-05 00:00:00', '2020-06-05 23:59:59'])
+    assert (data['stages_mod_pass_d'], data['phases_all']) == (1, 0)
+
+
+def test_getAttrs(users):
+    rollupStats(days=366)
+    # the last two ranges are less than a day long, for the other branch of
+    # every where()
+    users = User.query.filter(User.id.in_(users)).order_by(User.id).all()
+    assert not Phase.query.filter_by(creator_user_id=users[-1].id).count()
+    seen = set()
+    for date_range in RANGES + [['2020-07-01 00:00:00', '2020-07-01 12:00:00'],
+                                ['2019-01-01 00:00:00', '2019-01-01 00:00:00']]:
+        data = getStatsColumns(users, date_range)
+        seen.update(('active', bool(value)) for value in (data['phases_all'] > 0) & (data['delta_days'] >= 1))
+        seen.update(('passed', bool(value)) for value in data['stages_one_pass_c'] + data['stages_mod_pass_c'])
+        attrs = getAttrs(data)
+        for i, user in enumerate(users):
+            assert getAttr(getStats(user.id, date_range)) == {key: value[i] for key, value in attrs.items()}
+    assert seen == {('active', True), ('active', False), ('passed', True), ('passed', False)}
+
+
+def test_getAttrs_empty(database):
+    for date_range in RANGES[:2]:
+        attrs = getAttrs(getStatsColumns([], date_range))
+        assert sorted(attrs) == ['contribution', 'energy', 'knowledge', 'power', 'score', 'speed']
+        assert all(len(value) == 0 for value in attrs.values())
+
+
+def test_edit_upload(database):
+    admin, first, second = makeUser(0, role_id=2), makeUser(1), makeUser(2)
+    project = Project.create_project(admin.id, 'edit', admin.id, first.id, '', [
+        {'stage_name': '成图', 'days_planned': 3}], [], [])
+    project.doStart(admin.id)
+    project.doUpload(admin.id, first.id, 'upload', [], [])
+    assert (getStats(first.id)['phases_all'], getStats(second.id)['phases_all']) == (1, 0)
+
+    project.editUpload(admin.id, second.id, 'upload', [], [])
+    assert (getStats(first.id)['phases_all'], getStats(second.id)['phases_all']) == (0, 1)
+
+    # the upload is now two days late
+    project.doChangeDDL(admin.id, project.current_phase().upload_date - timedelta(days=2))
+    stats = getStats(second.id)
+    assert stats['overtime_sum'] == getData(second.id)['overtime_sum'] == 2 * 86400
+    # the day stats keep whole seconds
+    assert abs(stats['deadline_total'] - getData(second.id)['deadline_total']) < timedelta(seconds=1)
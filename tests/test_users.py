@@ -0,0 +1,76 @@
+"""Writers of the user profile bump its version."""
+import jwt
+from sqlalchemy import event
+from app import app, db
+from app.cache import getVersion, local_cache
+from app.model import User, WxUser
+from app.restful.wechat import accessUser
+from app.restful.decorator import issueToken, getPrincipal
+from conftest import makeUser
+
+WX_DATA = {'openid': 'openid', 'nickname': 'nick', 'sex': 1, 'language': 'zh_CN', 'city': 'city',
+           'province': 'province', 'country': 'country', 'headimgurl': 'http://img', 'unionid': 'unionid'}
+
+
+def test_access(database):
+    with database.get_app().test_request_context():
+        accessUser(WX_DATA)
+    user = WxUser.query.filter_by(unionid='unionid').one().user
+    version = getVersion('user:%s' % user.id)
+    with database.get_app().test_request_context():
+        accessUser(dict(WX_DATA, nickname='renamed', headimgurl='http://new'))
+    db.session.expire_all()
+    assert getVersion('user:%s' % user.id) != version
+    assert (user.wx_user.nickname, user.wx_user.headimg_url, user.wx_user.sex) == ('renamed', 'http://new', 1)
+
+
+def test_delete(client):
+    users = [makeUser(index) for index in range(3)]
+    user_ids = [user.id for user in users]
+    claims = [jwt.decode(issueToken(user_id), app.config['SECRET_KEY'], algorithms=['HS256'])
+              for user_id in user_ids]
+    assert getPrincipal(claims[0]).id == user_ids[0]
+    versions = [getVersion('user:%s' % user_id) for user_id in user_ids]
+
+    response = client.delete('/api/users?user_id=%s,%s' % tuple(user_ids[:2]))
+    assert response.status_code == 200
+    assert [getPrincipal(data) for data in claims[:2]] == [None, None]
+    assert getPrincipal(claims[2]).id == user_ids[2]
+    assert getVersion('user:%s' % user_ids[2]) == versions[2]
+    assert all(getVersion('user:%s' % user_id) != version
+               for user_id, version in zip(user_ids[:2], versions))
+
+
+def test_cache_lost(client):
+    users = [makeUser(index) for index in range(2)]
+    user_ids = [user.id for user in users]
+    # tokens issued on a fresh cache
+    local_cache.data.clear()
+    claims = [jwt.decode(issueToken(user_id), app.config['SECRET_KEY'], algorithms=['HS256'])
+              for user_id in user_ids]
+    assert getPrincipal(claims[1]).role_id == 3
+    User.query.get(user_ids[0]).delete()
+    User.query.get(user_ids[1]).role_id = 2
+    db.session.commit()
+    # Redis flushed or restarted
+    local_cache.data.clear()
+    assert getPrincipal(claims[0]) is None
+    assert getPrincipal(claims[1]).role_id == 2
+
+
+def test_me(client):
+    user = makeUser(1)
+    user_id = user.id
+    client.set_cookie('localhost', 'token', issueToken(user_id))
+    db.session.expunge_all()
+    queries = []
+    listener = lambda *args: queries.append(args[2])
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        response = client.get('/api/me')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    data = response.get_json()
+    assert (data['id'], data['unread_count'], data['role']) == (user_id, 0, 'Visitor')
+    # the user with its joined loads, then one query per list of L_AUTH_USER
+    assert len(queries) == 6
@@ -0,0 +1,107 @@
+"""The outbox and the token handling against the WeChat stub."""
+import json
+from datetime import datetime, timedelta
+import pytest
+from app import app, db, scheduler
+from app.model import WxOutbox
+from app.restful.wechat import sendWxOutbox, getAccessToken
+from app.wxclient import wx
+from conftest import makeUser
+
+
+@pytest.fixture
+def settings():
+    """Restores the app settings a test changes."""
+    saved = dict(app.config)
+    yield app.config
+    app.config.clear()
+    app.config.update(saved)
+
+
+def queue(count):
+    user = makeUser(1)
+    db.session.add_all([WxOutbox(to_user_id=user.id, payload=json.dumps({'message': i}))
+                        for i in range(count)])
+    db.session.commit()
+    return [message.id for message in WxOutbox.query.order_by(WxOutbox.id)]
+
+
+def send():
+    sendWxOutbox.apply()
+    db.session.expire_all()
+    return WxOutbox.query.order_by(WxOutbox.id).all()
+
+
+def makeDue():
+    WxOutbox.query.update({WxOutbox.next_try_date: datetime.utcnow()})
+    db.session.commit()
+
+
+def test_drain(wechat):
+    queue(10)
+    messages = send()
+    assert [message.status for message in messages] == ['sent'] * 10
+    assert sorted(json.loads(payload)['message'] for payload in wechat.messages) == list(range(10))
+    makeDue()
+    send()
+    assert len(wechat.messages) == 10
+    assert len(wechat.tokens) == 1
+
+
+@pytest.mark.parametrize('answer', [45009, 429])
+def test_limited(wechat, settings, answer):
+    settings['WX_OUTBOX_CONCURRENCY'] = 1
+    queue(3)
+    wechat.answers.append(answer)
+    messages = send()
+    # the rest of the batch waits without a request
+    assert not wechat.messages and not wechat.answers
+    assert [(message.status, message.attempts) for message in messages] == [('pending', 0)] * 3
+    assert all(message.next_try_date > datetime.utcnow() + timedelta(seconds=30) for message in messages)
+    makeDue()
+    assert [message.status for message in send()] == ['sent'] * 3
+
+
+def test_retry_limit(wechat, settings):
+    settings['WX_OUTBOX_MAX_ATTEMPTS'] = 3
+    queue(1)
+    wechat.answers.extend([-1] * 5)
+    for attempts in range(1, 4):
+        message, = send()
+        assert message.attempts == attempts
+        makeDue()
+    assert (message.status, message.error) == ('failed', '-1 stub answer')
+    send()
+    assert len(wechat.answers) == 2 and not wechat.messages
+
+
+@pytest.mark.parametrize('errcode', [40001, 42001])
+def test_token_expired(wechat, errcode):
+    queue(1)
+    wechat.answers.append(errcode)
+    message, = send()
+    assert (message.status, message.attempts) == ('sent', 0)
+    assert len(wechat.tokens) == 2 and len(wechat.messages) == 1
+
+
+def test_call_refresh(wechat):
+    assert wx.get('/cgi-bin/user/info', params={'openid': 'a'})['nickname'] == 'stub'
+    # expired at WeChat before our margin says so
+    wechat.tokens[-1][1] = datetime.utcnow() - timedelta(seconds=1)
+    assert wx.get('/cgi-bin/user/info', params={'openid': 'b'})['openid'] == 'b'
+    assert len(wechat.tokens) == 2
+    wechat.tokens.append(['revoked', datetime.utcnow() + timedelta(hours=1)])
+    assert wx.get('/cgi-bin/user/info', params={'openid': 'c'})['openid'] == 'c'
+    assert len(wechat.tokens) == 4
+
+
+def test_token_api(wechat, client):
+    scheduler.add_job(id='update_wechat_access_token', func=getAccessToken, trigger='interval', minutes=110)
+    for _ in range(2):
+        response = client.post('/api/wechat/token')
+        assert response.status_code == 200
+        assert response.get_json()['access_token'] == wechat.tokens[-1][0]
+    # one refresh, shared with the outbox and every other call
+    assert len(wechat.tokens) == 1
+    assert wx.accessToken() == wechat.tokens[-1][0]
+    assert scheduler.get_job('update_wechat_access_token') is None